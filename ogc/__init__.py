@@ -1,5 +1,10 @@
 from __future__ import annotations
 
-from gevent import monkey
+import os
 
-monkey.patch_all()
+# The asyncio executor runs blocking work in threads, leave the interpreter
+# alone for it, see `ogc.executor`
+if os.environ.get("OGC_EXECUTOR", "gevent") == "gevent":
+    from gevent import monkey
+
+    monkey.patch_all()
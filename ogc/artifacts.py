@@ -0,0 +1,323 @@
+"""Streaming collection of artifacts from machines
+
+Every machine runs a single `tar -cz` of the files matching the patterns, its
+output is read from one SSH channel and unpacked as it arrives, nothing waits
+for the whole archive. Files go either to a directory per machine or into one
+combined archive.
+
+Files are de-duplicated by their sha256: in directories, identical files are
+hard links to one copy under `.objects`, in a combined archive they are added
+once and linked to from then on.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import posixpath
+import queue
+import re
+import shlex
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import typing as t
+import uuid
+from pathlib import Path
+
+import structlog
+from attrs import define
+
+from ogc import connections
+from ogc.executor import get_executor
+from ogc.rollout import Rollout
+from ogc.scheduler import Priority
+
+if t.TYPE_CHECKING:
+    from ogc.models.machine import MachineModel
+
+log = structlog.getLogger()
+
+# Chunks of a stream held in memory before the machine is made to wait
+QUEUE_CHUNKS = 64
+
+# Files of a combined archive larger than this are spooled to disk
+SPOOL_SIZE = 8 * 2**20
+
+OBJECTS_DIR = ".objects"
+
+
+class ArtifactClient(t.Protocol):
+    """Runs commands on a node"""
+
+    name: str
+
+    def run(self, cmd: str, **kwargs: t.Any) -> tuple[str, str, int]:
+        ...
+
+
+@define
+class ArtifactReport:
+    """Artifacts collected from a machine
+
+    Attributes:
+        files: files collected
+        duplicates: files identical to one collected before
+        bytes: size of the files
+        received: bytes received, compressed
+        elapsed: seconds the collection took
+    """
+
+    files: int = 0
+    duplicates: int = 0
+    bytes: int = 0
+    received: int = 0
+    elapsed: float = 0.0
+
+
+def remote_command(patterns: t.Iterable[str]) -> str:
+    """Shell command writing a tar.gz of the files matching globs to stdout
+
+    Patterns are relative to the home directory, `**` matches across
+    directories. Paths that don't exist are left out, nothing is written when
+    no file matches.
+    """
+    # Escape everything but the glob characters, the shell expands the rest
+    globs = " ".join(re.sub(r"([^\w*?\[\]/.\-])", r"\\\1", pat) for pat in patterns)
+    script = (
+        f'set --; for path in {globs}; do [ -e "$path" ] && set -- "$@" "$path"; done;'
+        ' [ "$#" -eq 0 ] || exec tar -czf - -- "$@"'
+    )
+    return f"bash -O globstar -O nullglob -c {shlex.quote(script)}"
+
+
+class _Stream(io.RawIOBase):
+    """Output of a command, read as a file while it arrives"""
+
+    def __init__(self, maxsize: int = QUEUE_CHUNKS):
+        self.chunks: queue.Queue[bytes] = queue.Queue(maxsize)
+        self.buf = b""
+        self.received = 0
+        self.done = False
+        self.aborted = False
+
+    def feed(self, data: bytes) -> None:
+        if not self.aborted:
+            self.received += len(data)
+            self.chunks.put(data)
+
+    def end(self) -> None:
+        self.chunks.put(b"")
+
+    def abort(self) -> None:
+        """Drops the rest of the output, so the command isn't left waiting"""
+        self.aborted = True
+        while not self.done:
+            self.done = not self.chunks.get()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        while not self.buf and not self.done:
+            data = self.chunks.get()
+            self.done = not data
+            self.buf = data
+        size = min(len(buf), len(self.buf))
+        buf[:size] = self.buf[:size]
+        self.buf = self.buf[size:]
+        return size
+
+
+def _safe_name(name: str) -> str | None:
+    """Member name relative to the node's directory, None if it escapes it"""
+    name = posixpath.normpath(name.lstrip("/"))
+    if name in ("", ".") or name == ".." or name.startswith("../"):
+        return None
+    return name
+
+
+class DirectorySink:
+    """Writes the files of every machine to `dest/<name>`
+
+    Args:
+        dest: directory to write to
+    """
+
+    def __init__(self, dest: Path):
+        self.dest = dest
+        self.objects = dest / OBJECTS_DIR
+        self.objects.mkdir(parents=True, exist_ok=True)
+
+    def add(self, node: str, member: tarfile.TarInfo, fileobj: t.BinaryIO) -> bool:
+        """Stores a file, returns whether an identical one was stored before"""
+        digest = hashlib.sha256()
+        tmp = self.objects / f"tmp-{uuid.uuid4().hex}"
+        with tmp.open("wb") as fp:
+            for chunk in iter(lambda: fileobj.read(2**20), b""):
+                digest.update(chunk)
+                fp.write(chunk)
+        obj = self.objects / digest.hexdigest()
+        duplicate = obj.exists()
+        if duplicate:
+            tmp.unlink()
+        else:
+            tmp.chmod(member.mode & 0o777)
+            os.utime(tmp, (member.mtime, member.mtime))
+            tmp.replace(obj)
+        path = self.dest / node / member.name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.unlink(missing_ok=True)
+        try:
+            os.link(obj, path)
+        except OSError:
+            shutil.copy2(obj, path)
+        return duplicate
+
+    def close(self) -> None:
+        pass
+
+
+class ArchiveSink:
+    """Writes the files of every machine under `<name>/` of one tar.gz
+
+    Args:
+        path: archive to write
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.tar = tarfile.open(path, "w:gz")
+        self.seen: dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def add(self, node: str, member: tarfile.TarInfo, fileobj: t.BinaryIO) -> bool:
+        """Adds a file, returns whether an identical one was added before"""
+        digest = hashlib.sha256()
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            for chunk in iter(lambda: fileobj.read(2**20), b""):
+                digest.update(chunk)
+                spool.write(chunk)
+            spool.seek(0)
+            info = tarfile.TarInfo(f"{node}/{member.name}")
+            info.mtime = member.mtime
+            info.mode = member.mode
+            with self.lock:
+                first = self.seen.get(digest.hexdigest())
+                if first:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = first
+                    self.tar.addfile(info)
+                    return True
+                info.size = member.size
+                self.tar.addfile(info, spool)
+                self.seen[digest.hexdigest()] = info.name
+        return False
+
+    def close(self) -> None:
+        self.tar.close()
+
+
+Sink = t.Union[DirectorySink, ArchiveSink]
+
+
+def _collect(client: ArtifactClient, cmd: str, sink: Sink) -> ArtifactReport:
+    """Unpacks the tar stream of a machine into a sink as it arrives"""
+    report = ArtifactReport()
+    started = time.monotonic()
+    stream = _Stream()
+    result: list[tuple[str, str, int]] = []
+
+    def _run() -> None:
+        try:
+            result.append(client.run(cmd, on_stdout=stream.feed))
+        finally:
+            stream.end()
+
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    try:
+        reader = io.BufferedReader(stream, buffer_size=2**20)
+        if reader.peek(1):
+            with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+                for member in tar:
+                    name = _safe_name(member.name)
+                    if not member.isfile() or name is None:
+                        continue
+                    member.name = name
+                    report.duplicates += sink.add(
+                        client.name, member, tar.extractfile(member)
+                    )
+                    report.files += 1
+                    report.bytes += member.size
+    finally:
+        stream.abort()
+        thread.join()
+    if not result:
+        raise RuntimeError(f"Could not collect artifacts from {client.name}")
+    _, err, exit_code = result[0]
+    # tar exits with 1 when a file changed while it was read
+    if exit_code > 1:
+        raise RuntimeError(f"Collecting artifacts failed: {err.strip()}")
+    report.received = stream.received
+    report.elapsed = time.monotonic() - started
+    return report
+
+
+def pull(
+    machines: t.Iterable[MachineModel],
+    patterns: t.Iterable[str],
+    dest: Path = Path("artifacts"),
+    archive: Path | None = None,
+    rollout: Rollout | None = None,
+    client: t.Callable[[t.Any], ArtifactClient] = connections.PooledClient,
+) -> dict[str, ArtifactReport]:
+    """Collects the files matching patterns from machines
+
+    Args:
+        machines: machines to collect from
+        patterns: globs relative to the home directory, eg. `logs/**/*.log`
+        dest: directory to write a directory per machine to
+        archive: write one tar.gz with a directory per machine instead
+        rollout: batches and timeouts, all machines at once if unset
+        client: returns the client of a machine
+
+    Returns:
+        Report of every machine that succeeded, by name
+    """
+    cmd = remote_command(patterns)
+    sink = ArchiveSink(archive) if archive else DirectorySink(dest)
+    reports: dict[str, ArtifactReport] = {}
+
+    def _node(_client: ArtifactClient) -> bool:
+        reports[_client.name] = _collect(_client, cmd, sink)
+        return True
+
+    started = time.monotonic()
+    try:
+        get_executor().run(
+            rollout or Rollout(),
+            [client(machine) for machine in machines],
+            _node,
+            "transfer",
+            Priority.EXEC,
+        )
+    finally:
+        sink.close()
+    totals = {
+        key: sum(getattr(report, key) for report in reports.values())
+        for key in ("files", "duplicates", "bytes", "received")
+    }
+    log.info(
+        f"Collected artifacts from {len(reports)} node(s)",
+        dest=str(archive or dest),
+        files=totals["files"],
+        duplicates=totals["duplicates"],
+        mb=round(totals["bytes"] / 2**20, 1),
+        received_mb=round(totals["received"] / 2**20, 1),
+        elapsed=round(time.monotonic() - started, 2),
+    )
+    return reports
@@ -0,0 +1,144 @@
+"""Content-addressed script bundles
+
+The scripts rendered for a node are packed into a single compressed tarball
+and uploaded in one transfer. The bundle is addressed by the hash of its
+contents, which is kept in a manifest on the node, so re-running unchanged
+scripts skips the upload entirely.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import io
+import json
+import posixpath
+import shlex
+import tarfile
+import typing as t
+from pathlib import Path
+
+import structlog
+from attrs import define, field
+
+log = structlog.getLogger()
+
+# Where bundles and their manifest are kept, relative to the remote home
+REMOTE_DIR = ".ogc"
+
+MANIFEST = f"{REMOTE_DIR}/bundle.json"
+
+
+@define
+class Bundle:
+    """Files to upload to a node
+
+    Attributes:
+        files: file contents by path relative to the remote home
+    """
+
+    files: dict[str, bytes] = field(factory=dict)
+
+    def add(self, path: str, contents: str | bytes) -> None:
+        """Adds a file, text is encoded as utf-8"""
+        self.files[path] = contents.encode() if isinstance(contents, str) else contents
+
+    def add_dir(self, src: Path, dest: str) -> None:
+        """Adds every file of a directory as is, under `dest`"""
+        for path in sorted(src.glob("**/*")):
+            if path.is_file():
+                self.add(f"{dest}/{path.relative_to(src).as_posix()}", path.read_bytes())
+
+    @property
+    def manifest(self) -> dict[str, str]:
+        """sha256 of every file by path"""
+        return {
+            path: hashlib.sha256(contents).hexdigest()
+            for path, contents in sorted(self.files.items())
+        }
+
+    @property
+    def digest(self) -> str:
+        """sha256 of the manifest, identifies the bundle"""
+        return hashlib.sha256(
+            json.dumps(self.manifest, sort_keys=True).encode()
+        ).hexdigest()
+
+    def pack(self) -> bytes:
+        """Returns the bundle as a reproducible tar.gz"""
+        buf = io.BytesIO()
+        # mtime=0 so identical contents always produce identical bytes
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6, mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode="w", format=tarfile.PAX_FORMAT) as tar:
+                for path, contents in sorted(self.files.items()):
+                    info = tarfile.TarInfo(path)
+                    info.size = len(contents)
+                    info.mode = 0o755
+                    tar.addfile(info, io.BytesIO(contents))
+        return buf.getvalue()
+
+
+def remote_digest(client: t.Any) -> str | None:
+    """Digest of the bundle last uploaded to a node, None if there is none"""
+    out, _, exit_code = client.run(f"cat {MANIFEST} 2>/dev/null")
+    if exit_code != 0:
+        return None
+    try:
+        return json.loads(out)["digest"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def upload(client: t.Any, bundle: Bundle, name: str = "") -> bool:
+    """Uploads a bundle unless the node already has it
+
+    The tarball is extracted into the remote home and the manifest written
+    once it is. Nodes without tar get the files uploaded one at a time.
+
+    Files are uploaded over a new SFTP session to absolute paths, a session
+    shared with other uploads may have changed its working directory.
+
+    Args:
+        client: node client with `run` and `sftp`, see
+            `ogc.connections.PooledClient`
+        bundle: bundle to upload
+        name: node name, for logging
+
+    Returns:
+        True if the bundle was uploaded, False if it was unchanged
+    """
+    digest = bundle.digest
+    if remote_digest(client) == digest:
+        log.debug("Bundle unchanged, skipping upload", machine=name, digest=digest)
+        return False
+    archive = f"{REMOTE_DIR}/bundle-{digest[:16]}.tar.gz"
+    data = bundle.pack()
+    manifest = json.dumps({"digest": digest, "files": bundle.manifest})
+    with client.sftp() as sftp:
+        home = sftp.normalize(".")
+        client.run(f"mkdir -p {REMOTE_DIR}")
+        sftp.putfo(io.BytesIO(data), posixpath.join(home, archive))
+        _, err, exit_code = client.run(
+            f"tar -xzf {archive} && rm -f {archive} "
+            f"&& echo {shlex.quote(manifest)} > {MANIFEST}"
+        )
+        if exit_code != 0:
+            log.debug(
+                "Could not extract bundle, uploading files", machine=name, err=err
+            )
+            sftp.remove(posixpath.join(home, archive))
+            dirs = {posixpath.dirname(path) for path in bundle.files} - {""}
+            if dirs:
+                client.run(f"mkdir -p {' '.join(map(shlex.quote, sorted(dirs)))}")
+            for path, contents in bundle.files.items():
+                sftp.putfo(io.BytesIO(contents), posixpath.join(home, path))
+                sftp.chmod(posixpath.join(home, path), 0o755)
+            sftp.putfo(io.BytesIO(manifest.encode()), posixpath.join(home, MANIFEST))
+    log.debug(
+        "Uploaded bundle",
+        machine=name,
+        digest=digest,
+        files=len(bundle.files),
+        size=len(data),
+    )
+    return True
@@ -0,0 +1,121 @@
+"""Cache of provider catalogs: sizes, images and locations
+
+Listing sizes or images takes seconds and returns the same thing for every
+layout of a run, so lookups are kept in memory and on disk for `CATALOG_TTL`
+seconds, keyed by provider and region or project. Concurrent lookups of the
+same key wait for a single call to the provider.
+
+libcloud objects are stored without their driver, `bind` attaches the driver
+of the provisioner using them.
+"""
+
+from __future__ import annotations
+
+import copy
+import os
+import threading
+import time
+import typing as t
+
+import structlog
+
+from ogc import db
+
+log = structlog.getLogger()
+
+# Seconds a catalog lookup is reused
+CATALOG_TTL = int(os.environ.get("OGC_CATALOG_TTL", 86400))
+
+T = t.TypeVar("T")
+
+Key = t.Tuple[str, ...]
+
+
+def bind(value: T, driver: t.Any) -> T:
+    """Copies libcloud objects with their driver set, nested ones in `extra` too"""
+    if isinstance(value, list):
+        return [bind(item, driver) for item in value]  # type: ignore
+    if isinstance(value, dict):
+        return {key: bind(item, driver) for key, item in value.items()}  # type: ignore
+    if hasattr(value, "driver"):
+        value = copy.copy(value)
+        value.driver = driver  # type: ignore
+        if isinstance(getattr(value, "extra", None), dict):
+            value.extra = bind(value.extra, driver)  # type: ignore
+    return value
+
+
+class Catalog:
+    """Provider lookups cached in memory and on disk
+
+    Args:
+        ttl: seconds a lookup is reused
+    """
+
+    def __init__(self, ttl: float = CATALOG_TTL):
+        self.ttl = ttl
+        self._memory: dict[Key, tuple[float, t.Any]] = {}
+        self._locks: dict[Key, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, key: Key) -> tuple[bool, t.Any]:
+        expires, value = self._memory.get(key, (0.0, None))
+        if expires > time.time():
+            return True, value
+        stored = db.catalog_path().get(key)
+        if stored is not None:
+            self._memory[key] = stored
+            return True, stored[1]
+        return False, None
+
+    def get(self, key: Key, fetch: t.Callable[[], T]) -> T:
+        """Returns a lookup, calling the provider if it isn't cached
+
+        Args:
+            key: provider, its region or project, and what is looked up
+            fetch: calls the provider
+
+        Returns:
+            The lookup, libcloud objects in it have no driver, see `bind`
+        """
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            found, value = self._fresh(key)
+            if found:
+                return value
+            started = time.monotonic()
+            value = bind(fetch(), None)
+            log.debug(
+                "Fetched provider catalog",
+                key=":".join(key),
+                elapsed=round(time.monotonic() - started, 2),
+            )
+            expires = time.time() + self.ttl
+            self._memory[key] = (expires, value)
+            db.catalog_path().set(key, (expires, value), expire=self.ttl)
+            return value
+
+    def refresh(self, provider: str | None = None) -> None:
+        """Drops the lookups of a provider, of every provider if None"""
+        cache = db.catalog_path()
+        with self._lock:
+            for key in list(self._memory):
+                if provider is None or key[0] == provider:
+                    del self._memory[key]
+            for key in list(cache.iterkeys()):
+                if provider is None or key[0] == provider:
+                    cache.delete(key)
+
+
+_catalog: Catalog | None = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> Catalog:
+    """Returns the process wide catalog"""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = Catalog()
+        return _catalog
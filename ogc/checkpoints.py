@@ -0,0 +1,135 @@
+"""Per node, per step completion records of exec-scripts
+
+Every step run on a node records the hash of the script it ran, its exit code
+and how long it took. Resuming skips the steps that already succeeded with the
+same script, so only failed, changed or new steps run again.
+"""
+
+from __future__ import annotations
+
+import datetime
+import hashlib
+import typing as t
+
+import structlog
+from attrs import asdict, define
+
+from ogc import db
+
+log = structlog.getLogger()
+
+
+@define
+class StepRecord:
+    """Outcome of a step on a node
+
+    Attributes:
+        step: name of the step, its script's file name
+        digest: sha256 of the rendered script
+        exit_code: exit code of the script
+        duration: seconds the script took
+        finished: when the script finished, ISO 8601
+    """
+
+    step: str
+    digest: str
+    exit_code: int
+    duration: float
+    finished: str
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_code == 0
+
+
+def digest(script: str | bytes) -> str:
+    """sha256 of a rendered script"""
+    return hashlib.sha256(
+        script.encode() if isinstance(script, str) else script
+    ).hexdigest()
+
+
+def record(
+    instance_id: str,
+    scope: str,
+    step: str,
+    script_digest: str,
+    exit_code: int,
+    duration: float,
+) -> StepRecord:
+    """Stores the outcome of a step
+
+    Args:
+        instance_id: node the step ran on
+        scope: scripts the step belongs to, eg. the scripts directory
+        step: name of the step
+        script_digest: sha256 of the rendered script
+        exit_code: exit code of the script
+        duration: seconds the script took
+
+    Returns:
+        The stored record
+    """
+    _record = StepRecord(
+        step=step,
+        digest=script_digest,
+        exit_code=exit_code,
+        duration=round(duration, 3),
+        finished=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    )
+    cache = db.checkpoints_path()
+    key = (str(instance_id), scope)
+    # Steps of a node running concurrently write the same key, the transaction
+    # keeps them from overwriting each other's records
+    with cache.transact():
+        steps = cache.get(key, {})
+        steps[step] = asdict(_record)
+        cache[key] = steps
+    return _record
+
+
+def records(instance_id: str, scope: str) -> dict[str, StepRecord]:
+    """Stored step records of a node, by step"""
+    steps = db.checkpoints_path().get((str(instance_id), scope), {})
+    return {step: StepRecord(**_record) for step, _record in steps.items()}
+
+
+def forget(*instance_ids: str) -> None:
+    """Removes the step records of nodes, in a single pass over the records"""
+    cache = db.checkpoints_path()
+    ids = {str(instance_id) for instance_id in instance_ids}
+    with cache.transact():
+        for key in list(cache.iterkeys()):
+            if key[0] in ids:
+                cache.delete(key)
+
+
+def pending(
+    steps: t.Sequence[tuple[str, str]],
+    done: dict[str, StepRecord],
+    resume: bool = False,
+    from_step: str | None = None,
+) -> list[str]:
+    """Steps that have to run
+
+    Args:
+        steps: name and script digest of every step, in order
+        done: stored records of the node, see `records`
+        resume: skip steps that succeeded with the same script
+        from_step: skip every step before this one
+
+    Returns:
+        Names of the steps to run, in order
+
+    Raises:
+        ValueError: if `from_step` isn't one of the steps
+    """
+    names = [name for name, _ in steps]
+    start = names.index(from_step) if from_step else 0
+    todo = []
+    for name, script_digest in steps[start:]:
+        previous = done.get(name)
+        if resume and previous and previous.ok and previous.digest == script_digest:
+            continue
+        todo.append(name)
+    return todo
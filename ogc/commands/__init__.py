@@ -3,6 +3,8 @@ from __future__ import annotations
 from .add import *
 from .base import *
 from .down import *
+from .files import *
 from .ls import *
+from .migrate import *
 from .run import *
 from .up import *
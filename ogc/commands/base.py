@@ -1,15 +1,16 @@
 from __future__ import annotations
 
+import functools
 import logging
 import os
-from multiprocessing import cpu_count
 
 import click
 import structlog
 from dotenv import load_dotenv
 
-# Not advertised, but available for those who seek moar power.
-MAX_WORKERS = int(os.environ.get("OGC_MAX_WORKERS", cpu_count() - 1))
+from ogc import filters, timeouts
+from ogc.exceptions import QueryException
+from ogc.rollout import Rollout
 
 logging.getLogger("paramiko").setLevel(logging.WARNING)
 
@@ -19,13 +20,100 @@ class CliCtx:
         self.query = query
         self.opts = {}
         if self.query:
-            k, v = self.query.split("=")
-            self.opts.update({k: v})
+            self.opts.update({"query": parse_query(self.query)})
+
+
+def parse_query(query: str) -> filters.Filter:
+    """Compiles a `--query` option, see `ogc.filters` for the syntax"""
+    try:
+        return filters.parse(query)
+    except QueryException as exc:
+        raise click.BadParameter(str(exc), param_hint="'--query'")
+
+
+def rollout_options(batching: bool = True):
+    """Adds batching and timeout options, passed to the command as a `rollout`
+
+    Args:
+        batching: add the batching options, only timeouts otherwise
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(
+            *args,
+            batch_size=None,
+            batch_percent=None,
+            canary=0,
+            max_failures=None,
+            node_timeout=None,
+            timeout=None,
+            **kwargs,
+        ):
+            if batch_size and batch_percent:
+                raise click.UsageError(
+                    "--batch-size and --batch-percent are mutually exclusive"
+                )
+            rollout = Rollout(
+                batch_size=batch_size,
+                batch_percent=batch_percent,
+                canary=canary,
+                max_failures=max_failures,
+                node_timeout=node_timeout,
+                timeout=timeout,
+            )
+            return func(*args, rollout=rollout, **kwargs)
+
+        options = [
+            click.option(
+                "--node-timeout",
+                type=click.FloatRange(min=0, min_open=True),
+                default=timeouts.NODE_TIMEOUT,
+                help="Seconds a single machine may take [env: OGC_NODE_TIMEOUT]",
+            ),
+            click.option(
+                "--timeout",
+                type=click.FloatRange(min=0, min_open=True),
+                default=timeouts.TIMEOUT,
+                help="Seconds the whole command may take [env: OGC_TIMEOUT]",
+            ),
+        ]
+        if batching:
+            options += [
+                click.option(
+                    "--batch-size",
+                    type=click.IntRange(min=1),
+                    help="Machines per batch",
+                ),
+                click.option(
+                    "--batch-percent",
+                    type=click.FloatRange(min=0, min_open=True, max=100),
+                    help="Machines per batch, as a percentage of all machines",
+                ),
+                click.option(
+                    "--canary",
+                    type=click.IntRange(min=0),
+                    default=0,
+                    help="Run a first batch of this many machines, abort if any fails",
+                ),
+                click.option(
+                    "--max-failures",
+                    type=click.IntRange(min=0),
+                    help="Abort, cancelling the machines left, once exceeded",
+                ),
+            ]
+        for option in reversed(options):
+            wrapper = option(wrapper)
+        return wrapper
+
+    return decorator
 
 
 @click.group()
 @click.option("--verbose", "-v", is_flag=True, help="Increase logging verbosity")
-@click.option("--query", "-q", "query", help="Filter machines via attributes")
+@click.option(
+    "--query", "-q", "query", help="Filter machines, eg. 'tag=worker and age>2h'"
+)
 @click.pass_context
 def cli(ctx, verbose: bool, query: str) -> None:
     """Just a simple provisioner"""
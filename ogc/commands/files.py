@@ -0,0 +1,190 @@
+"""copy files to and from machines"""
+from __future__ import annotations
+
+from pathlib import Path
+
+import click
+
+from ogc import artifacts, db, distribute, transfer
+from ogc.commands.base import cli, rollout_options
+from ogc.rollout import Rollout
+
+
+def transfer_options(func):
+    """Adds the options shared by push-files and pull-files"""
+    options = [
+        click.option(
+            "--exclude",
+            multiple=True,
+            help="Glob of files or directories to leave out, repeatable",
+        ),
+        click.option(
+            "--compress",
+            is_flag=True,
+            help="Stream files through gzip, for compressible data on slow links",
+        ),
+        click.option(
+            "--restart",
+            is_flag=True,
+            help="Copy interrupted files from the start instead of resuming",
+        ),
+        click.option(
+            "--streams",
+            type=click.IntRange(min=1),
+            default=transfer.STREAMS,
+            show_default=True,
+            help="SFTP sessions per machine [env: OGC_TRANSFER_STREAMS]",
+        ),
+        rollout_options(),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def _check(reports: dict[str, transfer.TransferReport]) -> None:
+    failed = [name for name, report in reports.items() if report.failed]
+    if failed:
+        raise click.ClickException(f"Transfers failed on: {', '.join(failed)}")
+
+
+@click.command(help="Copy files or directories to machines")
+@click.argument("src", type=click.Path(exists=True, path_type=Path))
+@click.argument("dest", type=str)
+@transfer_options
+@click.pass_obj
+def _push_files(
+    ctx_obj,
+    src: Path,
+    dest: str,
+    exclude: tuple[str, ...],
+    compress: bool,
+    restart: bool,
+    streams: int,
+    rollout: Rollout,
+) -> None:
+    """Pushes files to machines by query"""
+    _check(
+        transfer.push(
+            db.iter_machines(**ctx_obj.opts),
+            src,
+            dest,
+            exclude=exclude,
+            compress=compress,
+            resume=not restart,
+            streams=streams,
+            rollout=rollout,
+        )
+    )
+
+
+@click.command(help="Copy files or directories from machines")
+@click.argument("src", type=str)
+@click.argument("dest", type=Path)
+@transfer_options
+@click.pass_obj
+def _pull_files(
+    ctx_obj,
+    src: str,
+    dest: Path,
+    exclude: tuple[str, ...],
+    compress: bool,
+    restart: bool,
+    streams: int,
+    rollout: Rollout,
+) -> None:
+    """Pulls files from machines by query, into a directory per machine"""
+    _check(
+        transfer.pull(
+            db.iter_machines(**ctx_obj.opts),
+            src,
+            dest,
+            exclude=exclude,
+            compress=compress,
+            resume=not restart,
+            streams=streams,
+            rollout=rollout,
+        )
+    )
+
+
+@click.command(help="Collect files matching globs from machines")
+@click.argument("patterns", nargs=-1, required=True, metavar="PATTERN...")
+@click.option(
+    "--dest",
+    type=Path,
+    default=Path("artifacts"),
+    show_default=True,
+    help="Directory to write a directory per machine to",
+)
+@click.option(
+    "--archive",
+    type=Path,
+    help="Write one tar.gz with a directory per machine instead, eg. soak.tar.gz",
+)
+@rollout_options()
+@click.pass_obj
+def _pull_artifacts(
+    ctx_obj,
+    patterns: tuple[str, ...],
+    dest: Path,
+    archive: Path | None,
+    rollout: Rollout,
+) -> None:
+    """Pulls artifacts from machines by query"""
+    machines = list(db.iter_machines(**ctx_obj.opts))
+    reports = artifacts.pull(
+        machines, patterns, dest=dest, archive=archive, rollout=rollout
+    )
+    missing = [str(m.instance_name) for m in machines if m.instance_name not in reports]
+    if missing:
+        raise click.ClickException(f"Not collected from: {', '.join(missing)}")
+
+
+@click.command(help="Copy a large file to machines, relaying between them")
+@click.argument("src", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.argument("dest", type=str)
+@click.option(
+    "--fanout",
+    type=click.IntRange(min=1),
+    default=distribute.FANOUT,
+    show_default=True,
+    help="Machines each holder serves per round [env: OGC_DISTRIBUTE_FANOUT]",
+)
+@click.option(
+    "--seeds",
+    type=click.IntRange(min=1),
+    default=distribute.SEEDS,
+    show_default=True,
+    help="Machines to upload to directly [env: OGC_DISTRIBUTE_SEEDS]",
+)
+@click.option("--direct", is_flag=True, help="Upload to every machine directly")
+@rollout_options(batching=False)
+@click.pass_obj
+def _distribute(
+    ctx_obj,
+    src: Path,
+    dest: str,
+    fanout: int,
+    seeds: int,
+    direct: bool,
+    rollout: Rollout,
+) -> None:
+    """Distributes a file to machines by query"""
+    report = distribute.distribute(
+        db.iter_machines(**ctx_obj.opts),
+        src,
+        dest,
+        tree=not direct,
+        fanout=fanout,
+        seeds=seeds,
+        rollout=rollout,
+    )
+    if report.failed:
+        raise click.ClickException(f"Not copied to: {', '.join(report.failed)}")
+
+
+cli.add_command(_distribute, name="distribute")
+cli.add_command(_pull_artifacts, name="pull-artifacts")
+cli.add_command(_pull_files, name="pull-files")
+cli.add_command(_push_files, name="push-files")
@@ -0,0 +1,20 @@
+"""migrate machine database"""
+from __future__ import annotations
+
+import click
+import structlog
+
+from ogc import db
+from ogc.commands.base import cli
+
+log = structlog.getLogger()
+
+
+@click.command(help="Convert stored machines to the current database format")
+def db_migrate() -> None:
+    """Rewrites legacy machine records"""
+    converted = db.store().migrate()
+    log.info(f"Migrated {converted} machine(s)")
+
+
+cli.add_command(db_migrate, name="db-migrate")
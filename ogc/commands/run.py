@@ -5,34 +5,84 @@ from pathlib import Path
 
 import click
 
-from ogc import db
-from ogc.commands.base import cli
+from ogc.commands.base import cli, rollout_options
 from ogc.deployer import exec, exec_scripts, ssh
-from ogc.provision import BaseProvisioner
+from ogc.output import TAIL_LINES
+from ogc.rollout import Rollout
 
 
 @click.command(help="Execute command against machines")
 @click.argument("cmd", type=str, metavar="cmd")
+@click.option(
+    "--stream", is_flag=True, help="Print output prefixed by machine as it arrives"
+)
+@click.option(
+    "--tail-lines",
+    type=click.IntRange(min=0),
+    default=TAIL_LINES,
+    show_default=True,
+    help="Trailing output lines kept per machine",
+)
+@click.option(
+    "--spool-dir",
+    type=Path,
+    help="Directory to write the full output of each machine to",
+)
+@rollout_options()
 @click.pass_obj
-def _exec(ctx_obj, cmd: str) -> None:
+def _exec(
+    ctx_obj,
+    cmd: str,
+    stream: bool,
+    tail_lines: int,
+    spool_dir: Path | None,
+    rollout: Rollout,
+) -> None:
     """Executes commands on machines by tag"""
-    exec(cmd, **ctx_obj.opts)
+    results = exec(
+        cmd,
+        stream=stream,
+        tail_lines=tail_lines,
+        spool_dir=spool_dir,
+        rollout=rollout,
+        **ctx_obj.opts,
+    )
+    if results.total:
+        results.print_summary()
 
 
 @click.command(help="Execute scripts against machines")
 @click.argument("script-dir", type=Path, metavar="path/to/script/or/dir")
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Only run the steps that failed, changed or never ran on a machine",
+)
+@click.option("--from-step", help="Skip the steps before this one, eg. 04-install")
+@rollout_options()
 @click.pass_obj
-def _exec_scripts(ctx_obj, script_dir: Path) -> None:
+def _exec_scripts(
+    ctx_obj,
+    script_dir: Path,
+    resume: bool,
+    from_step: str | None,
+    rollout: Rollout,
+) -> None:
     """Launches machines from layout specifications by tag"""
-    exec_scripts(script_dir, **ctx_obj.opts)
+    exec_scripts(
+        script_dir,
+        rollout=rollout,
+        resume=resume,
+        from_step=from_step,
+        **ctx_obj.opts,
+    )
 
 
 @click.command(help="SSH into machine")
 @click.pass_obj
 def _ssh(ctx_obj) -> None:
     """ssh into machine"""
-    _machines = db.query(**ctx_obj.opts)
-    ssh(provisioner=BaseProvisioner.from_machine(machine=_machines[0]))
+    ssh(**ctx_obj.opts)
 
 
 cli.add_command(_exec, name="exec")
@@ -9,27 +9,39 @@ import click
 import structlog
 import yaml
 
-from ogc import db
-from ogc.commands.base import cli
+from ogc import catalog, db
+from ogc.commands.base import cli, rollout_options
 from ogc.deployer import up as d_up
 from ogc.models import layout
+from ogc.rollout import Rollout
 
 
 @click.command(help="Launch machines from layout configurations")
 @click.option("--force", is_flag=True, help="Force machine creation")
+@click.option(
+    "--refresh-catalog",
+    is_flag=True,
+    help="Look sizes, images and locations up again instead of using the cache",
+)
 @click.argument(
     "spec",
     type=click.File("r"),
     metavar="<layouts.yml>",
     required=False,
 )
+@rollout_options(batching=False)
 @click.pass_obj
-def up(ctx_obj, force: bool, spec: Path | io.TextIOWrapper) -> None:
+def up(
+    ctx_obj,
+    force: bool,
+    refresh_catalog: bool,
+    spec: Path | io.TextIOWrapper,
+    rollout: Rollout,
+) -> None:
     """Launches machines from layout specifications by tag"""
     log = structlog.getLogger()
     log.info("Booting up...")
-    _machines = db.query()
-    if _machines and not force:
+    if next(db.iter_machines(), None) and not force:
         log.info("Machines exist, assuming a re-run.")
         sys.exit(0)
 
@@ -52,7 +64,9 @@ def up(ctx_obj, force: bool, spec: Path | io.TextIOWrapper) -> None:
         layouts_from_spec["layouts"]
     )
 
-    d_up(layouts_from_spec)
+    if refresh_catalog:
+        catalog.get_catalog().refresh()
+    d_up(layouts_from_spec, rollout=rollout)
 
 
 cli.add_command(up, name="up")
@@ -0,0 +1,400 @@
+"""SSH connection pool
+
+Connections are kept open per machine and reused across commands, every
+command runs in its own channel multiplexed over the machine's transport.
+Connections idle for longer than `OGC_SSH_IDLE_TIMEOUT` seconds are closed,
+never while a command or SFTP session is using them, broken ones are replaced
+on the next checkout.
+
+For the system `ssh` client an ssh_config of the fleet is generated with
+`write_ssh_config`, its ControlMaster sockets let every command after the
+first one to a machine skip the handshake.
+"""
+
+from __future__ import annotations
+
+import atexit
+import contextlib
+import os
+import select
+import socket
+import tempfile
+import threading
+import time
+import typing as t
+from pathlib import Path
+
+import paramiko
+import structlog
+from libcloud.compute.ssh import ParamikoSSHClient
+from retry.api import retry_call
+
+from ogc import limiter, timeouts
+
+if t.TYPE_CHECKING:
+    from ogc.models.machine import MachineModel
+
+log = structlog.getLogger()
+
+CHUNK_SIZE = 32768
+
+
+class _Connection:
+    def __init__(self) -> None:
+        self.client: ParamikoSSHClient | None = None
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class SSHPool:
+    """Pool of SSH connections keyed by machine
+
+    Args:
+        idle_timeout: seconds a connection may stay unused before it is closed
+        keepalive: seconds between keepalive packets on open transports
+        connect_timeout: seconds to wait for a connection to be established
+    """
+
+    def __init__(
+        self,
+        idle_timeout: float = float(os.environ.get("OGC_SSH_IDLE_TIMEOUT", 300)),
+        keepalive: int = int(os.environ.get("OGC_SSH_KEEPALIVE", 30)),
+        connect_timeout: float = float(os.environ.get("OGC_SSH_CONNECT_TIMEOUT", 30)),
+    ):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self._connections: dict[str, _Connection] = {}
+        # Commands and sessions in flight per connection, these aren't idle
+        self._users: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(machine: MachineModel) -> str:
+        return f"{machine.instance_id}:{machine.username}@{machine.public_ip}"
+
+    @staticmethod
+    def is_healthy(client: ParamikoSSHClient) -> bool:
+        """Whether the client's transport is still usable"""
+        transport = client.client.get_transport()
+        return bool(transport and transport.is_active())
+
+    def _connect(self, machine: MachineModel) -> ParamikoSSHClient:
+        client = ParamikoSSHClient(
+            str(machine.public_ip),
+            username=str(machine.username),
+            key=str(Path(machine.layout.ssh_private_key).expanduser().resolve()),
+            timeout=timeouts.remaining(self.connect_timeout),
+            use_compression=True,
+            keep_alive=self.keepalive,
+        )
+        started = time.monotonic()
+        try:
+            retry_call(
+                client.connect,
+                exceptions=(paramiko.ssh_exception.NoValidConnectionsError, OSError),
+                tries=5,
+                delay=5,
+                jitter=(1, 5),
+                logger=None,
+            )
+        except Exception as exc:
+            limiter.get_limiter().failure(exc)
+            raise
+        limiter.get_limiter().observe(time.monotonic() - started, "ssh-connect")
+        transport = client.client.get_transport()
+        transport.set_keepalive(self.keepalive)
+        transport.use_compression(compress=True)
+        if isinstance(transport.sock, socket.socket):
+            # Channels multiplexed on the transport send small packets, don't
+            # let them wait on the acknowledgement of each other
+            transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return client
+
+    def client(self, machine: MachineModel) -> ParamikoSSHClient:
+        """Checks out the connection of a machine, connecting if needed"""
+        self.evict_idle()
+        key = self.key(machine)
+        with self._lock:
+            conn = self._connections.setdefault(key, _Connection())
+        with conn.lock:
+            if conn.client is not None and not self.is_healthy(conn.client):
+                log.debug("Replacing broken connection", machine=machine.name)
+                conn.client.close()
+                conn.client = None
+            if conn.client is None:
+                conn.client = self._connect(machine)
+            conn.last_used = time.monotonic()
+            return conn.client
+
+    @contextlib.contextmanager
+    def hold(self, machine: MachineModel) -> t.Iterator[None]:
+        """Keeps the connection of a machine from being evicted while in use"""
+        key = self.key(machine)
+        with self._lock:
+            self._users[key] = self._users.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._users[key] -= 1
+                if not self._users[key]:
+                    del self._users[key]
+                conn = self._connections.get(key)
+                if conn:
+                    conn.last_used = time.monotonic()
+
+    def discard(self, machine: MachineModel) -> None:
+        """Closes and forgets the connection of a machine"""
+        with self._lock:
+            conn = self._connections.pop(self.key(machine), None)
+        if conn and conn.client:
+            conn.client.close()
+
+    def evict_idle(self) -> None:
+        """Closes connections unused for longer than the idle timeout"""
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                key
+                for key, conn in self._connections.items()
+                if conn.client is not None
+                and not conn.lock.locked()
+                and not self._users.get(key)
+                and now - conn.last_used > self.idle_timeout
+            ]
+            evicted = [self._connections.pop(key) for key in idle]
+        for conn in evicted:
+            conn.client.close()
+
+    def close(self) -> None:
+        """Closes all connections"""
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            if conn.client:
+                conn.client.close()
+
+    @contextlib.contextmanager
+    def sftp(self, machine: MachineModel) -> t.Iterator[paramiko.SFTPClient]:
+        """Opens an SFTP session over the pooled connection of a machine"""
+        with self.hold(machine):
+            client = self.client(machine)
+            try:
+                sftp = client.client.open_sftp()
+            except (paramiko.SSHException, EOFError):
+                self.discard(machine)
+                sftp = self.client(machine).client.open_sftp()
+            try:
+                yield sftp
+            finally:
+                sftp.close()
+
+    def run(
+        self,
+        machine: MachineModel,
+        cmd: str,
+        timeout: float | None = None,
+        on_stdout: t.Callable[[bytes], t.Any] | None = None,
+        on_stderr: t.Callable[[bytes], t.Any] | None = None,
+        stdin: t.Iterable[bytes] | None = None,
+    ) -> tuple[str, str, int]:
+        """Runs a command on a machine over its pooled connection
+
+        Args:
+            machine: machine to run on
+            cmd: command to execute
+            timeout: seconds to wait for the command to finish, clamped to
+                the current deadline
+            on_stdout: called with stdout chunks as they arrive instead of
+                collecting them
+            on_stderr: called with stderr chunks as they arrive instead of
+                collecting them
+            stdin: chunks to send to the command's stdin, the command
+                shouldn't write much output until it has read them all
+
+        Returns:
+            stdout, stderr and exit code of the command, outputs passed to a
+            callback are returned empty
+        """
+        with self.hold(machine):
+            return self._run(machine, cmd, timeout, on_stdout, on_stderr, stdin)
+
+    def _run(
+        self,
+        machine: MachineModel,
+        cmd: str,
+        timeout: float | None,
+        on_stdout: t.Callable[[bytes], t.Any] | None,
+        on_stderr: t.Callable[[bytes], t.Any] | None,
+        stdin: t.Iterable[bytes] | None,
+    ) -> tuple[str, str, int]:
+        timeout = timeouts.remaining(timeout)
+        client = self.client(machine)
+        started = time.monotonic()
+        try:
+            channel = client.client.get_transport().open_session()
+        except (paramiko.SSHException, EOFError):
+            # The transport died between the health check and opening a channel
+            self.discard(machine)
+            channel = self.client(machine).client.get_transport().open_session()
+        else:
+            limiter.get_limiter().observe(time.monotonic() - started, "ssh-channel")
+
+        stdout, stderr = bytearray(), bytearray()
+        on_stdout = on_stdout or stdout.extend
+        on_stderr = on_stderr or stderr.extend
+        with channel:
+            channel.exec_command(cmd)
+            for chunk in stdin or ():
+                channel.sendall(chunk)
+            channel.shutdown_write()
+            deadline = time.monotonic() + timeout if timeout else None
+            while True:
+                while channel.recv_ready():
+                    on_stdout(channel.recv(CHUNK_SIZE))
+                while channel.recv_stderr_ready():
+                    on_stderr(channel.recv_stderr(CHUNK_SIZE))
+                if (
+                    channel.exit_status_ready()
+                    and not channel.recv_ready()
+                    and not channel.recv_stderr_ready()
+                ):
+                    break
+                if deadline and time.monotonic() > deadline:
+                    raise TimeoutError(f"Command timed out after {timeout}s: {cmd}")
+                select.select([channel], [], [], 1.0)
+            exit_code = channel.recv_exit_status()
+        return (
+            stdout.decode("utf-8", errors="replace"),
+            stderr.decode("utf-8", errors="replace"),
+            exit_code,
+        )
+
+
+class PooledClient:
+    """Runs commands on and copies files to a machine over its pooled connection"""
+
+    def __init__(self, machine: MachineModel):
+        self.machine = machine
+        self.name = str(machine.instance_name)
+        self.address = machine.private_ip
+
+    def run(self, cmd: str, **kwargs: t.Any) -> tuple[str, str, int]:
+        """Runs a command, see `SSHPool.run`"""
+        return get_pool().run(self.machine, cmd, **kwargs)
+
+    def sftp(self) -> t.ContextManager[paramiko.SFTPClient]:
+        """Opens an SFTP session, see `SSHPool.sftp`"""
+        return get_pool().sftp(self.machine)
+
+    def upload(self, src: Path, dest: str) -> None:
+        with self.sftp() as sftp:
+            sftp.put(str(src), dest)
+
+
+_pool: SSHPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> SSHPool:
+    """Returns the process wide SSH connection pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SSHPool()
+            atexit.register(_pool.close)
+        return _pool
+
+
+SSH_CONFIG_DEFAULTS = {
+    "StrictHostKeyChecking": "no",
+    "UserKnownHostsFile": "/dev/null",
+    "LogLevel": "ERROR",
+    "ControlMaster": "auto",
+    "ControlPersist": os.environ.get("OGC_SSH_CONTROL_PERSIST", "10m"),
+    "ServerAliveInterval": "30",
+}
+
+
+def control_dir() -> Path:
+    """Directory of the ControlMaster sockets
+
+    Kept under the temp dir rather than the project, unix socket paths are
+    limited to ~100 characters.
+    """
+    path = Path(tempfile.gettempdir()) / f"ogc-{os.getuid()}"
+    path.mkdir(mode=0o700, exist_ok=True)
+    return path
+
+
+def ssh_config_path() -> Path:
+    """Returns where the generated ssh_config is written"""
+    return Path(__file__).cwd() / ".ogc-cache" / "ssh_config"
+
+
+def host_alias(machine: MachineModel) -> str:
+    """Host entry of a machine in the generated ssh_config"""
+    return str(machine.instance_name)
+
+
+def render_ssh_config(machines: t.Iterable[MachineModel]) -> str:
+    """Renders an ssh_config with a host entry per machine
+
+    Args:
+        machines: machines to add
+
+    Returns:
+        ssh_config contents
+    """
+    lines = []
+    for machine in machines:
+        key = Path(machine.layout.ssh_private_key).expanduser().resolve()
+        lines += [
+            f"Host {host_alias(machine)}",
+            f"    HostName {machine.public_ip}",
+            f"    User {machine.username}",
+            f"    IdentityFile {key}",
+            "    IdentitiesOnly yes",
+            "",
+        ]
+    lines.append("Host *")
+    lines.append(f"    ControlPath {control_dir()}/%C")
+    lines += [f"    {key} {value}" for key, value in SSH_CONFIG_DEFAULTS.items()]
+    user_config = Path("~/.ssh/config").expanduser()
+    if user_config.exists():
+        # Included last, the user's settings apply where ogc sets none, eg.
+        # ProxyJump or ForwardAgent
+        lines.append(f"    Include {user_config}")
+    return "\n".join(lines) + "\n"
+
+
+def write_ssh_config(machines: t.Iterable[MachineModel]) -> Path:
+    """Writes the ssh_config of the fleet, only when it changed
+
+    Args:
+        machines: machines to add
+
+    Returns:
+        Path of the ssh_config
+    """
+    path = ssh_config_path()
+    contents = render_ssh_config(machines)
+    if not path.exists() or path.read_text() != contents:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}")
+        tmp.write_text(contents)
+        tmp.chmod(0o600)
+        tmp.replace(path)
+    return path
+
+
+def openssh_args(machine: MachineModel, config: Path | None = None) -> list[str]:
+    """Arguments for the system `ssh` to connect to a machine
+
+    Args:
+        machine: machine to connect to
+        config: generated ssh_config, see `write_ssh_config`
+    """
+    return ["-F", str(config or ssh_config_path()), host_alias(machine)]
@@ -1,17 +1,58 @@
+from __future__ import annotations
+
+import datetime
+import functools
+import io
+import os
+import threading
 import typing as t
+from collections import defaultdict
 from pathlib import Path
 
+import attrs
 import dill
-import magicattr
+import msgpack
 import structlog
+from cattrs.gen import make_dict_unstructure_fn, override
+from cattrs.preconf.msgpack import make_converter
 from diskcache import Cache
 
+from ogc import filters
 from ogc.models.machine import MachineModel
 
 log = structlog.getLogger()
 
 dill.settings["recurse"] = True
 
+# Machine records are `RECORD_MAGIC` + schema version byte + msgpack payload,
+# anything else is a legacy dill pickle.
+RECORD_MAGIC = b"OGC"
+SCHEMA_VERSION = 2
+
+# Upgrades a decoded payload from the keyed schema version to the next one
+MIGRATIONS: dict[int, t.Callable[[dict], dict]] = {
+    # 2 keeps the boot disk GCE deletes with the node
+    1: lambda payload: {**payload, "boot_disk": None},
+}
+
+converter = make_converter()
+converter.register_unstructure_hook(datetime.datetime, lambda v: v.isoformat())
+converter.register_structure_hook(
+    datetime.datetime, lambda v, _: datetime.datetime.fromisoformat(v)
+)
+converter.register_unstructure_hook(
+    MachineModel,
+    make_dict_unstructure_fn(MachineModel, converter, _node=override(omit=True)),
+)
+
+# Secondary indexes kept alongside the machine records, these are looked up
+# directly without having to decode any of the stored machines.
+INDEXES = ("instance_id", "name", "layout.name", "provider", "state", "tag", "label")
+
+_INDEX_BUILT_KEY = ("idx", "__built__")
+# Bumped whenever the summary or index layout changes, forcing a reindex
+_INDEX_VERSION = 2
+
 
 def model_as_pickle(obj: object) -> bytes:
     """Converts model object to bytes"""
@@ -24,36 +65,359 @@ def pickle_to_model(obj: bytes) -> t.Any:
     return dill.loads(obj)
 
 
+class _LegacyMachine:
+    """Stand-in for machines pickled before records were versioned"""
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+
+
+class _LegacyUnpickler(dill.Unpickler):
+    def find_class(self, module: str, name: str) -> t.Any:
+        if (module, name) == ("ogc.models.machine", "MachineModel"):
+            return _LegacyMachine
+        return super().find_class(module, name)
+
+
+def is_legacy_record(data: bytes) -> bool:
+    """Whether the record was written with dill rather than `machine_as_bytes`"""
+    return not data.startswith(RECORD_MAGIC)
+
+
+def machine_as_bytes(machine: MachineModel) -> bytes:
+    """Converts machine to its compact, versioned encoding"""
+    payload: bytes = msgpack.packb(converter.unstructure(machine))
+    return RECORD_MAGIC + bytes([SCHEMA_VERSION]) + payload
+
+
+def bytes_to_machine(data: bytes) -> MachineModel:
+    """Converts machine record back into a machine
+
+    Records from older schema versions are upgraded on the fly, legacy dill
+    pickles are rebuilt from the attributes they held.
+    """
+    if is_legacy_record(data):
+        legacy = vars(_LegacyUnpickler(io.BytesIO(data)).load())
+        if "node" in legacy:
+            legacy["_node"] = legacy.pop("node")
+        return MachineModel(
+            **{
+                attr.alias: legacy[attr.name]
+                for attr in attrs.fields(MachineModel)
+                if attr.name in legacy
+            }
+        )
+    version = data[len(RECORD_MAGIC)]
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"Machine record schema {version} is newer than this ogc")
+    payload = msgpack.unpackb(data[len(RECORD_MAGIC) + 1 :])
+    for _version in range(version, SCHEMA_VERSION):
+        payload = MIGRATIONS[_version](payload)
+    return converter.structure(payload, MachineModel)
+
+
+_caches: dict[tuple[int, Path], Cache] = {}
+_stores: dict[tuple[int, Path], MachineStore] = {}
+_lock = threading.RLock()
+
+
+def _shared_cache(name: str) -> Cache:
+    """Opens the named cache once per process and directory
+
+    diskcache keeps a connection per thread (greenlet when patched) on the
+    handle, so the same handle is safe to share across greenlets and threads.
+    """
+    key = (os.getpid(), Path(__file__).cwd() / ".ogc-cache" / name)
+    with _lock:
+        if key not in _caches:
+            _caches[key] = Cache(directory=key[1], size=2**30)
+        return _caches[key]
+
+
 def cache_path() -> Cache:
     """Returns where to store files"""
-    p = Path(__file__).cwd() / ".ogc-cache/nodes"
-    return Cache(directory=p, size=2**30)
+    return _shared_cache("nodes")
 
 
 def registry_path() -> Cache:
     """Returns where to store service registry"""
-    p = Path(__file__).cwd() / ".ogc-cache/registry"
-    return Cache(directory=p, size=2**30)
+    return _shared_cache("registry")
+
+
+def checkpoints_path() -> Cache:
+    """Returns where to store exec-scripts step records"""
+    return _shared_cache("checkpoints")
+
+
+def transfers_path() -> Cache:
+    """Returns where to store the chunks of interrupted file transfers"""
+    return _shared_cache("transfers")
+
+
+def catalog_path() -> Cache:
+    """Returns where to store provider catalog lookups"""
+    return _shared_cache("catalog")
+
+
+def machine_summary(machine: MachineModel) -> dict[str, t.Any]:
+    """Small, indexable description of a machine
+
+    Args:
+        machine: machine to summarize
+
+    Returns:
+        Mapping of the indexed attributes of the machine
+    """
+    return {
+        "instance_id": str(machine.instance_id),
+        "name": machine.name,
+        "instance_name": machine.instance_name,
+        "layout.name": machine.layout.name,
+        "provider": machine.layout.provider,
+        "state": machine.instance_state,
+        "tag": list(machine.layout.tags or []),
+        "label": [f"{k}={v}" for k, v in (machine.layout.labels or {}).items()],
+        "created": machine.created.isoformat(),
+    }
+
+
+def _index_keys(summary: dict[str, t.Any]) -> t.Iterator[tuple[str, str, str]]:
+    for index in INDEXES:
+        values = summary[index]
+        for value in values if isinstance(values, list) else [values]:
+            yield ("idx", index, value)
+
+
+class Batch:
+    """Pending machine writes of a `MachineStore`
 
+    Writes are only buffered while the batch is open, so it can be shared by
+    greenlets doing slow provider work. Everything is committed in one
+    transaction when the batch exits, every touched index entry is rewritten
+    once regardless of how many machines changed.
+    """
 
-def query(**kwargs: str) -> list[MachineModel] | None:
-    """list machines"""
+    def __init__(self, store: MachineStore):
+        self.store = store
+        self.puts: dict[str, tuple[bytes, dict[str, t.Any]]] = {}
+        self.deletes: set[str] = set()
+
+    def put(self, machine: MachineModel) -> None:
+        summary = machine_summary(machine)
+        self.deletes.discard(summary["instance_id"])
+        self.puts[summary["instance_id"]] = (machine_as_bytes(machine), summary)
+
+    def delete(self, instance_id: str) -> None:
+        self.puts.pop(str(instance_id), None)
+        self.deletes.add(str(instance_id))
+
+    def commit(self) -> None:
+        """Applies the pending writes in a single transaction"""
+        if not self.puts and not self.deletes:
+            return
+        cache = self.store.cache
+        added: dict[tuple, set[str]] = defaultdict(set)
+        removed: dict[tuple, set[str]] = defaultdict(set)
+        with cache.transact():
+            for _id in self.deletes | self.puts.keys():
+                previous = cache.get(("meta", _id))
+                if previous:
+                    for key in _index_keys(previous):
+                        removed[key].add(_id)
+            for _id in self.deletes:
+                cache.delete(("meta", _id))
+                cache.delete(_id)
+            for _id, (data, summary) in self.puts.items():
+                cache[_id] = data
+                cache[("meta", _id)] = summary
+                for key in _index_keys(summary):
+                    added[key].add(_id)
+            for key in added.keys() | removed.keys():
+                ids = (cache.get(key, set()) - removed[key]) | added[key]
+                if ids:
+                    cache[key] = ids
+                else:
+                    cache.delete(key)
+        self.puts.clear()
+        self.deletes.clear()
+
+    def __enter__(self) -> Batch:
+        return self
+
+    def __exit__(self, exc_type: t.Any, exc: t.Any, tb: t.Any) -> None:
+        self.commit()
+
+
+class MachineStore:
+    """Machine records with secondary indexes
+
+    Machines are stored by their `instance_id`, for each indexed attribute an
+    entry of `("idx", <index>, <value>)` maps to the set of instance ids having
+    that value. A `("meta", <instance_id>)` entry holds the summary that was
+    indexed so that it can be unindexed without decoding the record.
+
+    Args:
+        cache: diskcache to persist machines in
+    """
+
+    def __init__(self, cache: Cache):
+        self.cache = cache
+        if self.cache.get(_INDEX_BUILT_KEY) != _INDEX_VERSION:
+            self.reindex()
+
+    def batch(self) -> Batch:
+        """Buffers writes and deletes, applied in a single transaction
+
+        Example:
+            ``` python
+            with db.store().batch() as batch:
+                for machine in machines:
+                    batch.put(machine)
+            ```
+        """
+        return Batch(self)
+
+    def put(self, machine: MachineModel) -> None:
+        """Stores machine and updates its index entries"""
+        with self.batch() as batch:
+            batch.put(machine)
+
+    def delete(self, instance_id: str) -> bool:
+        """Removes machine and its index entries"""
+        exists = str(instance_id) in self.cache
+        with self.batch() as batch:
+            batch.delete(instance_id)
+        return exists
+
+    def get(self, instance_id: str) -> MachineModel | None:
+        """Decodes a single machine"""
+        data = self.cache.get(str(instance_id))
+        if data is None:
+            return None
+        return bytes_to_machine(data)
+
+    def iter_ids(self) -> t.Iterator[str]:
+        """Lazily yields all stored instance ids"""
+        return (key for key in self.cache.iterkeys() if isinstance(key, str))
+
+    def ids(self) -> list[str]:
+        """All stored instance ids"""
+        return list(self.iter_ids())
+
+    def lookup(self, index: str, value: str) -> set[str]:
+        """Instance ids having `value` in `index`"""
+        return set(self.cache.get(("idx", index, value), set()))
+
+    def reindex(self) -> None:
+        """Rebuilds all index entries from the stored machines"""
+        with self.cache.transact():
+            for key in list(self.cache.iterkeys()):
+                if isinstance(key, tuple):
+                    self.cache.delete(key)
+            index: dict[tuple, set[str]] = defaultdict(set)
+            for _id in self.ids():
+                machine = self.get(_id)
+                if not machine:
+                    continue
+                summary = machine_summary(machine)
+                self.cache[("meta", _id)] = summary
+                for key in _index_keys(summary):
+                    index[key].add(_id)
+            for key, ids in index.items():
+                self.cache[key] = ids
+            self.cache[_INDEX_BUILT_KEY] = _INDEX_VERSION
+
+    def iter(self, _filter: filters.Filter | None = None) -> t.Iterator[MachineModel]:
+        """Lazily yields the machines matching the filter
+
+        Candidates are narrowed down with the secondary indexes and the filter
+        is evaluated against their summaries, machine records are only decoded
+        for matches or when the filter needs an attribute that isn't indexed.
+        """
+        candidates = _filter.candidates(self.lookup) if _filter else None
+        ids = self.iter_ids() if candidates is None else iter(sorted(candidates))
+        for _id in ids:
+            summary = self.cache.get(("meta", _id))
+            if summary is None:
+                continue
+            record = filters.Record(summary, functools.partial(self.get, _id))
+            if _filter and not _filter.matches(record):
+                continue
+            if record.machine:
+                yield record.machine
+
+    def query(self, _filter: filters.Filter | None = None) -> list[MachineModel]:
+        """Machines matching the filter"""
+        return list(self.iter(_filter))
+
+    def migrate(self) -> int:
+        """Rewrites legacy and older schema records in the current encoding
+
+        Returns:
+            Number of records converted
+        """
+        converted = 0
+        with self.batch() as batch:
+            for _id in self.ids():
+                data = self.cache.get(_id)
+                if data is None:
+                    continue
+                if (
+                    not is_legacy_record(data)
+                    and data[len(RECORD_MAGIC)] == SCHEMA_VERSION
+                ):
+                    continue
+                batch.put(bytes_to_machine(data))
+                converted += 1
+        return converted
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.iter_ids())
+
+
+def store() -> MachineStore:
+    """Returns the process wide indexed machine store"""
     cache = cache_path()
-    _machines = [pickle_to_model(cache.get(machine)) for machine in cache.iterkeys()]
+    key = (os.getpid(), Path(cache.directory))
+    with _lock:
+        if key not in _stores:
+            _stores[key] = MachineStore(cache)
+        return _stores[key]
 
-    log.debug(kwargs)
-    if not kwargs:
-        return _machines
 
-    _filtered_machines = []
-
-    for _machine in _machines:
-        for k, v in kwargs.items():
-            try:
-                if magicattr.get(_machine, str(k)) == v:
-                    _filtered_machines.append(_machine)
-            except AttributeError as exc:
-                log.error(f"Missing attribute: {exc}", k=k, v=v, machine=_machine)
-    if _filtered_machines:
-        return _filtered_machines
+def iter_machines(
+    query: filters.Filter | str | None = None, **kwargs: str
+) -> t.Iterator[MachineModel]:
+    """Lazily yields machines
+
+    Machines are decoded one at a time as they are consumed so work can start
+    on the first match and memory does not grow with the size of the fleet.
+
+    Args:
+        query: filter query or compiled filter, see `ogc.filters`
+        kwargs: attribute equality filters, ANDed with the query
+
+    Returns:
+        Iterator of matching machines
+    """
+    _filter = filters.combine(query, filters.from_kwargs(**kwargs))
+    log.debug("Querying machines", query=_filter)
+    return store().iter(_filter)
+
+
+def query(
+    query: filters.Filter | str | None = None, **kwargs: str
+) -> list[MachineModel] | None:
+    """list machines
+
+    Args:
+        query: filter query or compiled filter, see `ogc.filters`
+        kwargs: attribute equality filters, ANDed with the query
+
+    Returns:
+        Matching machines or None
+    """
+    _machines = list(iter_machines(query, **kwargs))
+    if _machines:
+        return _machines
     return None
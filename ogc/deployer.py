@@ -4,47 +4,59 @@
 
 from __future__ import annotations
 
+import functools
 import json
 import os
+import shlex
 import sys
-import tempfile
+import time
 import typing as t
-from multiprocessing import cpu_count
 from pathlib import Path
 
 import arrow
+import paramiko
 import rich.console
 import sh
 import structlog
 import yaml
-from attrs import asdict, fields, filters
-from gevent.pool import Pool
-from libcloud.compute.deployment import (Deployment, FileDeployment,
-                                         MultiStepDeployment, ScriptDeployment)
-from jinja2 import Environment, FileSystemLoader
-
+from attrs import asdict, evolve, fields, filters
+from jinja2 import (Environment, FileSystemBytecodeCache, FileSystemLoader,
+                    Template)
+from libcloud.compute.ssh import SSHCommandTimeoutError
 from pampy import _
 from pampy import match as pmatch
 from rich.table import Table
 
+import ogc.filters
+import ogc.fs
+import ogc.plan
 import ogc.service
-from ogc import db
+from ogc import bundle, catalog, checkpoints, connections, db, output, timeouts
+from ogc.exceptions import PlanException
+from ogc.executor import get_executor
+from ogc.fleet import FleetView
 from ogc.models.actions import ActionModel
 from ogc.models.layout import LayoutModel
 from ogc.models.machine import MachineModel
 from ogc.provision import BaseProvisioner
+from ogc.results import ResultSet
+from ogc.rollout import Rollout
+from ogc.scheduler import Priority
+
+# Compiled templates are kept under .ogc-cache/jinja across runs, set to 0 to
+# only keep them in memory
+TEMPLATE_BYTECODE_CACHE = os.environ.get("OGC_TEMPLATE_BYTECODE_CACHE", "1") != "0"
 
-# Not advertised, but available for those who seek moar power.
-# If more than 10 cpus, limit to 9. The CI provides a lot more
-# cpu's than needed
-_cpu_count = cpu_count()
-if _cpu_count >= 10:
-    _cpu_count = 9
-MAX_WORKERS = int(os.environ.get("OGC_MAX_WORKERS", _cpu_count))
+# Commands run over pooled paramiko connections, set to `openssh` to fork the
+# ssh client per command instead.
+SSH_BACKEND = os.environ.get("OGC_SSH_BACKEND", "paramiko")
+
+# Seconds the teardown script of a node may take, connecting included, so
+# unreachable nodes don't hold up `down`
+TEARDOWN_TIMEOUT = float(os.environ.get("OGC_TEARDOWN_TIMEOUT", 60))
 
 
 log = structlog.getLogger()
-pool = Pool(MAX_WORKERS)
 
 
 class Ctx(t.TypedDict):
@@ -55,6 +67,38 @@ class Ctx(t.TypedDict):
     nodes: t.Required[t.Any]
 
 
+@functools.lru_cache(maxsize=None)
+def _environment(search_path: str) -> Environment:
+    bytecode_cache = None
+    if TEMPLATE_BYTECODE_CACHE:
+        cache_dir = ogc.fs.ensure_cache_dir() / "jinja"
+        cache_dir.mkdir(exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(str(cache_dir))
+    return Environment(
+        loader=FileSystemLoader(searchpath=search_path),
+        bytecode_cache=bytecode_cache,
+        # Keep every template, they are only recompiled once changed on disk
+        cache_size=-1,
+        auto_reload=True,
+    )
+
+
+def compile_template(path: Path) -> Template:
+    """Returns a compiled template
+
+    Templates are compiled once per script directory and reused until the
+    file changes.
+
+    Args:
+        path: path to template file
+
+    Returns:
+        Compiled template, rendered with `Template.render(**context)`
+    """
+    path = Path(path).resolve()
+    return _environment(str(path.parent)).get_template(path.name)
+
+
 def render(template: Path, context: Ctx) -> str:
     """Returns the correct deployment based on type of step
 
@@ -65,11 +109,7 @@ def render(template: Path, context: Ctx) -> str:
     Returns:
         Rendered template string
     """
-
-    loader = FileSystemLoader(searchpath=str(template.parent))
-    env = Environment(loader=loader)
-    temp = env.get_template(str(template.parts[-1]))
-    return temp.render(**context)
+    return compile_template(template).render(**context)
 
 
 class MachineOpts(t.TypedDict):
@@ -81,6 +121,7 @@ class MachineOpts(t.TypedDict):
         ```
     """
 
+    query: t.NotRequired[str | ogc.filters.Filter]
     instance_id: t.NotRequired[str]
     instance_name: t.NotRequired[str]
     limit: t.NotRequired[int]
@@ -133,14 +174,14 @@ def filter_layouts(**kwargs: MachineOpts) -> list[LayoutModel]:
     )
 
 
-def ssh(provisioner: BaseProvisioner, **kwargs: MachineOpts) -> None:
+def ssh(provisioner: BaseProvisioner | None = None, **kwargs: MachineOpts) -> None:
     """Opens SSH connection to a machine
 
     Pass in a mapping of options to filter machines, a single machine
     must be queried
 
     Args:
-        provisioner: provisioner
+        provisioner: unused, kept for compatibility
         kwargs: Mapping of options to pass to `ssh`
 
     Example:
@@ -148,92 +189,170 @@ def ssh(provisioner: BaseProvisioner, **kwargs: MachineOpts) -> None:
         > ogc -v ssh -q layout.name=machine-1
         ```
     """
-    nodes = filter_machines(**kwargs)
-    if nodes:
-        machine = nodes[0]
-        if machine:
-            cmd = [
-                "-o",
-                "StrictHostKeyChecking=no",
-                "-o",
-                "UserKnownHostsFile=/dev/null",
-                "-i",
-                Path(machine.layout.ssh_private_key).expanduser(),
-                f"{machine.layout.username}@{machine.node.public_ips[0]}",
-            ]
-
-            sh.ssh(cmd, _fg=True, _env=os.environ.copy())  # type: ignore
-            sys.exit(0)
+    machine = next(db.iter_machines(**kwargs), None)
+    if machine:
+        config = connections.write_ssh_config(db.iter_machines())
+        cmd = connections.openssh_args(machine, config)
+        sh.ssh(cmd, _fg=True, _env=os.environ.copy())  # type: ignore
+        sys.exit(0)
     log.error("Could not find machine to ssh to")
     sys.exit(1)
 
 
-def up(layouts: list[LayoutModel]) -> bool:
+def up(layouts: list[LayoutModel], rollout: Rollout | None = None) -> bool:
     """Bring up machines
 
     Args:
-        provisioner: provisioner
+        layouts: layouts to create machines from
+        rollout: timeouts per layout and overall, see `ogc.rollout.Rollout`
 
     Returns:
         True if successful, False otherwise.
     """
 
-    def _up_async(layout: LayoutModel) -> None:
-        provisioner = BaseProvisioner.from_layout(layout=layout)
+    def _up_async(layout: LayoutModel) -> bool | Exception:
         try:
+            provisioner = BaseProvisioner.from_layout(layout=layout)
             provisioner.setup()
             provisioner.create()
-        except Exception:
+        except Exception as exc:
             log.error("Could not bring up instance", exc_info=True)
+            # Handed back so the scheduler can back off when throttled
+            return exc
+        return True
 
     log.info(
         "Creating machines from layouts",
         layouts=", ".join([f"({l.name})" for l in layouts]),
     )
-    for layout in layouts:
-        pool.spawn(_up_async, layout)
-    pool.join()
-
-    _new_machines = ", ".join(
-        [f"({m.name}:{m.username}@{m.public_ip})" for m in filter_machines()]
+    report = get_executor().run(
+        rollout or Rollout(),
+        layouts,
+        _up_async,
+        "api",
+        Priority.PROVISION,
+        key=lambda layout: layout.provider,
     )
-    log.info(f"Machines ready", machines=_new_machines)
-    return True
+    for layout in report.timed_out:
+        log.error("Timed out bringing up layout", layout=layout.name)
+
+    for machine in db.iter_machines():
+        log.info(
+            "Machine ready", machine=f"{machine.name}:{machine.username}@{machine.public_ip}"
+        )
+    return not report.failed
 
 
-def down(provisioner: BaseProvisioner, **kwargs: MachineOpts) -> bool:
+def down(
+    provisioner: BaseProvisioner | None = None,
+    rollout: Rollout | None = None,
+    **kwargs: MachineOpts,
+) -> bool:
     """Tear down machines
 
-    Pass in a **optional** mapping of options to filter machines
+    Pass in a **optional** mapping of options to filter machines. The
+    `teardown` script of every machine runs first, concurrently. Machines are
+    then grouped by provider, region and layout: each group is destroyed with
+    a single call over one provider connection per region, its state removed
+    in one write, and the firewall and key pair of a layout are removed once
+    none of its machines are left.
 
     Args:
-        provisioner: Provisioner
+        provisioner: unused, kept for compatibility
+        rollout: timeouts of the teardown scripts and of each group
         kwargs: Mapping of options to pass to `down`
 
     Example:
         ``` bash
         # All  machines
-        > ogc ubuntu.py down -v
+        > ogc down
         # Single machine
-        > ogc ubuntu.py down -v -o instance_id=5407368969918077947
+        > ogc down -q instance_id=5407368969918077947
         ```
     Returns:
         True if successful, False otherwise.
     """
-    nodes = filter_machines(**kwargs)
-    kwargs.update({"cmd": "./teardown"})
-    if not exec(provisioner, **kwargs):
-        log.debug("Could not run teardown script")
-    provisioner.destroy(nodes=nodes)
-    return True
+    groups: dict[tuple[str, ...], list[MachineModel]] = {}
+    provisioners: dict[tuple[str, ...], BaseProvisioner] = {}
+    for machine in db.iter_machines(**kwargs):
+        _prov = BaseProvisioner.from_layout(machine.layout, connect=False)
+        key = (*_prov.scope, machine.layout.name)
+        groups.setdefault(key, []).append(machine)
+        provisioners.setdefault(key, _prov)
+    if not groups:
+        log.info("No machines to tear down")
+        return True
 
+    # Scripts without a teardown file just succeed
+    rollout = rollout or Rollout()
+    limits = [x for x in (rollout.node_timeout, TEARDOWN_TIMEOUT) if x is not None]
+    teardown = evolve(rollout, node_timeout=min(limits))
+    if not exec("test ! -x ./teardown || ./teardown", rollout=teardown, **kwargs):
+        log.warning("Teardown script failed on some machines, destroying anyway")
+
+    drivers: dict[tuple[str, ...], t.Any] = {}
+    for _prov in provisioners.values():
+        if _prov.scope not in drivers:
+            drivers[_prov.scope] = _prov.observed(_prov.connect())
+        _prov.provisioner = drivers[_prov.scope]
+
+    store = db.store()
+    batch = store.batch()
+
+    def _down_group(key: tuple[str, ...]) -> bool:
+        machines = groups[key]
+        _prov = provisioners[key]
+        ids = [str(machine.instance_id) for machine in machines]
+        log.info(
+            f"Tearing down {len(machines)} machine(s)",
+            layout=_prov.layout.name,
+            scope=":".join(_prov.scope),
+        )
+        # Stored machines have no driver, driver calls need one
+        nodes = [catalog.bind(machine.node, _prov.provisioner) for machine in machines]
+        try:
+            destroyed = _prov.destroy(nodes)
+        except Exception:
+            log.error("Destroy failed, checking what is gone", exc_info=True)
+            try:
+                destroyed = _prov.gone(nodes)
+            except Exception:
+                log.error("Could not list nodes", exc_info=True)
+                destroyed = [False] * len(nodes)
+        gone = [machine for machine, ok in zip(machines, destroyed) if ok]
+        for machine in gone:
+            connections.get_pool().discard(machine)
+            batch.delete(machine.instance_id)
+        checkpoints.forget(*[str(machine.instance_id) for machine in gone])
+        if len(gone) < len(machines):
+            log.error(
+                f"Could not destroy {len(machines) - len(gone)} machine(s)",
+                layout=_prov.layout.name,
+            )
+            return False
+        if not store.lookup("layout.name", _prov.layout.name) - set(ids):
+            _prov.cleanup()
+        return True
+
+    with batch:
+        report = get_executor().run(
+            rollout,
+            list(groups),
+            _down_group,
+            "api",
+            Priority.TEARDOWN,
+            key=lambda key: key[0],
+        )
+    for key in report.timed_out:
+        log.error("Timed out tearing down layout", layout=key[-1])
+    return not report.failed and not report.timed_out
 
-def ls(
-    output_format: str = "table", **kwargs: MachineOpts
-) -> list[MachineModel] | None:
-    """Return a list of machines for deployment
 
-    Pass in a mapping of options to filter machines
+def ls(output_format: str = "table", **kwargs: MachineOpts) -> int:
+    """List machines of the deployment
+
+    Pass in a mapping of options to filter machines, machines are streamed
+    from the database so only the table output keeps its rows in memory.
 
     Args:
         kwargs: Mapping of options to pass to `ls`
@@ -242,56 +361,75 @@ def ls(
 
         |Key|Value|
         |---|-----|
-        | output_format | table, yaml, json, suppress_output
+        | output_format | table, yaml, json, list, suppress_output
 
 
     Returns:
-        List of deployed machines
+        Number of machines listed
     """
 
     con = rich.console.Console(log_time=True)
 
-    def ui_nodes_yaml(nodes: list[MachineModel]) -> None:
-        con.out(
-            yaml.safe_dump(
-                [
-                    asdict(node, filter=filters.exclude(fields(MachineModel).node, int))
-                    for node in nodes
-                ]
-            )
-        )
-
-    def ui_nodes_json(nodes: list[MachineModel]) -> None:
-        con.out(
-            json.dumps(
-                [
-                    asdict(node, filter=filters.exclude(fields(MachineModel).node, int))
-                    for node in nodes
-                ],
-                skipkeys=True,
-                default=str,
-                indent=2,
-            )
-        )
+    def as_dict(node: MachineModel) -> dict:
+        return asdict(node, filter=filters.exclude(fields(MachineModel)._node, int))
 
-    def ui_nodes_list(nodes: list[MachineModel]) -> None:
+    def ui_nodes_yaml(nodes: t.Iterator[MachineModel]) -> int:
+        count = 0
+        for node in nodes:
+            con.out(yaml.safe_dump([as_dict(node)]), end="")
+            count += 1
+        return count
+
+    def ui_nodes_json(nodes: t.Iterator[MachineModel]) -> int:
+        count = 0
+        previous = None
+        con.out("[")
+        for node in nodes:
+            if previous:
+                con.out(f"{previous},")
+            previous = json.dumps(as_dict(node), skipkeys=True, default=str, indent=2)
+            count += 1
+        if previous:
+            con.out(previous)
+        con.out("]")
+        return count
+
+    def ui_nodes_list(nodes: t.Iterator[MachineModel]) -> int:
+        count = 0
         services_list = db.registry_path()
         for node in nodes:
             _services = ""
-            if node.name in services_list.iterkeys():
+            if services := services_list.get(node.name):
                 _services = ", ".join(
-                    [srvc for srvc in db.pickle_to_model(services_list[node.name])]
+                    [srvc for srvc in db.pickle_to_model(services)]
                 )
             con.out(
                 f"{node.name}: {node.username}@{node.public_ip} | services: ({_services if _services else 'add some'})"
             )
+            count += 1
+        return count
 
     def ui_nodes_table(
-        nodes: list[MachineModel], output_file: str | None = None
-    ) -> None:
+        nodes: t.Iterator[MachineModel], output_file: str | None = None
+    ) -> int:
         con.record = True
-        rows = nodes
+        rows = [
+            (
+                data.instance_id,
+                data.instance_name,
+                arrow.get(data.created).humanize(),
+                data.instance_state,
+                ",".join(
+                    [f"[purple]{k}[/]={v}" for k, v in data.layout.labels.items()]
+                ),
+                ",".join([f"[purple]{tag}[/]" for tag in data.layout.tags]),
+                f"ssh -i {Path(data.layout.ssh_private_key).expanduser()} {data.layout.username}@{data.public_ip}",
+            )
+            for data in nodes
+        ]
         rows_count = len(rows)
+        if not rows_count:
+            return 0
 
         table = Table(
             caption=f"Node Count: [green]{rows_count}[/]",
@@ -309,18 +447,8 @@ def ls(
         table.add_column("Tags")
         table.add_column("Connection", style="bold red on black")
 
-        for data in rows:
-            table.add_row(
-                data.node.id,
-                data.node.name,
-                arrow.get(data.created).humanize(),
-                data.node.state,
-                ",".join(
-                    [f"[purple]{k}[/]={v}" for k, v in data.layout.labels.items()]
-                ),
-                ",".join([f"[purple]{tag}[/]" for tag in data.layout.tags]),
-                f"ssh -i {Path(data.layout.ssh_private_key).expanduser()} {data.layout.username}@{data.node.public_ips[0]}",
-            )
+        for row in rows:
+            table.add_row(*row)
 
         con.print(table, justify="center")
         if output_file:
@@ -333,20 +461,19 @@ def ls(
                     f"Unknown extension for {output_file}, must end in '.svg' or '.html'"
                 )
         con.record = False
+        return rows_count
 
-    nodes = filter_machines(**kwargs)
-    if nodes:
-        if output_format == "yaml":
-            ui_nodes_yaml(nodes=nodes)
-        elif output_format == "json":
-            ui_nodes_json(nodes=nodes)
-        elif output_format == "list":
-            ui_nodes_list(nodes=nodes)
-        elif output_format == "suppress_output":
-            ui_nodes_table(nodes=nodes, output_file=kwargs.get("output_file", None))
-        else:
-            ui_nodes_table(nodes=nodes)
-    return nodes if nodes else None
+    output_file = kwargs.pop("output_file", None)
+    nodes = db.iter_machines(**kwargs)
+    if output_format == "yaml":
+        return ui_nodes_yaml(nodes=nodes)
+    if output_format == "json":
+        return ui_nodes_json(nodes=nodes)
+    if output_format == "list":
+        return ui_nodes_list(nodes=nodes)
+    if output_format == "suppress_output":
+        return ui_nodes_table(nodes=nodes, output_file=output_file)
+    return ui_nodes_table(nodes=nodes)
 
 
 def ls_layouts(
@@ -426,98 +553,160 @@ def ls_layouts(
     return layouts if layouts else None
 
 
-def exec(cmd: str, **kwargs: MachineOpts) -> bool:
+def exec(
+    cmd: str,
+    stream: bool = False,
+    tail_lines: int = output.TAIL_LINES,
+    spool_dir: Path | None = None,
+    rollout: Rollout | None = None,
+    **kwargs: MachineOpts,
+) -> ResultSet:
     """Execute commands on node(s)
 
+    Output is consumed as it arrives, only the last `tail_lines` lines of each
+    node are kept for its `ActionModel`. Nodes are grouped by the hash of
+    their output in the returned result set.
+
     Args:
-        machines: list of machines to execute on
+        cmd: command to execute on remote machines
+        stream: print output prefixed with the node name as it arrives
+        tail_lines: number of trailing output lines to keep per node
+        spool_dir: directory to write the full output of each node to
+        rollout: batches, canary and failure budget, all nodes at once if unset
         kwargs: Options to exec
 
-    Additional Options:
-        |Key|Value|
-        |---|-----|
-        | cmd | command to execute on remote machines |
-
     Example:
         ``` bash
         > ogc -v exec 'ls -l'
+        > ogc exec --stream --spool-dir logs 'journalctl -f -n 100'
+        > ogc exec --canary 1 --batch-percent 10 --max-failures 5 'apt-get upgrade -y'
         ```
 
     Returns:
-        True if succesful, False otherwise.
+        Result set, truthy if the command succeeded on every node.
     """
 
-    def _exec(node: MachineModel, cmd: str) -> bool:
-        _node: MachineModel = node
-        cmd_opts = [
-            "-o",
-            "StrictHostKeyChecking=no",
-            "-o",
-            "UserKnownHostsFile=/dev/null",
-            "-i",
-            str(Path(_node.layout.ssh_private_key).expanduser()),
-            f"{_node.layout.username}@{_node.node.public_ips[0]}",
-        ]
+    results = ResultSet(cmd=cmd)
+    if SSH_BACKEND == "openssh":
+        ssh_env = os.environ.copy()
+        ssh_config = connections.write_ssh_config(db.iter_machines())
+
+    def _run_openssh(node: MachineModel, cmd: str, out: output.NodeOutput) -> int:
+        cmd_opts = connections.openssh_args(node, ssh_config)
         cmd_opts.append(cmd)
-        return_status = None
         try:
-            out = sh.ssh(cmd_opts, _env=os.environ.copy(), _err_to_out=True)
-            return_status = dict(
-                exit_code=0,
-                out=out,
-                error=out,
-                cmd=" ".join(txt for txt in cmd_opts),
+            sh.ssh(
+                cmd_opts,
+                _env=ssh_env,
+                _out=out.feed_out,
+                _err=out.feed_err,
+                _timeout=timeouts.remaining(),
             )
         except sh.ErrorReturnCode as e:
-            return_status = dict(
-                exit_code=e.exit_code,
-                out=e.stdout.decode(),
-                error=e.stderr.decode(),
-                cmd=str(e.full_cmd),
-            )
-        if return_status:
-            return_status.update({"machine": _node.node.name})
-            log.debug(return_status)
+            return int(e.exit_code)
+        except sh.TimeoutException:
+            raise timeouts.NodeTimeout()
+        return 0
 
-            action = ActionModel(
-                machine=_node,
-                exit_code=int(return_status["exit_code"]),
-                out=str(return_status["out"]),
-                err=str(return_status["error"]),
-                cmd=str(return_status["cmd"]),
+    def _run_pooled(node: MachineModel, cmd: str, out: output.NodeOutput) -> int:
+        try:
+            _, _, exit_code = connections.get_pool().run(
+                node, cmd, on_stdout=out.feed_out, on_stderr=out.feed_err
             )
-            if action.exit_code > 0:
-                log.error(
-                    "Action failed",
-                    cmd=action.cmd,
-                    exit_code=action.exit_code,
-                    err=action.err,
-                )
-            else:
-                log.info(
-                    "Action complete",
-                    cmd=action.cmd,
-                    exit_code=action.exit_code,
-                )
-            return bool(return_status["exit_code"] == 0)
-        return False
+        except TimeoutError:
+            raise timeouts.NodeTimeout()
+        except (paramiko.SSHException, OSError) as e:
+            out.feed_err(f"{e}\n")
+            return 255
+        return exit_code
+
+    def _exec(node: MachineModel) -> bool:
+        _node: MachineModel = node
+        with output.NodeOutput(
+            str(_node.instance_name),
+            stream=stream,
+            tail_lines=tail_lines,
+            spool_dir=spool_dir,
+        ) as out:
+            try:
+                if SSH_BACKEND == "openssh":
+                    exit_code = _run_openssh(_node, cmd, out)
+                else:
+                    exit_code = _run_pooled(_node, cmd, out)
+            except timeouts.NodeTimeout:
+                out.feed_err("ogc: timed out\n")
+                exit_code = timeouts.EXIT_CODE
+                results.timed_out.append(str(_node.instance_name))
+
+        action = ActionModel(
+            machine=_node,
+            exit_code=exit_code,
+            out=out.out,
+            err=out.err,
+            cmd=cmd,
+        )
+        action.extra.update(truncated=out.truncated)
+        if spool_dir:
+            action.extra.update(
+                stdout=str(out.spool_path("out")), stderr=str(out.spool_path("err"))
+            )
+        log.debug("Action output", machine=_node.instance_name, **action.extra)
+        results.add(action, out.digest)
+        if action.exit_code > 0:
+            log.error(
+                "Action failed",
+                machine=_node.instance_name,
+                cmd=action.cmd,
+                exit_code=action.exit_code,
+                err=action.err,
+            )
+        else:
+            log.info(
+                "Action complete",
+                machine=_node.instance_name,
+                cmd=action.cmd,
+                exit_code=action.exit_code,
+            )
+        return bool(action.exit_code == 0)
 
     if cmd:
-        machines = filter_machines(**kwargs)
-        log.info(f"Executing '{cmd}' across {len(machines)} node(s)")
-        for node in machines:
-            pool.spawn(_exec, node, cmd)
-        return bool(pool.join())
-    return False
+        log.info(f"Executing '{cmd}'")
+        report = get_executor().run(
+            rollout or Rollout(),
+            db.iter_machines(**kwargs),
+            _exec,
+            "ssh",
+            Priority.EXEC,
+        )
+        results.cancelled = [str(node.instance_name) for node in report.cancelled]
+        results.timed_out += [str(node.instance_name) for node in report.timed_out]
+        log.info(
+            f"Executed '{cmd}' across {results.total} node(s)",
+            failed=len(results.failed),
+            cancelled=len(results.cancelled),
+            timed_out=len(results.timed_out),
+            outputs=len(results.groups),
+        )
+    return results
 
 
-def exec_scripts(script_dir: Path, **kwargs: MachineOpts) -> bool:
+def exec_scripts(
+    script_dir: Path,
+    rollout: Rollout | None = None,
+    resume: bool = False,
+    from_step: str | None = None,
+    **kwargs: MachineOpts,
+) -> bool:
     """Execute scripts
 
-    Executing scripts/templates on a node.
+    Executing scripts/templates on a node. The outcome of every step is
+    recorded per node, see `ogc.checkpoints`.
 
     Args:
-        machines: machines to execute scripts on
+        script_dir: script or directory of scripts to execute
+        rollout: batches, canary and failure budget, all nodes at once if unset
+        resume: only run the steps that failed, changed or never ran on a node
+        from_step: skip the steps before this one
         kwargs: Options to exec_scripts
 
     Additional Options:
@@ -530,85 +719,171 @@ def exec_scripts(script_dir: Path, **kwargs: MachineOpts) -> bool:
         > ogc -v exec_scripts /home/ubuntu/new-deploy-scripts
         ```
     Returns:
-        True if succesful, False otherwise.
+        True if the scripts succeeded on every node, False otherwise.
     """
 
-    def _exec_scripts(node: MachineModel, scripts: str | Path) -> bool:
+    _scripts = Path(script_dir)
+    _plan = None
+    scripts_to_run: list[Path] = []
+    if _scripts.is_dir():
+        # teardown file is a special file that gets executed before node
+        # destroy, hidden files such as .plan.yml aren't scripts
+        scripts_to_run = sorted(
+            fname
+            for fname in _scripts.glob("**/*")
+            if fname.stem != "teardown"
+            and fname.is_file()
+            and not any(
+                part.startswith(".") for part in fname.relative_to(_scripts).parts
+            )
+        )
+    elif _scripts.exists():
+        scripts_to_run = [_scripts.resolve()]
+        _plan = yaml.safe_load((_scripts.parent / ".plan.yml").read_text())
+
+    # Compiled once, only rendered per node
+    templates = [(s.name, compile_template(s)) for s in scripts_to_run]
+    # Shared by every node, machines are decoded as templates use them
+    fleet = FleetView.snapshot()
+    teardown_script = _scripts / "teardown"
+    teardown = compile_template(teardown_script) if teardown_script.exists() else None
+    scope = str(_scripts.resolve())
+    if from_step and from_step not in [name for name, _ in templates]:
+        log.error(f"No step {from_step} in {script_dir}")
+        return False
+    try:
+        steps_plan = ogc.plan.load(
+            ogc.plan.read(_scripts) if _scripts.is_dir() else None,
+            [name for name, _ in templates],
+        )
+    except PlanException as exc:
+        log.error(f"Invalid plan in {script_dir}: {exc}")
+        return False
+
+    machines: t.Iterable[MachineModel] = db.iter_machines(**kwargs)
+    tagged: dict[str, list[str]] = {}
+    if waited_on := ogc.plan.waited_on(steps_plan):
+        # Nodes others wait for go first, so they aren't left waiting for a
+        # free slot behind the nodes waiting on them
+        machines = sorted(
+            machines, key=lambda m: not waited_on & set(m.layout.tags or [])
+        )
+        for machine in machines:
+            for tag in waited_on & set(machine.layout.tags or []):
+                tagged.setdefault(tag, []).append(str(machine.instance_id))
+    progress = ogc.plan.Progress(tagged)
+
+    def _exec_scripts(node: MachineModel) -> bool:
+        try:
+            # Steps run on the checked out client, keep the pool from
+            # evicting it however long they take
+            with connections.get_pool().hold(node):
+                return _exec_node(node)
+        finally:
+            progress.leave(str(node.instance_id))
+
+    def _exec_node(node: MachineModel) -> bool:
         _node: MachineModel = node
-        _scripts = Path(scripts)
         if not _scripts.exists():
             return False
-
-        if not _scripts.is_dir():
-            scripts_to_run = [_scripts.resolve()]
-            _plan = yaml.safe_load((_scripts.parent / ".plan.yml").read_text())
+        if _plan:
             ogc.service.add(_node, _plan["name"])
-        else:
-            # teardown file is a special file that gets executed before node
-            # destroy
-            scripts_to_run = [
-                fname for fname in _scripts.glob("**/*") if fname.stem != "teardown"
-            ]
 
         context = Ctx(
             env=os.environ.copy(),
             node=_node,
-            nodes=[node for node in MachineModel.query()],
+            nodes=fleet,
         )
-        steps: list[Deployment] = [
-            ScriptDeployment(script=render(s, context), name=s.name)
-            for s in scripts_to_run
-            if s.is_file()
-        ]
+        _bundle = bundle.Bundle()
+        steps = []
+        for name, _template in templates:
+            script = _template.render(**context)
+            _bundle.add(name, script)
+            steps.append((name, checkpoints.digest(script)))
+        # teardown is uploaded with the scripts but only run before destroy
+        if teardown:
+            _bundle.add("teardown", teardown.render(**context))
+        if _plan:
+            _bundle.add_dir(
+                _scripts.parent, f"{bundle.REMOTE_DIR}/services/{_plan['name']}"
+            )
+        if not _bundle.files:
+            return True
 
-        # Add teardown script as just a filedeployment
-        teardown_script = _scripts / "teardown"
-        if teardown_script.exists():
-            with tempfile.NamedTemporaryFile(delete=False) as fp:
-                temp_contents = render(teardown_script, context)
-                fp.write(temp_contents.encode())
-                steps.append(FileDeployment(fp.name, "teardown"))
-                steps.append(ScriptDeployment("chmod +x teardown"))
-
-        if steps:
-            msd = MultiStepDeployment(steps)
-            ssh_client = _node.ssh()
-            if ssh_client:
-                node_state = _node.node
-                if node_state:
-                    msd.run(node_state, ssh_client)
-            for step in msd.steps:
-                match step:
-                    case FileDeployment():
-                        log.debug(
-                            f"(machine) {_node.node.name} "
-                            f"(source) {step.source if hasattr(step, 'source') else ''} "
-                            f"(target) {step.target if hasattr(step, 'target') else ''} "
-                        )
-                    case ScriptDeployment():
-                        log.debug(
-                            f"(machine) {_node.node.name} "
-                            f"(exit) {step.exit_status if hasattr(step, 'exit_status') else 0} "
-                            f"(out) {step.stdout if hasattr(step, 'stdout') else ''} "
-                            f"(stderr) {step.stderr if hasattr(step, 'stderr') else ''}"
-                        )
-                        action = ActionModel(
-                            machine=_node,
-                            exit_code=step.exit_status
-                            if hasattr(step, "exit_status")
-                            else 0,
-                            out=step.stdout if hasattr(step, "stdout") else "",
-                            err=step.stderr if hasattr(step, "stderr") else "",
-                            cmd=f"{step.script} {step.args}",
-                        )
-                        log.debug(action)
-                    case _:
-                        log.debug(step)
-        return True
+        ssh_client = _node.ssh()
+        if ssh_client is None:
+            return False
+        bundle.upload(
+            connections.PooledClient(_node), _bundle, name=_node.instance_name
+        )
 
-    machines = filter_machines(**kwargs)
-    log.info(f"Executing scripts across {len(machines)} node(s)")
-    for node in machines:
-        pool.spawn(_exec_scripts, node, script_dir)
-    pool.join()
-    return True
+        done = checkpoints.records(_node.instance_id, scope) if resume else {}
+        todo = set(checkpoints.pending(steps, done, resume, from_step))
+        digests = dict(steps)
+        timed_out: list[str] = []
+
+        def _run_step(name: str) -> bool:
+            if name not in todo:
+                log.debug(f"(machine) {_node.instance_name} (skipped) {name}")
+                return True
+            started = time.monotonic()
+            try:
+                stdout, stderr, exit_code = ssh_client.run(
+                    f"./{shlex.quote(name)}", timeout=timeouts.remaining()
+                )
+            except SSHCommandTimeoutError as e:
+                # Same outcome as a node interrupted at its deadline
+                stdout, stderr = e.stdout or "", e.stderr or ""
+                exit_code = timeouts.EXIT_CODE
+                timed_out.append(name)
+            checkpoints.record(
+                _node.instance_id,
+                scope,
+                name,
+                digests[name],
+                exit_code,
+                time.monotonic() - started,
+            )
+            log.debug(
+                f"(machine) {_node.instance_name} "
+                f"(exit) {exit_code} "
+                f"(out) {stdout} "
+                f"(stderr) {stderr}"
+            )
+            action = ActionModel(
+                machine=_node,
+                exit_code=exit_code,
+                out=stdout,
+                err=stderr,
+                cmd=name,
+            )
+            log.debug(action)
+            return action.exit_code == 0
+
+        ok = ogc.plan.run_node(
+            str(_node.instance_id),
+            steps_plan,
+            _run_step,
+            progress,
+            timeout=timeouts.remaining,
+        )
+        if timed_out:
+            log.error(f"(machine) {_node.instance_name} (timed out) {timed_out}")
+            raise timeouts.NodeTimeout()
+        return ok
+
+    log.info(f"Executing scripts from {script_dir}")
+    report = get_executor().run(
+        rollout or Rollout(),
+        machines,
+        _exec_scripts,
+        "ssh",
+        Priority.EXEC,
+    )
+    log.info(
+        f"Executed scripts across {report.succeeded + report.failed} node(s)",
+        failed=report.failed,
+        timed_out=len(report.timed_out),
+        cancelled=len(report.cancelled),
+    )
+    return not report.failed and not report.cancelled
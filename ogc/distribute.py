@@ -0,0 +1,290 @@
+"""Tree fan-out of large files to the fleet
+
+Pushing a file to every node from one machine is bound by its uplink. Instead
+the file is uploaded to a few seed nodes only, every node holding a verified
+copy then serves it over its private IP to up to `fanout` nodes per round, so
+the number of holders multiplies every round.
+
+Nodes don't have credentials for each other, a holder serves the file with a
+short lived HTTP server (python3) on a random port of its private IP and the
+other nodes fetch it with curl or wget. The file is only served under a random
+path, so other hosts of the network can't guess its URL, and a holder is
+stopped as soon as no node is left for it to serve. Every copy is checked
+against the sha256 of the local file, nodes whose fetch fails get the file
+uploaded directly instead.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import shlex
+import time
+import typing as t
+import uuid
+from pathlib import Path
+
+import structlog
+from attrs import define, evolve, field
+
+from ogc import connections
+from ogc.executor import get_executor
+from ogc.rollout import Rollout
+from ogc.scheduler import Priority
+
+if t.TYPE_CHECKING:
+    from ogc.models.machine import MachineModel
+
+log = structlog.getLogger()
+
+# Nodes a holder serves per round
+FANOUT = int(os.environ.get("OGC_DISTRIBUTE_FANOUT", 4))
+
+# Nodes the file is uploaded to directly
+SEEDS = int(os.environ.get("OGC_DISTRIBUTE_SEEDS", 2))
+
+# Seconds a holder serves the file at most, in case ogc goes away
+SERVE_TTL = int(os.environ.get("OGC_DISTRIBUTE_TTL", 600))
+
+# The server makes up the token of its path and writes it with its port to a
+# file only the user can read, the token never shows in a command line
+_SERVER = """
+import functools, hmac, http.server, secrets, sys, threading
+directory, host, ttl = sys.argv[1], sys.argv[2], float(sys.argv[3])
+token = secrets.token_urlsafe(24)
+path = "/" + token
+class Handler(http.server.SimpleHTTPRequestHandler):
+    def send_head(self):
+        if not hmac.compare_digest(self.path.encode(), path.encode()):
+            self.send_error(404)
+            return None
+        self.path = "/file"
+        return super().send_head()
+    def log_message(self, *args):
+        pass
+server = http.server.ThreadingHTTPServer(
+    (host, 0), functools.partial(Handler, directory=directory)
+)
+print(server.server_address[1], token, flush=True)
+threading.Timer(ttl, server.shutdown).start()
+server.serve_forever()
+"""
+
+
+class NodeClient(t.Protocol):
+    """Runs commands on and uploads files to a node"""
+
+    name: str
+    address: str
+
+    def run(
+        self, cmd: str, stdin: t.Iterable[bytes] | None = None
+    ) -> tuple[str, str, int]:
+        ...
+
+    def upload(self, src: Path, dest: str) -> None:
+        ...
+
+
+@define
+class DistributeReport:
+    """Outcome of a distribution
+
+    Attributes:
+        checksum: sha256 of the file
+        uploaded: nodes the file was uploaded to directly
+        relayed: nodes that fetched the file, with the node they fetched from
+        failed: nodes that didn't get a verified copy
+        rounds: number of relay rounds
+        elapsed: seconds until every node had the file
+    """
+
+    checksum: str
+    uploaded: list[str] = field(factory=list)
+    relayed: dict[str, str] = field(factory=dict)
+    failed: list[str] = field(factory=list)
+    rounds: int = 0
+    elapsed: float = 0.0
+
+
+def sha256(path: Path) -> str:
+    """sha256 of a local file"""
+    digest = hashlib.sha256()
+    with path.open("rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _checksum(client: NodeClient, dest: str) -> str | None:
+    out, _, exit_code = client.run(f"sha256sum {shlex.quote(dest)}")
+    return out.split()[0] if exit_code == 0 and out else None
+
+
+class _Holder:
+    """Node serving its copy of the file"""
+
+    def __init__(self, client: NodeClient, dest: str):
+        self.client = client
+        self.dir = f"/tmp/ogc-distribute-{uuid.uuid4().hex}"
+        _dir = shlex.quote(self.dir)
+        out, err, exit_code = client.run(
+            f"mkdir -m 700 -p {_dir} && ln -sf \"$(readlink -f {shlex.quote(dest)})\" {_dir}/file"
+            f" && (nohup python3 -c {shlex.quote(_SERVER)} {_dir}"
+            f" {shlex.quote(client.address)} {SERVE_TTL}"
+            f" > {_dir}/port 2>/dev/null < /dev/null & echo $! > {_dir}/pid)"
+            f" && for _ in $(seq 100); do [ -s {_dir}/port ] && break; sleep 0.1; done"
+            f" && cat {_dir}/port"
+        )
+        port, _, token = out.strip().partition(" ")
+        if exit_code != 0 or not port.isdigit() or not token:
+            raise RuntimeError(f"Could not serve file from {client.name}: {err}")
+        # Handed to the fetching nodes on stdin, never in a command line
+        self.url = f"http://{client.address}:{port}/{token}"
+
+    def stop(self) -> None:
+        _dir = shlex.quote(self.dir)
+        self.client.run(f"kill $(cat {_dir}/pid) 2>/dev/null; rm -rf {_dir}")
+
+
+def distribute(
+    machines: t.Iterable[MachineModel],
+    src: Path,
+    dest: str,
+    tree: bool = True,
+    fanout: int = FANOUT,
+    seeds: int = SEEDS,
+    client: t.Callable[[t.Any], NodeClient] = connections.PooledClient,
+    rollout: Rollout | None = None,
+) -> DistributeReport:
+    """Copies a file to every machine
+
+    Args:
+        machines: machines to copy to
+        src: local file
+        dest: path on the machines, relative to the home directory
+        tree: relay between machines, otherwise upload to each directly
+        fanout: machines a holder serves per round
+        seeds: machines to upload to directly before relaying
+        client: returns the client of a machine
+        rollout: timeouts, the overall one covers every round
+
+    Returns:
+        Report of the distribution
+    """
+    started = time.monotonic()
+    rollout = rollout or Rollout()
+    end = started + rollout.timeout if rollout.timeout else None
+    report = DistributeReport(checksum=sha256(src))
+    clients = [client(machine) for machine in machines]
+    holders: list[_Holder] = []
+    quoted = shlex.quote(dest)
+
+    def _verified(_client: NodeClient) -> bool:
+        if _checksum(_client, dest) == report.checksum:
+            return True
+        log.error("Checksum mismatch", machine=_client.name, path=dest)
+        return False
+
+    def _hold(_client: NodeClient) -> None:
+        if tree:
+            try:
+                holders.append(_Holder(_client, dest))
+            except RuntimeError:
+                log.warning("Not relaying", machine=_client.name, exc_info=True)
+
+    def _upload(_client: NodeClient) -> bool:
+        try:
+            _client.run(f"mkdir -p \"$(dirname {quoted})\"")
+            _client.upload(src, dest)
+        except Exception:
+            log.error("Upload failed", machine=_client.name, exc_info=True)
+            return False
+        if not _verified(_client):
+            return False
+        report.uploaded.append(_client.name)
+        _hold(_client)
+        return True
+
+    def _fetch(pair: tuple[NodeClient, _Holder]) -> bool:
+        _client, holder = pair
+        # The url is read from stdin into a file only the user can read, curl
+        # and wget take it from there rather than from their arguments
+        _, err, exit_code = _client.run(
+            f"mkdir -p \"$(dirname {quoted})\" && (umask 077 && cat > {quoted}.url)"
+            f" && (sed 's/^/url = /' {quoted}.url | curl -fsS -o {quoted}.part -K -"
+            f" || wget -q -O {quoted}.part -i {quoted}.url)"
+            f"; code=$?; rm -f {quoted}.url; [ $code -eq 0 ] && mv {quoted}.part {quoted}",
+            stdin=[f"{holder.url}\n".encode()],
+        )
+        if exit_code == 0 and _verified(_client):
+            report.relayed[_client.name] = holder.client.name
+            _hold(_client)
+            return True
+        log.warning(
+            "Relay failed, uploading directly",
+            machine=_client.name,
+            source=holder.client.name,
+            err=err.strip(),
+        )
+        return _upload(_client)
+
+    def _missing(_clients: list[NodeClient]) -> list[str]:
+        return [
+            _client.name
+            for _client in _clients
+            if _client.name not in report.uploaded
+            and _client.name not in report.relayed
+        ]
+
+    def _rollout() -> Rollout:
+        if end is None:
+            return rollout
+        return evolve(rollout, timeout=max(end - time.monotonic(), 0.001))
+
+    def _uploads(_clients: list[NodeClient]) -> None:
+        get_executor().run(_rollout(), _clients, _upload, "transfer", Priority.EXEC)
+        report.failed += _missing(_clients)
+
+    pending = clients
+    try:
+        if not tree:
+            _uploads(pending)
+            pending = []
+        else:
+            _uploads(pending[: max(seeds, 1)])
+            pending = pending[max(seeds, 1) :]
+        while pending:
+            if not holders:
+                _uploads(pending)
+                break
+            report.rounds += 1
+            size = len(holders) * max(fanout, 1)
+            batch, pending = pending[:size], pending[size:]
+            _holders = list(holders)
+            if not pending:
+                # Last round, holders without a node to serve stop right away
+                busy = len(batch)
+                _holders, idle = _holders[:busy], _holders[busy:]
+                for holder in idle:
+                    holder.stop()
+                    holders.remove(holder)
+            pairs = [
+                (_client, _holders[idx % len(_holders)])
+                for idx, _client in enumerate(batch)
+            ]
+            get_executor().run(_rollout(), pairs, _fetch, "ssh", Priority.EXEC)
+            report.failed += _missing(batch)
+    finally:
+        for holder in holders:
+            holder.stop()
+    report.elapsed = time.monotonic() - started
+    log.info(
+        f"Distributed {src} to {len(report.uploaded) + len(report.relayed)} node(s)",
+        uploaded=len(report.uploaded),
+        relayed=len(report.relayed),
+        failed=len(report.failed),
+        rounds=report.rounds,
+        elapsed=round(report.elapsed, 2),
+    )
+    return report
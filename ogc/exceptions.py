@@ -7,3 +7,15 @@ class ProvisionException(Exception):
 
 class ProvisionDeployerException(Exception):
     """Raise when deployer fails"""
+
+
+class QueryException(Exception):
+    """Raise when a machine filter can not be parsed"""
+
+
+class ExecutorException(Exception):
+    """Raise when an executor can not be used"""
+
+
+class PlanException(Exception):
+    """Raise when the steps of a plan can not be ordered"""
@@ -0,0 +1,155 @@
+"""Execution backends
+
+Work on machines is handed to an executor, picked with `OGC_EXECUTOR`:
+
+| Executor | How work runs |
+| -------- | ------------- |
+| `gevent` | greenlets on a monkey patched interpreter, admitted by `ogc.scheduler`, the default |
+| `asyncio` | an event loop handing blocking SSH and provider calls to worker threads, nothing is patched |
+
+gevent patches the interpreter when `ogc` is imported, so `OGC_EXECUTOR` has
+to be set before that to embed ogc in an asyncio service.
+"""
+
+from __future__ import annotations
+
+import abc
+import asyncio
+import concurrent.futures
+import os
+import typing as t
+
+from ogc.exceptions import ExecutorException
+from ogc.limiter import MAX_WORKERS
+from ogc.rollout import N, Rollout, RolloutReport
+from ogc.scheduler import get_scheduler
+
+EXECUTOR = os.environ.get("OGC_EXECUTOR", "gevent")
+
+Key = t.Union[str, t.Callable[[t.Any], str], None]
+
+
+class Executor(abc.ABC):
+    """Runs a rollout of blocking work across nodes"""
+
+    name: str
+
+    @abc.abstractmethod
+    def run(
+        self,
+        rollout: Rollout,
+        nodes: t.Iterable[N],
+        fn: t.Callable[[N], bool],
+        budget: str,
+        priority: int,
+        key: Key = None,
+    ) -> RolloutReport[N]:
+        """Runs `fn` for every node
+
+        Args:
+            rollout: batches and timeouts to run with
+            nodes: nodes to run on
+            fn: work to do on a node, returns whether it succeeded
+            budget: scheduler budget the work counts against
+            priority: priority of the work, see `ogc.scheduler.Priority`
+            key: budget key, or a function returning it for a node
+
+        Returns:
+            Report of the rollout
+        """
+
+
+class GeventExecutor(Executor):
+    """Runs nodes in greenlets through the scheduler"""
+
+    name = "gevent"
+
+    def run(
+        self,
+        rollout: Rollout,
+        nodes: t.Iterable[N],
+        fn: t.Callable[[N], bool],
+        budget: str,
+        priority: int,
+        key: Key = None,
+    ) -> RolloutReport[N]:
+        return rollout.run(nodes, fn, get_scheduler().lane(budget, priority, key))
+
+
+class AsyncioExecutor(Executor):
+    """Runs nodes as asyncio tasks, each in a worker thread
+
+    Budgets have the same adaptive limits as with gevent, priorities are not
+    applied.
+
+    Args:
+        max_workers: number of worker threads
+    """
+
+    name = "asyncio"
+
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self.threads = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ogc"
+        )
+
+    async def run_async(
+        self,
+        rollout: Rollout,
+        nodes: t.Iterable[N],
+        fn: t.Callable[[N], bool],
+        budget: str,
+        priority: int,
+        key: Key = None,
+    ) -> RolloutReport[N]:
+        """Same as `run`, for callers already in an event loop"""
+        scheduler = get_scheduler()
+
+        def _limiter(node: N):
+            return scheduler.budget(budget, key(node) if callable(key) else key).limiter
+
+        return await rollout.run_async(nodes, fn, _limiter, self.threads)
+
+    def run(
+        self,
+        rollout: Rollout,
+        nodes: t.Iterable[N],
+        fn: t.Callable[[N], bool],
+        budget: str,
+        priority: int,
+        key: Key = None,
+    ) -> RolloutReport[N]:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(
+                self.run_async(rollout, nodes, fn, budget, priority, key)
+            )
+        raise ExecutorException(
+            "Can not block the running event loop, await `run_async` or "
+            "call ogc from `asyncio.to_thread` instead"
+        )
+
+
+EXECUTORS: dict[str, type[Executor]] = {
+    GeventExecutor.name: GeventExecutor,
+    AsyncioExecutor.name: AsyncioExecutor,
+}
+
+_executors: dict[str, Executor] = {}
+
+
+def get_executor(name: str | None = None) -> Executor:
+    """Returns the process wide executor
+
+    Args:
+        name: executor to use, `OGC_EXECUTOR` if None
+    """
+    name = name or EXECUTOR
+    if name not in EXECUTORS:
+        raise ExecutorException(
+            f"Unknown executor {name}, expected one of: {', '.join(EXECUTORS)}"
+        )
+    if name not in _executors:
+        _executors[name] = EXECUTORS[name]()
+    return _executors[name]
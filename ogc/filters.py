@@ -0,0 +1,431 @@
+"""Machine filter language
+
+Filters passed with `--query/-q` are parsed once and compiled into a
+predicate that is evaluated against the indexed machine summaries, only
+attributes that aren't indexed require decoding the machine itself.
+
+```
+tag=ogc-worker and not state=terminated
+provider in (google, aws) and label.team=observability
+name~ogc-machine-* or instance_name=~'^ubuntu-[0-9]+$'
+age>2h
+```
+
+| Operator | Description |
+| -------- | ----------- |
+| `=`, `!=` | equality, membership for tags |
+| `~` | glob match |
+| `=~` | regular expression search |
+| `<`, `<=`, `>`, `>=` | ordering, `created` and `age` accept a duration (`30m`, `2h`, `1d`) or a date |
+| `in (a, b)` | any of the values |
+| `and`, `or`, `not`, `( )` | grouping, terms separated by spaces are ANDed |
+
+`created` orders by creation time and `age` by time since creation, a
+duration stands for the time that long ago: `created>2h` and `age<2h` are
+machines created in the last two hours, `created<2024-01-01` and
+`age>2024-01-01` the ones created before that date.
+"""
+
+from __future__ import annotations
+
+import datetime
+import fnmatch
+import functools
+import re
+import typing as t
+
+import magicattr
+
+from ogc.exceptions import QueryException
+
+# Query fields that resolve to an attribute of the indexed machine summary
+FIELD_ALIASES = {
+    "instance_id": "instance_id",
+    "node.id": "instance_id",
+    "name": "name",
+    "instance_name": "instance_name",
+    "node.name": "instance_name",
+    "layout.name": "layout.name",
+    "provider": "provider",
+    "layout.provider": "provider",
+    "state": "state",
+    "instance_state": "state",
+    "node.state": "state",
+    "tag": "tag",
+    "tags": "tag",
+    "layout.tags": "tag",
+    "created": "created",
+    "age": "created",
+}
+
+# Summary attributes that have a secondary index
+INDEXED = {"instance_id", "name", "layout.name", "provider", "state", "tag"}
+
+_LABEL_PREFIXES = ("label.", "labels.", "layout.labels.")
+_MISSING = object()
+_KEYWORDS = {"and", "or", "not", "in"}
+_DURATION = re.compile(r"^(\d+(?:\.\d+)?)([smhdw])$")
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+# Ordering operators and the one ordering the other way round
+_ORDER_INVERSE = {"<": ">", "<=": ">=", ">": "<", ">=": "<="}
+_TOKENS = re.compile(
+    r"""\s*(?:
+    (?P<lparen>\()|(?P<rparen>\))|(?P<comma>,)|
+    (?P<op>=~|!=|<=|>=|=|~|<|>)|
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|
+    (?P<word>[^\s(),=!<>~"']+)
+    )""",
+    re.VERBOSE,
+)
+
+Lookup = t.Callable[[str, str], set[str]]
+
+
+class Record:
+    """Machine being filtered
+
+    Args:
+        summary: indexed summary of the machine
+        load: returns the decoded machine, only called when a filter needs an
+            attribute missing from the summary
+    """
+
+    def __init__(self, summary: dict[str, t.Any], load: t.Callable[[], t.Any]):
+        self.summary = summary
+        self._load = load
+        self._machine: t.Any = None
+
+    @property
+    def machine(self) -> t.Any:
+        if self._machine is None:
+            self._machine = self._load()
+        return self._machine
+
+    def get(self, field: str) -> t.Any:
+        """Value of a query field, `_MISSING` if the machine doesn't have it"""
+        if field in FIELD_ALIASES:
+            return self.summary[FIELD_ALIASES[field]]
+        if field.startswith(_LABEL_PREFIXES):
+            key = field.split(".", 1)[1].removeprefix("labels.")
+            labels = dict(label.split("=", 1) for label in self.summary["label"])
+            return labels.get(key, _MISSING)
+        try:
+            return magicattr.get(self.machine, field)
+        except AttributeError:
+            return _MISSING
+
+
+def _age(value: str) -> datetime.timedelta | None:
+    match = _DURATION.match(value)
+    if not match:
+        return None
+    return datetime.timedelta(
+        seconds=float(match.group(1)) * _DURATION_UNITS[match.group(2)]
+    )
+
+
+def _since(value: str) -> datetime.datetime | datetime.timedelta | None:
+    """A date, or a duration, None if it is neither"""
+    age = _age(value)
+    if age is not None:
+        return age
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.utcnow()
+
+
+def _order(left: t.Any, right: str) -> tuple[t.Any, t.Any]:
+    try:
+        return float(left), float(right)
+    except (TypeError, ValueError):
+        return str(left), right
+
+
+class Expr:
+    """Node of a compiled filter"""
+
+    def matches(self, record: Record) -> bool:
+        raise NotImplementedError()
+
+    def candidates(self, lookup: Lookup) -> set[str] | None:
+        """Instance ids that can match according to the indexes
+
+        Returns:
+            Set of candidate ids, or None if every machine has to be checked
+        """
+        return None
+
+
+class Compare(Expr):
+    def __init__(self, field: str, op: str, value: str):
+        self.field = field
+        self.op = op
+        self.value = value
+        self.pattern: re.Pattern | None = None
+        if op == "=~":
+            try:
+                self.pattern = re.compile(value)
+            except re.error as exc:
+                raise QueryException(f"Invalid regular expression {value!r}: {exc}")
+        elif op == "~":
+            self.pattern = re.compile(fnmatch.translate(value))
+        self.since: datetime.datetime | datetime.timedelta | None = None
+        if FIELD_ALIASES.get(field) == "created" and op in _ORDER_INVERSE:
+            self.since = _since(value)
+            if self.since is None:
+                raise QueryException(f"Expected a duration or a date for {field}: {value}")
+            if field == "age":
+                # An older machine has a bigger age but an earlier timestamp
+                self.op = _ORDER_INVERSE[op]
+
+    def _compare(self, value: t.Any) -> bool:
+        if self.pattern is not None:
+            return bool(self.pattern.search(str(value)))
+        if self.op == "=":
+            return str(value) == self.value
+        if self.op == "!=":
+            return str(value) != self.value
+        if self.since is not None:
+            right = self.since
+            if isinstance(right, datetime.timedelta):
+                # Taken from now on every match, parsed filters are cached and
+                # live as long as the process
+                right = _now() - right
+            left = datetime.datetime.fromisoformat(str(value))
+        else:
+            left, right = _order(value, self.value)
+        try:
+            return {
+                "<": left < right,
+                "<=": left <= right,
+                ">": left > right,
+                ">=": left >= right,
+            }[self.op]
+        except TypeError:
+            return False
+
+    def matches(self, record: Record) -> bool:
+        value = record.get(self.field)
+        if value is _MISSING:
+            return False
+        if isinstance(value, (list, tuple, set)):
+            if self.op == "!=":
+                return self.value not in [str(item) for item in value]
+            return any(self._compare(item) for item in value)
+        return self._compare(value)
+
+    def candidates(self, lookup: Lookup) -> set[str] | None:
+        if self.op != "=":
+            return None
+        if FIELD_ALIASES.get(self.field) in INDEXED:
+            return lookup(FIELD_ALIASES[self.field], self.value)
+        if self.field.startswith(_LABEL_PREFIXES):
+            key = self.field.split(".", 1)[1].removeprefix("labels.")
+            return lookup("label", f"{key}={self.value}")
+        return None
+
+
+class In(Expr):
+    def __init__(self, field: str, values: list[str]):
+        self.terms = [Compare(field, "=", value) for value in values]
+
+    def matches(self, record: Record) -> bool:
+        return any(term.matches(record) for term in self.terms)
+
+    def candidates(self, lookup: Lookup) -> set[str] | None:
+        return Or(self.terms).candidates(lookup)
+
+
+class And(Expr):
+    def __init__(self, terms: list[Expr]):
+        self.terms = terms
+
+    def matches(self, record: Record) -> bool:
+        return all(term.matches(record) for term in self.terms)
+
+    def candidates(self, lookup: Lookup) -> set[str] | None:
+        result: set[str] | None = None
+        for term in self.terms:
+            ids = term.candidates(lookup)
+            if ids is not None:
+                result = ids if result is None else result & ids
+                if not result:
+                    break
+        return result
+
+
+class Or(Expr):
+    def __init__(self, terms: list[Expr]):
+        self.terms = terms
+
+    def matches(self, record: Record) -> bool:
+        return any(term.matches(record) for term in self.terms)
+
+    def candidates(self, lookup: Lookup) -> set[str] | None:
+        result: set[str] = set()
+        for term in self.terms:
+            ids = term.candidates(lookup)
+            if ids is None:
+                return None
+            result |= ids
+        return result
+
+
+class Not(Expr):
+    def __init__(self, term: Expr):
+        self.term = term
+
+    def matches(self, record: Record) -> bool:
+        return not self.term.matches(record)
+
+
+class _Parser:
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens: list[tuple[str, str]] = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = _TOKENS.match(text, pos)
+            if not match or match.end() == pos:
+                raise QueryException(f"Unexpected input at {pos}: {text[pos:]!r}")
+            kind = t.cast(str, match.lastgroup)
+            value = match.group(kind)
+            if kind == "string":
+                value = re.sub(r"\\(.)", r"\1", value[1:-1])
+            elif kind == "word" and value.lower() in _KEYWORDS:
+                kind, value = "keyword", value.lower()
+            self.tokens.append((kind, value))
+            pos = match.end()
+        self.pos = 0
+
+    def peek(self) -> tuple[str, str] | None:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, kind: str, value: str | None = None) -> str:
+        token = self.peek()
+        if not token or token[0] != kind or (value and token[1] != value):
+            found = repr(token[1]) if token else "end of query"
+            raise QueryException(
+                f"Expected {value or kind} but found {found} in {self.text!r}"
+            )
+        self.pos += 1
+        return token[1]
+
+    def parse(self) -> Expr:
+        expr = self.parse_or()
+        if self.peek():
+            raise QueryException(f"Unexpected {self.peek()[1]!r} in {self.text!r}")
+        return expr
+
+    def parse_or(self) -> Expr:
+        terms = [self.parse_and()]
+        while self.peek() == ("keyword", "or"):
+            self.pos += 1
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else Or(terms)
+
+    def parse_and(self) -> Expr:
+        terms = [self.parse_not()]
+        while self.peek() and self.peek() not in [("keyword", "or"), ("rparen", ")")]:
+            if self.peek() == ("keyword", "and"):
+                self.pos += 1
+            terms.append(self.parse_not())
+        return terms[0] if len(terms) == 1 else And(terms)
+
+    def parse_not(self) -> Expr:
+        if self.peek() == ("keyword", "not"):
+            self.pos += 1
+            return Not(self.parse_not())
+        if self.peek() == ("lparen", "("):
+            self.pos += 1
+            expr = self.parse_or()
+            self.take("rparen")
+            return expr
+        return self.parse_term()
+
+    def parse_value(self) -> str:
+        token = self.peek()
+        if token and token[0] in ("word", "string", "keyword"):
+            self.pos += 1
+            return token[1]
+        return self.take("word")
+
+    def parse_term(self) -> Expr:
+        field = self.take("word")
+        if self.peek() == ("keyword", "in"):
+            self.pos += 1
+            self.take("lparen")
+            values = [self.parse_value()]
+            while self.peek() == ("comma", ","):
+                self.pos += 1
+                values.append(self.parse_value())
+            self.take("rparen")
+            return In(field, values)
+        op = self.take("op")
+        return Compare(field, op, self.parse_value())
+
+
+class Filter:
+    """Compiled machine filter
+
+    Args:
+        expr: root of the compiled expression
+        text: query the filter was parsed from
+    """
+
+    def __init__(self, expr: Expr, text: str = ""):
+        self.expr = expr
+        self.text = text
+
+    def matches(self, record: Record) -> bool:
+        return self.expr.matches(record)
+
+    def candidates(self, lookup: Lookup) -> set[str] | None:
+        return self.expr.candidates(lookup)
+
+    def __repr__(self) -> str:
+        return f"<Filter {self.text!r}>"
+
+
+@functools.lru_cache(maxsize=128)
+def parse(text: str) -> Filter:
+    """Compiles a filter query
+
+    Args:
+        text: filter query
+
+    Returns:
+        Compiled filter
+
+    Raises:
+        QueryException: if the query is invalid
+    """
+    return Filter(_Parser(text).parse(), text)
+
+
+def from_kwargs(**kwargs: t.Any) -> Filter | None:
+    """Compiles equality filters, every one of them has to match"""
+    if not kwargs:
+        return None
+    return Filter(
+        And([Compare(str(k), "=", str(v)) for k, v in kwargs.items()]),
+        " and ".join(f"{k}={v}" for k, v in kwargs.items()),
+    )
+
+
+def combine(*filters: Filter | str | None) -> Filter | None:
+    """ANDs filters and queries together, skipping empty ones"""
+    _filters = [parse(f) if isinstance(f, str) else f for f in filters if f]
+    if not _filters:
+        return None
+    if len(_filters) == 1:
+        return _filters[0]
+    return Filter(
+        And([f.expr for f in _filters]), " and ".join(f.text for f in _filters)
+    )
@@ -0,0 +1,149 @@
+"""Read-only view of the fleet for templates
+
+A snapshot of the machine summaries is taken once per run and shared by every
+node being rendered. Machines are only decoded when a template touches them,
+so templates using a few peers don't decode the whole fleet.
+
+Example:
+    ``` bash
+    {% for peer in nodes.where(tag="worker") %}
+    echo "{{ peer.private_ip }} {{ peer.instance_name }}" >> /etc/hosts
+    {% endfor %}
+    export MANAGER={{ nodes.by_name["ogc-manager-a1b2-001"].public_ip }}
+    ```
+"""
+
+from __future__ import annotations
+
+import typing as t
+from collections.abc import Mapping, Sequence
+
+import ogc.filters
+from ogc import db
+from ogc.models.machine import MachineModel
+
+
+class FleetView(Sequence):
+    """Lazily decoded machines of a snapshot
+
+    Indexing and iterating work like the list of machines it replaces.
+
+    Args:
+        store: store the machines are decoded from
+        summaries: summaries of the machines in the view, by instance id
+        cache: decoded machines shared by views of the same snapshot
+    """
+
+    def __init__(
+        self,
+        store: db.MachineStore,
+        summaries: dict[str, dict[str, t.Any]],
+        cache: dict[str, MachineModel] | None = None,
+    ):
+        self._store = store
+        self._summaries = summaries
+        self._ids = list(summaries)
+        self._machines = cache if cache is not None else {}
+        self._views: dict[str, FleetView] = {}
+        self._by_name: _ByName | None = None
+
+    @classmethod
+    def snapshot(cls, store: db.MachineStore | None = None) -> FleetView:
+        """Takes a snapshot of the stored machines' summaries"""
+        store = store or db.store()
+        summaries = {}
+        for _id in store.ids():
+            summary = store.cache.get(("meta", _id))
+            if summary is not None:
+                summaries[_id] = summary
+        return cls(store, summaries)
+
+    def _get(self, _id: str) -> MachineModel | None:
+        if _id not in self._machines:
+            machine = self._store.get(_id)
+            if machine is None:
+                return None
+            self._machines[_id] = machine
+        return self._machines[_id]
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @t.overload
+    def __getitem__(self, index: int) -> MachineModel:
+        ...
+
+    @t.overload
+    def __getitem__(self, index: slice) -> list[MachineModel]:
+        ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(_id) for _id in self._ids[index]]
+        return self._get(self._ids[index])
+
+    def __iter__(self) -> t.Iterator[MachineModel]:
+        for _id in self._ids:
+            machine = self._get(_id)
+            if machine is not None:
+                yield machine
+
+    def where(
+        self, query: ogc.filters.Filter | str | None = None, **kwargs: str
+    ) -> FleetView:
+        """Machines matching a filter, see `ogc.filters`
+
+        Only the summaries are checked unless the filter needs an attribute
+        that isn't indexed. Results are kept, so every node rendering the same
+        filter shares them.
+
+        Args:
+            query: filter query or compiled filter
+            kwargs: attribute equality filters, ANDed with the query
+
+        Returns:
+            View of the matching machines
+        """
+        _filter = ogc.filters.combine(query, ogc.filters.from_kwargs(**kwargs))
+        if _filter is None:
+            return self
+        if _filter.text not in self._views:
+            matches = {
+                _id: summary
+                for _id, summary in self._summaries.items()
+                if _filter.matches(
+                    ogc.filters.Record(summary, lambda _id=_id: self._get(_id))
+                )
+            }
+            self._views[_filter.text] = FleetView(self._store, matches, self._machines)
+        return self._views[_filter.text]
+
+    @property
+    def by_name(self) -> Mapping[str, MachineModel]:
+        """Machines by instance name"""
+        if self._by_name is None:
+            self._by_name = _ByName(self)
+        return self._by_name
+
+    def __repr__(self) -> str:
+        return f"<FleetView of {len(self)} machine(s)>"
+
+
+class _ByName(Mapping):
+    def __init__(self, view: FleetView):
+        self._view = view
+        self._ids = {
+            summary["instance_name"]: _id for _id, summary in view._summaries.items()
+        }
+
+    def __getitem__(self, name: str) -> MachineModel:
+        machine = self._view._get(self._ids[name])
+        if machine is None:
+            raise KeyError(name)
+        return machine
+
+    def __iter__(self) -> t.Iterator[str]:
+        return iter(self._ids)
+
+    def __len__(self) -> int:
+        return len(self._ids)
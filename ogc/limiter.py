@@ -0,0 +1,163 @@
+"""Adaptive concurrency limits
+
+Work on machines is bound by the network and provider APIs rather than local
+CPUs, so how many machines are worked on at once is adjusted as work
+completes (AIMD). Concurrency grows while SSH and API latencies stay near the
+best seen, and it is cut back on errors, throttling or rising latency. It
+always stays between the floor and the ceiling.
+"""
+
+from __future__ import annotations
+
+import os
+import typing as t
+
+import structlog
+
+log = structlog.getLogger()
+
+# Lowest concurrency, also where it starts from
+MIN_WORKERS = int(os.environ.get("OGC_MIN_WORKERS", 4))
+
+# Highest concurrency
+MAX_WORKERS = int(os.environ.get("OGC_MAX_WORKERS", 64))
+
+# Errors hinting at the provider or host throttling us
+_THROTTLE_HINTS = (
+    "throttl",
+    "rate limit",
+    "ratelimit",
+    "too many requests",
+    "requestlimitexceeded",
+    "quota",
+    "429",
+)
+
+
+def is_throttle(exc: BaseException) -> bool:
+    """Whether an error looks like throttling"""
+    text = f"{type(exc).__name__} {exc}".lower()
+    return any(hint in text for hint in _THROTTLE_HINTS)
+
+
+class AdaptiveLimiter:
+    """Additive increase, multiplicative decrease concurrency limit
+
+    The limit grows by one per success until the first sign of congestion,
+    then by one per window of `limit` successes. It is cut by `backoff` on a
+    failure, or on a latency over `tolerance` times the baseline, at most once
+    per window.
+
+    Args:
+        floor: lowest limit
+        ceiling: highest limit
+        backoff: factor the limit is multiplied by on congestion
+        tolerance: latency over the baseline tolerated before backing off
+    """
+
+    def __init__(
+        self,
+        floor: int = MIN_WORKERS,
+        ceiling: int = MAX_WORKERS,
+        backoff: float = 0.5,
+        tolerance: float = 2.0,
+    ):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self._limit = float(self.floor)
+        self.peak = self.floor
+        self.slow_start = True
+        self.baselines: dict[str, float] = {}
+        self.successes = 0
+        self.failures = 0
+        self.throttled = 0
+        # Completions since the last backoff, the first congestion always counts
+        self._since_backoff = self.ceiling
+
+    @property
+    def limit(self) -> int:
+        """Current concurrency limit"""
+        return int(self._limit)
+
+    def _set(self, limit: float) -> None:
+        self._limit = min(max(limit, self.floor), self.ceiling)
+        self.peak = max(self.peak, self.limit)
+
+    def _congested(self, reason: str) -> None:
+        self.slow_start = False
+        if self._since_backoff < self.limit:
+            # Already backed off for this window
+            return
+        self._since_backoff = 0
+        previous = self.limit
+        self._set(self._limit * self.backoff)
+        log.debug(
+            "Backing off concurrency", reason=reason, old=previous, new=self.limit
+        )
+
+    def observe(self, latency: float, kind: str = "ssh") -> None:
+        """Records the latency of an SSH or API round trip
+
+        Args:
+            latency: seconds the round trip took
+            kind: kind of round trip, each kind has its own baseline
+        """
+        baseline = self.baselines.get(kind)
+        if baseline is None or latency < baseline:
+            baseline = latency
+        else:
+            # Let the baseline drift up slowly so one lucky sample doesn't
+            # hold the limit down forever
+            baseline += (latency - baseline) * 0.01
+        self.baselines[kind] = baseline
+        if latency > baseline * self.tolerance and latency - baseline > 0.05:
+            self._congested(f"{kind} latency {latency:.3f}s over {baseline:.3f}s")
+
+    def success(self) -> None:
+        """Records a completed unit of work"""
+        self.successes += 1
+        self._since_backoff += 1
+        self._set(self._limit + (1 if self.slow_start else 1 / self._limit))
+
+    def failure(self, exc: BaseException | None = None) -> None:
+        """Records a failed unit of work
+
+        Args:
+            exc: error the work failed with, if any
+        """
+        self.failures += 1
+        self._since_backoff += 1
+        if exc is not None and is_throttle(exc):
+            self.throttled += 1
+            self._congested(f"throttled: {exc}")
+        else:
+            self._congested("failure")
+
+    def report(self) -> dict[str, t.Any]:
+        """Concurrency chosen and what it was based on"""
+        return {
+            "concurrency": self.limit,
+            "peak": self.peak,
+            "floor": self.floor,
+            "ceiling": self.ceiling,
+            "successes": self.successes,
+            "failures": self.failures,
+            "throttled": self.throttled,
+            "baseline_ms": {
+                kind: round(baseline * 1000, 1)
+                for kind, baseline in self.baselines.items()
+            },
+        }
+
+
+_limiter: AdaptiveLimiter | None = None
+
+
+def get_limiter() -> AdaptiveLimiter:
+    """Returns the process wide limiter"""
+    global _limiter
+    if _limiter is None:
+        _limiter = AdaptiveLimiter()
+    return _limiter
@@ -36,12 +36,12 @@ class LayoutModel:
     runs_on: str = field()
     scale: int = field()
     username: str = field()
-    ssh_private_key: str = field()
-    ssh_public_key: str = field()
+    ssh_private_key: str = field(converter=str)
+    ssh_public_key: str = field(converter=str)
     tags: list[str] = field()
     labels: dict = field()
-    ports: dict = field()
-    name: str = field(init=False)
+    ports: list[str] = field()
+    name: str = field()
 
     @classmethod
     def create_from_specs(cls, specs: list) -> list[LayoutModel]:
@@ -1,13 +1,15 @@
 import datetime
+import typing as t
 from pathlib import Path
 
+import paramiko
 import structlog
 from attrs import define, field
-from libcloud.compute.base import Node
+from libcloud.compute.base import Node, NodeLocation, StorageVolume
 from libcloud.compute.ssh import ParamikoSSHClient
-from retry import retry
+from libcloud.compute.types import NodeState
 
-from ogc import db
+from ogc import connections, db
 
 from .layout import LayoutModel
 
@@ -16,15 +18,26 @@ log = structlog.getLogger()
 
 @define
 class MachineModel:
+    """Machine Model
+
+    Only the attributes needed to manage a machine are kept, the libcloud
+    `node` handle is rebuilt from them on first access when the machine was
+    loaded from the database. The rebuilt node carries what the provider
+    destroy calls read: its zone, state and boot disk.
+    """
+
     layout: LayoutModel = field()
-    node: Node = field()
-    name: str = field(init=False)
-    created: datetime.datetime = field(init=False)
-    instance_name: str = field(init=False)
-    instance_id: str = field(init=False)
-    public_ip: str = field(init=False)
-    private_ip: str = field(init=False)
-    username: str = field(init=False)
+    _node: Node | None = field(default=None, eq=False, repr=False)
+    name: str = field()
+    created: datetime.datetime = field()
+    instance_name: str = field()
+    instance_id: str = field()
+    instance_state: str = field()
+    public_ip: str = field()
+    private_ip: str = field()
+    username: str = field()
+    zone: str | None = field()
+    boot_disk: str | None = field()
 
     @name.default
     def get_name(self) -> str:
@@ -36,60 +49,90 @@ class MachineModel:
 
     @instance_name.default
     def get_instance_name(self) -> str:
-        return self.node.name
+        return self._node.name
 
     @instance_id.default
     def get_instance_id(self) -> str:
-        return self.node.id
+        return self._node.id
+
+    @instance_state.default
+    def get_instance_state(self) -> str:
+        return str(self._node.state)
 
     @public_ip.default
     def get_public_ip(self) -> str:
-        return self.node.public_ips[0]
+        return self._node.public_ips[0]
 
     @private_ip.default
     def get_private_ip(self) -> str:
-        return self.node.private_ips[0]
+        return self._node.private_ips[0]
+
+    @zone.default
+    def get_zone(self) -> str | None:
+        _zone = self._node.extra.get("zone", self._node.extra.get("availability"))
+        return getattr(_zone, "name", _zone)
+
+    @boot_disk.default
+    def get_boot_disk(self) -> str | None:
+        if self._node is None:
+            return None
+        return getattr(self._node.extra.get("boot_disk"), "name", None)
 
     @created.default
     def get_created(self) -> datetime.datetime:
         return datetime.datetime.utcnow()
 
-    @retry(tries=5, delay=5, jitter=(1, 5), logger=None)
-    def ssh(self) -> ParamikoSSHClient | None:
-        """Provides an SSH Client for use with provisioning"""
-        priv_key = Path(self.layout.ssh_private_key).expanduser().resolve()
-        if self.node.public_ips[0] and self.layout.username:
-            _client = ParamikoSSHClient(
-                str(self.node.public_ips[0]),
-                username=str(self.layout.username),
-                key=str(priv_key),
-                timeout=300,
-                use_compression=True,
-                keep_alive=5,
+    @property
+    def node(self) -> Node:
+        """libcloud node handle, rebuilt lazily from the stored attributes"""
+        if self._node is None:
+            extra: dict[str, t.Any] = {"boot_disk": None}
+            if self.zone:
+                extra["zone"] = NodeLocation(
+                    id=self.zone, name=self.zone, country="", driver=None
+                )
+            if self.boot_disk:
+                extra["boot_disk"] = StorageVolume(
+                    id=self.boot_disk,
+                    name=self.boot_disk,
+                    size=None,
+                    driver=None,
+                    extra={"zone": extra.get("zone")},
+                )
+            try:
+                state = NodeState(self.instance_state)
+            except ValueError:
+                state = NodeState.UNKNOWN
+            self._node = Node(
+                id=self.instance_id,
+                name=self.instance_name,
+                state=state,
+                public_ips=[self.public_ip],
+                private_ips=[self.private_ip],
+                driver=None,
+                extra=extra,
             )
+        return self._node
+
+    def ssh(self) -> ParamikoSSHClient | None:
+        """Provides an SSH Client for use with provisioning
+
+        The client is checked out of the process wide connection pool, it is
+        shared with other users of the machine and must not be closed.
+        """
+        if self.public_ip and self.layout.username:
             try:
-                _client.connect()
+                return connections.get_pool().client(self)
             except paramiko.ssh_exception.SSHException:
+                priv_key = Path(self.layout.ssh_private_key).expanduser().resolve()
                 log.error(
-                    f"Authentication failed for: ({self.layout.name}/{priv_key}) {self.layout.username}@{self.node.public_ips[0]}"
+                    f"Authentication failed for: ({self.layout.name}/{priv_key}) "
+                    f"{self.layout.username}@{self.public_ip}"
                 )
                 return None
-            return _client
         return None
 
     @classmethod
     def query(cls, **kwargs: str) -> list["MachineModel"]:
-        """list layouts"""
-        cache = db.cache_path()
-        _machines = [
-            db.pickle_to_model(cache.get(machine)) for machine in cache.iterkeys()
-        ]
-        _filtered_machines: list[MachineModel] = []
-        if kwargs:
-            for k, v in kwargs.items():
-                for _machine in _filtered_machines:
-                    if getattr(_machine, k) == v:
-                        _filtered_machines.append(_machine)
-        if _filtered_machines:
-            return _filtered_machines
-        return _machines
+        """list machines"""
+        return db.query(**kwargs) or []
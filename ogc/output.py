@@ -0,0 +1,149 @@
+"""Per-node command output
+
+Output is consumed as it arrives, split into lines and optionally echoed
+prefixed with the node name. Only the last lines are kept in memory, the full
+output can be spooled to disk.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sys
+import threading
+import typing as t
+from collections import deque
+from pathlib import Path
+
+# Number of trailing lines kept in memory per node and stream
+TAIL_LINES = int(os.environ.get("OGC_TAIL_LINES", 200))
+
+# Lines longer than this are split so a command without newlines stays bounded
+MAX_LINE = 65536
+
+EOL = "\r\n"
+
+_write_lock = threading.Lock()
+
+
+class _Stream:
+    def __init__(self, tail_lines: int, spool: Path | None):
+        self.tail: deque[str] = deque(maxlen=tail_lines)
+        self.partial = bytearray()
+        self.lines = 0
+        self.hash = hashlib.blake2b(digest_size=16)
+        self.spool = spool.open("wb") if spool else None
+
+    def feed(self, data: bytes) -> list[str]:
+        self.hash.update(data)
+        if self.spool:
+            self.spool.write(data)
+        self.partial += data
+        lines = []
+        while True:
+            end = self.partial.find(b"\n")
+            if end < 0:
+                if len(self.partial) < MAX_LINE:
+                    break
+                end = MAX_LINE - 1
+            lines.append(self.partial[: end + 1].decode("utf-8", errors="replace"))
+            del self.partial[: end + 1]
+        return lines
+
+    def flush(self) -> list[str]:
+        lines = []
+        if self.partial:
+            lines.append(self.partial.decode("utf-8", errors="replace"))
+            self.partial.clear()
+        if self.spool:
+            self.spool.close()
+            self.spool = None
+        return lines
+
+
+class NodeOutput:
+    """Output of a command running on a node
+
+    Args:
+        name: node name used to prefix streamed lines
+        stream: echo lines as they arrive
+        tail_lines: number of trailing lines to keep per stream
+        spool_dir: directory to write the full `<name>.out` and `<name>.err` to
+        echo: where streamed lines are written, defaults to stdout
+    """
+
+    def __init__(
+        self,
+        name: str,
+        stream: bool = False,
+        tail_lines: int = TAIL_LINES,
+        spool_dir: Path | None = None,
+        echo: t.TextIO | None = None,
+    ):
+        self.name = name
+        self.stream = stream
+        self.echo = echo or sys.stdout
+        self.spool_dir = spool_dir
+        if spool_dir:
+            spool_dir.mkdir(parents=True, exist_ok=True)
+        self._out = _Stream(tail_lines, self.spool_path("out"))
+        self._err = _Stream(tail_lines, self.spool_path("err"))
+
+    def spool_path(self, stream: str) -> Path | None:
+        """File the full `out` or `err` stream is spooled to"""
+        return self.spool_dir / f"{self.name}.{stream}" if self.spool_dir else None
+
+    def _emit(self, stream: _Stream, lines: list[str], marker: str) -> None:
+        stream.lines += len(lines)
+        stream.tail.extend(lines)
+        if self.stream and lines:
+            prefix = f"{self.name}{marker} "
+            text = "".join(f"{prefix}{line.rstrip(EOL)}\n" for line in lines)
+            with _write_lock:
+                self.echo.write(text)
+                self.echo.flush()
+
+    def feed_out(self, data: bytes | str) -> None:
+        """Consumes a chunk of stdout"""
+        if isinstance(data, str):
+            data = data.encode()
+        self._emit(self._out, self._out.feed(data), ":")
+
+    def feed_err(self, data: bytes | str) -> None:
+        """Consumes a chunk of stderr"""
+        if isinstance(data, str):
+            data = data.encode()
+        self._emit(self._err, self._err.feed(data), "!")
+
+    def close(self) -> None:
+        """Flushes incomplete lines and closes the spool files"""
+        self._emit(self._out, self._out.flush(), ":")
+        self._emit(self._err, self._err.flush(), "!")
+
+    @property
+    def out(self) -> str:
+        """Trailing stdout lines"""
+        return "".join(self._out.tail)
+
+    @property
+    def err(self) -> str:
+        """Trailing stderr lines"""
+        return "".join(self._err.tail)
+
+    @property
+    def digest(self) -> str:
+        """Hash of the full stdout and stderr, computed as they arrived"""
+        return hashlib.blake2b(
+            self._out.hash.digest() + self._err.hash.digest(), digest_size=16
+        ).hexdigest()
+
+    @property
+    def truncated(self) -> bool:
+        """Whether lines were dropped from the tails"""
+        return any(s.lines > len(s.tail) for s in (self._out, self._err))
+
+    def __enter__(self) -> NodeOutput:
+        return self
+
+    def __exit__(self, exc_type: t.Any, exc: t.Any, tb: t.Any) -> None:
+        self.close()
@@ -0,0 +1,235 @@
+"""Dependencies between script steps
+
+Without a plan the steps of a scripts directory run one after the other in
+name order. A `steps` mapping in the directory's `.plan.yml` declares what
+each step waits for instead, steps not waiting on each other run at the same
+time:
+
+``` yaml
+steps:
+  01-setup: {}
+  02-install:
+    needs: [01-setup]
+  03-monitoring:
+    needs: [01-setup]
+  04-join:
+    needs: [02-install]
+    after: ["ogc-manager:02-install"]
+```
+
+`needs` are steps of the same node, `after` are `tag:step` pairs, the step
+waits for it to finish on every node of the run having that tag. Steps left
+out of the mapping wait for nothing. A step whose prerequisites failed is not
+run and fails as well.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import threading
+import typing as t
+from pathlib import Path
+
+import structlog
+import yaml
+from attrs import define, field
+
+from ogc.exceptions import PlanException
+
+log = structlog.getLogger()
+
+
+@define
+class Step:
+    """Step and what it waits for
+
+    Attributes:
+        name: name of the step, its script's file name
+        needs: steps of the same node to wait for
+        after: tag and step pairs to wait for on every node having the tag
+    """
+
+    name: str
+    needs: list[str] = field(factory=list)
+    after: list[tuple[str, str]] = field(factory=list)
+
+
+def load(plan: dict | None, names: list[str]) -> list[Step]:
+    """Reads the steps of a plan
+
+    Args:
+        plan: parsed `.plan.yml`, if any
+        names: script names in name order
+
+    Returns:
+        Steps in name order
+
+    Raises:
+        PlanException: if a step is unknown or the dependencies form a cycle
+    """
+    declared = (plan or {}).get("steps")
+    if declared is None:
+        return [
+            Step(name, needs=[names[idx - 1]] if idx else [])
+            for idx, name in enumerate(names)
+        ]
+    unknown = set(declared) - set(names)
+    if unknown:
+        raise PlanException(f"Unknown steps in plan: {', '.join(sorted(unknown))}")
+    steps = []
+    for name in names:
+        spec = declared.get(name) or {}
+        after = []
+        for entry in spec.get("after", []):
+            tag, sep, step = str(entry).partition(":")
+            if not sep or step not in names:
+                raise PlanException(f"{name}: expected tag:step, got {entry!r}")
+            after.append((tag, step))
+        needs = [str(need) for need in spec.get("needs", [])]
+        if set(needs) - set(names):
+            raise PlanException(f"{name}: unknown needs {needs}")
+        steps.append(Step(name, needs=needs, after=after))
+    _check_cycles(steps)
+    return steps
+
+
+def _check_cycles(steps: list[Step]) -> None:
+    # Cross node waits are on the same steps, so they count as edges too
+    edges = {
+        step.name: set(step.needs) | {name for _, name in step.after}
+        for step in steps
+    }
+    visiting: set[str] = set()
+    visited: set[str] = set()
+
+    def _visit(name: str) -> None:
+        if name in visited:
+            return
+        if name in visiting:
+            raise PlanException(f"Steps depend on each other: {name}")
+        visiting.add(name)
+        for dep in edges[name]:
+            _visit(dep)
+        visiting.discard(name)
+        visited.add(name)
+
+    for name in edges:
+        _visit(name)
+
+
+def read(script_dir: Path) -> dict | None:
+    """Parsed `.plan.yml` of a scripts directory, None without one"""
+    path = script_dir / ".plan.yml"
+    if not path.exists():
+        return None
+    return yaml.safe_load(path.read_text())
+
+
+def waited_on(steps: list[Step]) -> set[str]:
+    """Tags other nodes wait for"""
+    return {tag for step in steps for tag, _ in step.after}
+
+
+class Progress:
+    """Steps finished across the nodes of a run
+
+    Args:
+        tagged: instance ids of the nodes of the run, by tag
+    """
+
+    def __init__(self, tagged: dict[str, list[str]] | None = None):
+        self.tagged = tagged or {}
+        self._results: dict[tuple[str, str], bool] = {}
+        self._gone: set[str] = set()
+        self._changed = threading.Condition()
+
+    def finish(self, instance_id: str, step: str, ok: bool) -> None:
+        with self._changed:
+            self._results[(instance_id, step)] = ok
+            self._changed.notify_all()
+
+    def leave(self, instance_id: str) -> None:
+        """Marks a node as done, steps it didn't finish count as failed"""
+        with self._changed:
+            self._gone.add(instance_id)
+            self._changed.notify_all()
+
+    def _state(self, instance_id: str, step: str) -> bool | None:
+        ok = self._results.get((instance_id, step))
+        if ok is None and instance_id in self._gone:
+            return False
+        return ok
+
+    def wait(self, waits: list[tuple[str, str]], timeout: float | None = None) -> bool:
+        """Waits for steps to finish
+
+        Args:
+            waits: instance id and step pairs
+            timeout: seconds to wait, unbounded if None
+
+        Returns:
+            Whether every step succeeded
+        """
+        with self._changed:
+            finished = self._changed.wait_for(
+                lambda: all(self._state(*wait) is not None for wait in waits),
+                timeout,
+            )
+            return finished and all(self._state(*wait) for wait in waits)
+
+
+def run_node(
+    instance_id: str,
+    steps: list[Step],
+    run_step: t.Callable[[str], bool],
+    progress: Progress,
+    timeout: t.Callable[[], float | None] = lambda: None,
+) -> bool:
+    """Runs the steps of a node as soon as what they wait for is done
+
+    Every step runs in its own thread, a greenlet when gevent patched the
+    interpreter.
+
+    Args:
+        instance_id: node the steps run on
+        steps: steps to run
+        run_step: runs a step, returns whether it succeeded
+        progress: progress of the run, shared by every node
+        timeout: returns how long a step may still wait
+
+    Returns:
+        Whether every step succeeded
+    """
+    results: dict[str, bool] = {}
+
+    def _step(step: Step) -> None:
+        waits = [(instance_id, need) for need in step.needs]
+        for tag, name in step.after:
+            waits += [(_id, name) for _id in progress.tagged.get(tag, [])]
+        ok = progress.wait(waits, timeout())
+        if ok:
+            try:
+                ok = run_step(step.name)
+            except Exception:
+                log.error("Step failed", step=step.name, exc_info=True)
+                ok = False
+        else:
+            log.error("Not running step, its prerequisites failed", step=step.name)
+        results[step.name] = ok
+        progress.finish(instance_id, step.name, ok)
+
+    threads = [
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(_step, step), daemon=True
+        )
+        for step in steps
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        # Interrupted nodes must not keep others waiting
+        progress.leave(instance_id)
+    return all(results.get(step.name, False) for step in steps)
@@ -6,19 +6,24 @@ from __future__ import annotations
 import datetime
 import logging
 import os
+import time
 import typing as t
 import uuid
 from pathlib import Path
 
-from libcloud.common.google import (InvalidRequestError, ResourceExistsError,
-                                    ResourceNotFoundError)
+from libcloud.common.google import (GoogleBaseError, InvalidRequestError,
+                                    ResourceExistsError, ResourceNotFoundError)
 from libcloud.compute.base import (KeyPair, Node, NodeAuthSSHKey, NodeDriver,
-                                   NodeImage, NodeLocation, NodeSize)
+                                   NodeImage, NodeLocation, NodeSize,
+                                   StorageVolume)
+from libcloud.compute.drivers.ec2 import NAMESPACE as EC2_NAMESPACE
+from libcloud.compute.drivers.ec2 import EC2NodeDriver
 from libcloud.compute.providers import get_driver
-from libcloud.compute.types import Provider
+from libcloud.compute.types import NodeState, Provider
+from libcloud.utils.xml import findall, findtext
 from retry import retry
 
-from ogc import db
+from ogc import catalog, db, scheduler, timeouts
 from ogc.enums import CLOUD_IMAGE_MAP
 from ogc.exceptions import ProvisionException
 from ogc.models.layout import LayoutModel
@@ -26,6 +31,9 @@ from ogc.models.machine import MachineModel
 
 log = logging.getLogger("ogc")
 
+# Instance ids sent in a single TerminateInstances call
+TERMINATE_BATCH = 1000
+
 
 class BaseProvisioner:
     """Base provisioner"""
@@ -43,7 +51,7 @@ class BaseProvisioner:
             else AWSProvisioner(layout=layout)
         )
         if connect:
-            _prov.provisioner = _prov.connect()
+            _prov.provisioner = _prov.observed(_prov.connect())
         return _prov
 
     @classmethod
@@ -56,7 +64,7 @@ class BaseProvisioner:
             else AWSProvisioner(layout=machine.layout)
         )
         if connect:
-            _prov.provisioner = _prov.connect()
+            _prov.provisioner = _prov.observed(_prov.connect())
         return _prov
 
     @property
@@ -69,59 +77,143 @@ class BaseProvisioner:
     def create(self) -> list[MachineModel] | None:
         raise NotImplementedError()
 
+    def observed(self, driver: NodeDriver) -> NodeDriver:
+        """Reports the latency of every request of a driver to the api budget
+
+        The limiter of the provider's `api` budget backs off when requests
+        slow down, not only when they are throttled, see `ogc.limiter`.
+        """
+        limiter = scheduler.get_scheduler().budget("api", self.layout.provider).limiter
+        request = driver.connection.request
+
+        def _request(*args: t.Any, **kwargs: t.Any) -> t.Any:
+            started = time.monotonic()
+            response = request(*args, **kwargs)
+            limiter.observe(time.monotonic() - started, "api")
+            return response
+
+        driver.connection.request = _request
+        return driver
+
     def setup(self) -> None:
         """Perform some provider specific setup before launch"""
         raise NotImplementedError()
 
-    def cleanup(self, node: MachineModel, **kwargs: dict[str, object]) -> bool:
-        """Perform some provider specific cleanup after node destroy typically"""
+    def cleanup(self) -> bool:
+        """Removes what `setup` created, once every node of the layout is destroyed"""
         raise NotImplementedError()
 
-    def destroy(self, nodes: list[Node]) -> bool:
-        for node in nodes:
-            self.provisioner.destroy_node(node)
-        return True
+    def destroy(self, nodes: list[Node]) -> list[bool]:
+        """Destroys nodes, in as few provider calls as the provider allows
+
+        Returns:
+            Whether each node was destroyed, in the order of `nodes`
+        """
+        return [bool(self.provisioner.destroy_node(node)) for node in nodes]
+
+    def gone(self, nodes: list[Node]) -> list[bool]:
+        """Asks the provider which nodes are terminated or no longer exist
+
+        Returns:
+            Whether each node is gone, in the order of `nodes`
+        """
+        states = {node.id: node for node in self.list_nodes()}
+        return [
+            node.id not in states
+            or states[node.id].state == NodeState.TERMINATED
+            or states[node.id].extra.get("status") == "shutting-down"
+            for node in nodes
+        ]
 
     def node(self, **kwargs: t.Mapping[str, t.Union[str, object]]) -> Node | None:
         raise NotImplementedError()
 
+    @property
+    def scope(self) -> tuple[str, ...]:
+        """Provider and region or project catalog lookups are shared by"""
+        raise NotImplementedError()
+
+    def cached(self, lookup: str, fetch: t.Callable[[], t.Any], *args: str) -> t.Any:
+        """Provider lookup through the catalog cache, see `ogc.catalog`
+
+        Args:
+            lookup: what is looked up, eg. `sizes`
+            fetch: calls the provider
+            args: arguments the lookup depends on
+        """
+        value = catalog.get_catalog().get((*self.scope, lookup, *args), fetch)
+        return catalog.bind(value, self.provisioner)
+
     def sizes(self, instance_size: str) -> list[NodeSize]:
-        _sizes = self.provisioner.list_sizes()
-        try:
-            return [
-                size
-                for size in _sizes
-                if size.id == instance_size or size.name == instance_size
-            ]
-        except IndexError:
+        _sizes = catalog.get_catalog().get(
+            (*self.scope, "sizes"), self.provisioner.list_sizes
+        )
+        _sizes = [
+            catalog.bind(size, self.provisioner)
+            for size in _sizes
+            if size.id == instance_size or size.name == instance_size
+        ]
+        if not _sizes:
             raise ProvisionException(
                 f"Could not locate instance size for {instance_size}"
             )
+        return _sizes
 
     def image(self, runs_on: str) -> NodeImage:
         """Gets a single image from registry of provider"""
-        return self.provisioner.get_image(runs_on)
+        return self.cached(
+            "image", lambda: self.provisioner.get_image(runs_on), runs_on
+        )
 
     def images(self, location: t.Optional[NodeLocation] = None) -> list[NodeImage]:
-        return self.provisioner.list_images(location)
+        return self.cached(
+            "images",
+            lambda: self.provisioner.list_images(location),
+            location.id if location else "",
+        )
 
     @retry(delay=5, jitter=(1, 5), tries=5, logger=None)
     def _create_node(self, **kwargs: dict[str, object]) -> MachineModel:
         _opts = kwargs.copy()
         node = self.provisioner.create_node(**_opts)  # type: ignore
         node = self.provisioner.wait_until_running(
-            nodes=[node], wait_period=5, timeout=300
+            nodes=[node], wait_period=5, timeout=timeouts.remaining(300)
         )[0][0]
         if not node.id:
             node.id = str(uuid.uuid4())
-        cache = db.cache_path()
         machine = MachineModel(
             layout=self.layout,
             node=node,
         )
-        cache[node.id] = db.model_as_pickle(machine)
+        db.store().put(machine)
         return machine
 
+    def _store(self, nodes: list[Node]) -> list[MachineModel]:
+        """Records created nodes in a single state write
+
+        Args:
+            nodes: nodes returned by the provider, failed ones are skipped
+
+        Returns:
+            Machines recorded
+        """
+        machines = []
+        for node in nodes:
+            if not getattr(node, "id", None):
+                log.error(
+                    f"Failed to create node {node.name}: ({getattr(node, 'code', '')}) {getattr(node, 'error', '')}"
+                )
+                continue
+            machines.append(MachineModel(layout=self.layout, node=node))
+        with db.store().batch() as batch:
+            for machine in machines:
+                batch.put(machine)
+        if len(machines) < self.layout.scale:
+            log.warning(
+                f"Created {len(machines)} of {self.layout.scale} nodes for {self.layout.name}"
+            )
+        return machines
+
     def list_nodes(self, **kwargs: dict[str, object]) -> list[Node]:
         return self.provisioner.list_nodes(**kwargs)
 
@@ -174,6 +266,10 @@ class AWSProvisioner(BaseProvisioner):
             "region": self.env.get("AWS_REGION", "us-east-2"),
         }
 
+    @property
+    def scope(self) -> tuple[str, ...]:
+        return ("aws", self.options["region"])
+
     @retry(delay=5, tries=10, jitter=(5, 25), logger=None)
     def connect(self) -> NodeDriver:
         aws = get_driver(Provider.EC2)
@@ -185,8 +281,29 @@ class AWSProvisioner(BaseProvisioner):
         if not any(kp.name == self.layout.name for kp in self.list_key_pairs()):
             self.create_keypair(self.layout.name, str(self.layout.ssh_public_key))
 
-    def cleanup(self, node: Node, **kwargs: dict[str, object]) -> bool:
-        pass
+    def cleanup(self) -> bool:
+        if self.layout.ports:
+            self.delete_firewall(self.layout.name)
+        for key_pair in self.list_key_pairs():
+            if key_pair.name == self.layout.name:
+                self.delete_key_pair(key_pair)
+        return True
+
+    def destroy(self, nodes: list[Node]) -> list[bool]:
+        # TerminateInstances takes many instance ids, libcloud only sends one
+        driver: EC2NodeDriver = self.provisioner  # type: ignore
+        states: dict[str, str] = {}
+        for start in range(0, len(nodes), TERMINATE_BATCH):
+            params = {"Action": "TerminateInstances"}
+            for idx, node in enumerate(nodes[start : start + TERMINATE_BATCH], 1):
+                params[f"InstanceId.{idx}"] = node.id
+            res = driver.connection.request(driver.path, params=params).object
+            for item in findall(res, "instancesSet/item", EC2_NAMESPACE):
+                instance_id = findtext(item, "instanceId", EC2_NAMESPACE)
+                states[instance_id] = findtext(item, "currentState/name", EC2_NAMESPACE)
+        return [
+            states.get(node.id) in ("shutting-down", "terminated") for node in nodes
+        ]
 
     def image(self, runs_on: str) -> NodeImage:
         if runs_on.startswith("ami-"):
@@ -207,8 +324,11 @@ class AWSProvisioner(BaseProvisioner):
                 name, ingress, egress, "0.0.0.0/0", "tcp"
             )
 
+    @retry(delay=5, jitter=(1, 5), tries=15, logger=None)
     def delete_firewall(self, name: str) -> None:
-        pass
+        """Deletes the security group, retried until its instances are gone"""
+        if any(sg.name == name for sg in self.provisioner.ex_get_security_groups()):  # type: ignore
+            self.provisioner.ex_delete_security_group_by_name(name)  # type: ignore
 
     def create(self) -> list[MachineModel] | None:
         pub_key = Path(self.layout.ssh_public_key).expanduser().read_text()
@@ -234,37 +354,30 @@ class AWSProvisioner(BaseProvisioner):
             else "",
             ex_terminate_on_shutdown=True,
         )
-        tags = {}
 
         # Store some metadata for helping with cleanup
         now = datetime.datetime.utcnow().strftime("%Y-%m-%d")
         if self.layout.tags:
             self.layout.tags.append(now)
             self.layout.tags.append(f"user-{os.environ.get('USER', 'ogc')}")
-            tags["created"] = now
-            tags["user_tag"] = f"user-{os.environ.get('USER', 'ogc')}"
-            # Store some extra metadata similar to what other projects use
-            epoch = str(datetime.datetime.now().timestamp())
-            tags["created_date"] = epoch
-            tags["environment"] = "ogc"
-            tags["repo"] = "ogc"
-
-        node = self.provisioner.create_node(**opts)  # type: ignore
-        _machines = []
-        machine_cache_p = db.cache_path() / node.id
-        node_state_p = Path(f"{machine_cache_p.resolve()}.state")
-        node_state_p.write_bytes(db.model_as_pickle(node))
-        machine = MachineModel(
-            layout=self.layout,
-            instance_name=node.name,
-            instance_id=node.id,
-            instance_state=node.state,
-            public_ip=node.public_ips[0],
-            private_ip=node.private_ips[0],
-            remote_state_file=node_state_p.resolve(),
-        )
-        _machines.append(machine)
-        return _machines if _machines else None
+
+        # A single RunInstances call launches every node of the layout
+        _nodes = self.provisioner.create_node(**opts)  # type: ignore
+        if isinstance(_nodes, Node):
+            _nodes = [_nodes]
+        # Public addresses are only assigned once the nodes are running
+        _nodes = [
+            node
+            for node, _ in self.provisioner.wait_until_running(
+                nodes=_nodes, wait_period=5, timeout=timeouts.remaining(600)
+            )
+        ]
+        # RunInstances tags every instance with the layout name, each node is
+        # named like GCE bulk created nodes instead so they can be told apart,
+        # locally only, tagging them would be one more call per node
+        for idx, node in enumerate(sorted(_nodes, key=lambda node: node.id)):
+            node.name = f"{self.layout.name}-{idx:03}"
+        return self._store(_nodes) or None
 
     def node(self, **kwargs: dict[str, object]) -> Node:
         instance_id = kwargs.get("instance_id", None)
@@ -298,12 +411,19 @@ class GCEProvisioner(BaseProvisioner):
             "datacenter": self.env.get("GOOGLE_DATACENTER", ""),
         }
 
+    @property
+    def scope(self) -> tuple[str, ...]:
+        return ("google", self.options["project"], self.options["datacenter"])
+
     def connect(self) -> NodeDriver:
         gce = get_driver(Provider.GCE)
 
         driver = gce(**self.options)
         try:
-            _has_locations = driver.list_locations()
+            # Checks the credentials once per project and zone, not per layout
+            _has_locations = catalog.get_catalog().get(
+                (*self.scope, "locations"), driver.list_locations
+            )
             if not _has_locations:
                 log.error("Could not connect to provider.")
         except Exception:
@@ -313,25 +433,57 @@ class GCEProvisioner(BaseProvisioner):
         )
         return driver
 
-    def destroy(self, nodes: list[Node]) -> bool:
-        _nodes = self.provisioner.ex_destroy_multiple_nodes(
-            node_list=[node for node in nodes], destroy_boot_disk=True
-        )  # type: ignore
-        self.delete_firewall(str(self.layout.name))
-        return all([node is True for node in _nodes])
+    def destroy(self, nodes: list[Node]) -> list[bool]:
+        # libcloud would delete every boot disk, failing the nodes whose disk
+        # was auto deleted with them, the disks left are deleted afterwards
+        _nodes = self.provisioner.ex_destroy_multiple_nodes(  # type: ignore
+            node_list=nodes, destroy_boot_disk=False
+        )
+        destroyed = [node is True for node in _nodes]
+        self.delete_disks(
+            [node.extra.get("boot_disk") for node, ok in zip(nodes, destroyed) if ok]
+        )
+        return destroyed
+
+    def delete_disks(self, disks: list[StorageVolume | None]) -> None:
+        """Deletes the boot disks that outlived their node
+
+        Disks created with auto delete are already gone, the disks of the
+        project are listed once so only the others are deleted.
+        """
+        _disks = {disk.name: disk for disk in disks if disk}
+        if not _disks:
+            return
+        response = self.provisioner.connection.request_aggregated_items("disks")  # type: ignore
+        left = {
+            disk["name"]
+            for zone in response.get("items", {}).values()
+            for disk in zone.get("disks", [])
+        }
+        for name in sorted(left & _disks.keys()):
+            try:
+                self.provisioner.destroy_volume(_disks[name])
+            except GoogleBaseError as e:
+                log.error(f"Error deleting boot disk {name}: {e}")
 
     def setup(self) -> None:
         tags = self.layout.tags or []
         if self.layout.ports:
             self.create_firewall(self.layout.name, self.layout.ports, tags)
 
-    def cleanup(self, node: MachineModel, **kwargs: t.Mapping[str, t.Any]) -> bool:
+    def cleanup(self) -> bool:
+        if self.layout.ports:
+            self.delete_firewall(self.layout.name)
         return True
 
     def image(self, runs_on: str) -> NodeImage:
         # Pull from partial first
         try:
-            partial_image: NodeImage = self.provisioner.ex_get_image_from_family(runs_on)  # type: ignore
+            partial_image: NodeImage = self.cached(
+                "image-family",
+                lambda: self.provisioner.ex_get_image_from_family(runs_on),  # type: ignore
+                runs_on,
+            )
             if partial_image:
                 return partial_image
         except ResourceNotFoundError:
@@ -361,7 +513,11 @@ class GCEProvisioner(BaseProvisioner):
         elif runs_on.startswith("windows"):
             request_endpoint = image_family_endpoint % ("windows-cloud", runs_on)
 
-        return self.provisioner.ex_get_image_from_family(request_endpoint)
+        return self.cached(
+            "image-family",
+            lambda: self.provisioner.ex_get_image_from_family(request_endpoint),  # type: ignore
+            str(request_endpoint),
+        )
 
     def create_firewall(self, name: str, ports: list[str], tags: list[str]) -> None:
         ports = [port.split(":")[0] for port in ports]
@@ -389,7 +545,7 @@ class GCEProvisioner(BaseProvisioner):
     def list_firewalls(self) -> list[str]:
         return self.provisioner.ex_list_firewalls()  # type: ignore
 
-    def create(self) -> None:
+    def create(self) -> list[MachineModel] | None:
         image = self.image_from_family(self.layout.runs_on)
         if not image and not self.layout.username:
             raise ProvisionException(
@@ -441,38 +597,24 @@ class GCEProvisioner(BaseProvisioner):
             self.layout.tags.append("repo-ogc")
 
         opts = dict(
-            name=self.layout.name,
+            base_name=self.layout.name,
             size=size,
-            image=self.image_from_family(self.layout.runs_on),
+            image=image,
+            number=self.layout.scale,
             ex_metadata=ex_metadata,
             ex_tags=self.layout.tags,
             ex_labels=self.layout.labels,
             ex_disk_type="pd-ssd",
             ex_disk_size=100,
             ex_preemptible=os.environ.get("OGC_ENABLE_SPOT", False),
+            timeout=int(timeouts.remaining(600)),
         )
-        try:
-            _nodes = [self.provisioner.create_node(**opts)]  # type: ignore
-        except ResourceNotFoundError:
-            log.error("Failed to create node", exc_info=True)
-            # Usually a name clash, 12/8/23 this shouldnt happen any longer
-            # keeping here just in case.
-            opts["name"] = f"{self.layout.name}-1"
-            _nodes = [self.provisioner.create_node(**opts)]  # type: ignore
+        # Inserts every node of the layout and polls them together, failed
+        # inserts come back as GCEFailedNode instead of raising
+        _nodes = self.provisioner.ex_create_multiple_nodes(**opts)  # type: ignore
         if not _nodes:
             log.error("Could not create nodes")
-        for node in _nodes:
-            if not hasattr(node, "id"):
-                log.error(
-                    f"Failed to create node {node.name}: ({node.code}) {node.error}"
-                )
-            cache = db.cache_path()
-            machine = MachineModel(
-                layout=self.layout,
-                node=node,
-            )
-            cache[node.id] = db.model_as_pickle(machine)
-        return None
+        return self._store(_nodes) or None
 
     def node(self, **kwargs: dict[str, object]) -> Node | None:
         _nodes = self.provisioner.list_nodes()
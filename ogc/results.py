@@ -0,0 +1,139 @@
+"""Aggregated results of commands run across machines
+
+Nodes whose output hashes the same are grouped together, only the output of
+the first node of each group is kept, so a result set of a thousand nodes
+printing the same thing holds a single copy of it.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import Counter
+
+import rich.console
+from attrs import define, field
+
+from ogc.models.actions import ActionModel
+
+# Number of node names listed in a group header before eliding the rest
+MAX_NAMES = 8
+
+
+@define
+class OutputGroup:
+    """Nodes that produced identical output
+
+    Attributes:
+        digest: hash of the full stdout and stderr
+        out: trailing stdout of the first node in the group
+        err: trailing stderr of the first node in the group
+        nodes: names of the nodes in the group
+        exit_codes: histogram of exit codes of the nodes in the group
+    """
+
+    digest: str
+    out: str
+    err: str
+    nodes: list[str] = field(factory=list)
+    exit_codes: Counter = field(factory=Counter)
+
+
+@define
+class ResultSet:
+    """Results of a command across machines
+
+    A result set is truthy when every node succeeded.
+
+    Attributes:
+        cmd: command that was executed
+        groups: output groups keyed by digest
+        exit_codes: histogram of exit codes of all nodes
+        failed: names of the nodes with a non-zero exit code
+        cancelled: names of the nodes that were stopped or never started
+        timed_out: names of the nodes that ran past their deadline
+    """
+
+    cmd: str
+    groups: dict[str, OutputGroup] = field(factory=dict)
+    exit_codes: Counter = field(factory=Counter)
+    failed: list[str] = field(factory=list)
+    cancelled: list[str] = field(factory=list)
+    timed_out: list[str] = field(factory=list)
+    _lock: threading.Lock = field(factory=threading.Lock, repr=False, eq=False)
+
+    def add(self, action: ActionModel, digest: str) -> None:
+        """Records the result of a node
+
+        Args:
+            action: completed action of the node
+            digest: hash of the node's full output, see `NodeOutput.digest`
+        """
+        name = str(action.machine.instance_name)
+        with self._lock:
+            group = self.groups.get(digest)
+            if group is None:
+                group = self.groups[digest] = OutputGroup(
+                    digest=digest, out=action.out, err=action.err
+                )
+            group.nodes.append(name)
+            group.exit_codes[action.exit_code] += 1
+            self.exit_codes[action.exit_code] += 1
+            if action.exit_code != 0:
+                self.failed.append(name)
+
+    @property
+    def total(self) -> int:
+        """Number of nodes"""
+        return sum(self.exit_codes.values())
+
+    @property
+    def ok(self) -> bool:
+        """Whether every node succeeded"""
+        return (
+            self.total > 0
+            and not self.failed
+            and not self.cancelled
+            and not self.timed_out
+        )
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+    def __len__(self) -> int:
+        return self.total
+
+    def sorted_groups(self) -> list[OutputGroup]:
+        """Groups, largest first"""
+        return sorted(self.groups.values(), key=lambda group: -len(group.nodes))
+
+    def print_summary(self, console: rich.console.Console | None = None) -> None:
+        """Prints the output groups followed by the exit code histogram"""
+        con = console or rich.console.Console()
+        for group in self.sorted_groups():
+            names = ", ".join(group.nodes[:MAX_NAMES])
+            if len(group.nodes) > MAX_NAMES:
+                names += f" (+{len(group.nodes) - MAX_NAMES} more)"
+            codes = ", ".join(f"{code}" for code in sorted(group.exit_codes))
+            con.rule(
+                f"[bold]{len(group.nodes)}[/] node(s) | exit {codes} | {names}",
+                align="left",
+                style="yellow",
+            )
+            if group.out:
+                con.out(group.out.rstrip("\n"), highlight=False)
+            if group.err:
+                con.out(group.err.rstrip("\n"), style="red", highlight=False)
+        histogram = ", ".join(
+            f"[{'green' if code == 0 else 'red'}]exit {code}[/]: {count}"
+            for code, count in sorted(self.exit_codes.items())
+        )
+        for label, nodes in [
+            ("timed out", self.timed_out),
+            ("cancelled", self.cancelled),
+        ]:
+            if nodes:
+                histogram += f" | [yellow]{label}[/]: {len(nodes)}"
+        con.print(
+            f"'{self.cmd}' on {self.total} node(s), "
+            f"{len(self.groups)} distinct output(s) | {histogram}"
+        )
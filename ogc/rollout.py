@@ -0,0 +1,330 @@
+"""Rolling execution across machines
+
+Nodes are worked through in batches, optionally starting with a small canary
+batch. Once more nodes have failed than the failure budget allows, the nodes
+still running are killed and the remaining batches are never started. Nodes
+running past their own deadline or the rollout's are killed and reported as
+timed out.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import itertools
+import math
+import time
+import typing as t
+
+import gevent
+import structlog
+from attrs import define, field
+from gevent.pool import Pool
+
+from ogc import timeouts
+from ogc.limiter import AdaptiveLimiter
+
+log = structlog.getLogger()
+
+N = t.TypeVar("N")
+
+
+@define
+class RolloutReport(t.Generic[N]):
+    """Outcome of a rollout
+
+    Attributes:
+        succeeded: number of nodes that succeeded
+        failed: number of nodes that failed
+        cancelled: nodes that were killed or never started
+        timed_out: nodes that were killed for running past a deadline
+        batches: number of batches started
+        aborted: why the rollout stopped early, if it did
+    """
+
+    succeeded: int = 0
+    failed: int = 0
+    cancelled: list[N] = field(factory=list)
+    timed_out: list[N] = field(factory=list)
+    batches: int = 0
+    aborted: str | None = None
+
+
+@define
+class Rollout:
+    """How work is staged across nodes
+
+    Args:
+        batch_size: number of nodes per batch
+        batch_percent: size of a batch as a percentage of all nodes
+        canary: number of nodes in a first batch that has to fully succeed
+        max_failures: failures tolerated before the rollout is aborted
+        node_timeout: seconds a single node may take
+        timeout: seconds the whole rollout may take
+    """
+
+    batch_size: int | None = None
+    batch_percent: float | None = None
+    canary: int = 0
+    max_failures: int | None = None
+    node_timeout: float | None = timeouts.NODE_TIMEOUT
+    timeout: float | None = timeouts.TIMEOUT
+
+    def batches(self, nodes: t.Iterable[N]) -> t.Iterator[t.Iterable[N]]:
+        """Splits nodes into batches
+
+        Without a batch size all nodes, past the canary, form a single batch
+        that is consumed lazily. A percentage needs the node count so the
+        nodes are read upfront in that case only.
+        """
+        size = self.batch_size
+        if self.batch_percent:
+            nodes = list(nodes)
+            size = max(1, math.ceil(len(nodes) * self.batch_percent / 100))
+        it = iter(nodes)
+        if self.canary:
+            yield list(itertools.islice(it, self.canary))
+        if not size:
+            yield it
+            return
+        while batch := list(itertools.islice(it, size)):
+            yield batch
+
+    def run(
+        self, nodes: t.Iterable[N], fn: t.Callable[[N], bool], pool: Pool
+    ) -> RolloutReport[N]:
+        """Runs `fn` for every node, one batch at a time
+
+        Args:
+            nodes: nodes to run on
+            fn: work to do on a node, returns whether it succeeded
+            pool: pool or scheduler lane bounding how many nodes run at once,
+                a greenlet returns whether its node succeeded or the error it
+                failed with
+
+        Returns:
+            Report of the rollout
+        """
+        report: RolloutReport[N] = RolloutReport()
+        running: dict[gevent.Greenlet, N] = {}
+        killed: set[gevent.Greenlet] = set()
+        end = time.monotonic() + self.timeout if self.timeout else None
+
+        def _left() -> float | None:
+            return max(end - time.monotonic(), 0) if end else None
+
+        def _abort(reason: str, expired: bool = False) -> None:
+            if report.aborted:
+                return
+            report.aborted = reason
+            log.error("Aborting rollout", reason=reason)
+            current = gevent.getcurrent()
+            victims = [g for g in running if g is not current and not g.dead]
+            killed.update(victims)
+            (report.timed_out if expired else report.cancelled).extend(
+                running[g] for g in victims
+            )
+            gevent.killall(victims, block=False)
+
+        def _run(node: N, budget: int | None) -> bool | BaseException:
+            # The node's deadline never outlives the rollout's
+            limits = [x for x in (self.node_timeout, _left()) if x is not None]
+            try:
+                with timeouts.deadline(min(limits, default=None)):
+                    ok = fn(node)
+            except timeouts.NodeTimeout as exc:
+                log.error("Node timed out", node=getattr(node, "name", node))
+                if gevent.getcurrent() not in killed:
+                    report.timed_out.append(node)
+                ok = exc
+            except Exception as exc:
+                log.error("Node failed", exc_info=True)
+                ok = exc
+            if ok and not isinstance(ok, BaseException):
+                report.succeeded += 1
+                return ok
+            report.failed += 1
+            if budget is not None and report.failed > budget:
+                _abort(f"{report.failed} failure(s), budget is {budget}")
+            # Errors are handed to the pool, an adaptive one backs off on them
+            return ok
+
+        for index, batch in enumerate(self.batches(nodes)):
+            it = iter(batch)
+            if report.aborted:
+                report.cancelled.extend(it)
+                continue
+            report.batches += 1
+            canary = index == 0 and bool(self.canary)
+            # The canary has to succeed on every node
+            budget = report.failed if canary else self.max_failures
+            for node in it:
+                # Wait for a free slot first, the rollout may abort meanwhile
+                pool.wait_available(timeout=_left())
+                if end and not _left():
+                    _abort(f"timed out after {self.timeout}s", expired=True)
+                if report.aborted:
+                    report.cancelled.append(node)
+                    continue
+                try:
+                    # Waiting for a slot of a keyed budget is bounded as well
+                    with timeouts.deadline(_left(), interrupt=False):
+                        greenlet = pool.spawn(_run, node, budget)
+                except timeouts.NodeTimeout:
+                    log.error("Node timed out", node=getattr(node, "name", node))
+                    report.timed_out.append(node)
+                    report.failed += 1
+                    _abort("timed out waiting for a slot", expired=True)
+                    continue
+                running[greenlet] = node
+                greenlet.link(lambda g: running.pop(g, None))
+            gevent.joinall(list(running), timeout=_left())
+            if any(not g.dead for g in running):
+                _abort(f"timed out after {self.timeout}s", expired=True)
+                gevent.joinall(list(running))
+            log.info(
+                "Batch complete",
+                batch=index + 1,
+                canary=canary,
+                succeeded=report.succeeded,
+                failed=report.failed,
+            )
+        if hasattr(pool, "report"):
+            for budget in pool.report():
+                log.info("Concurrency", **budget)
+        return report
+
+    async def run_async(
+        self,
+        nodes: t.Iterable[N],
+        fn: t.Callable[[N], bool],
+        limiter: t.Callable[[N], AdaptiveLimiter] | None = None,
+        executor: concurrent.futures.Executor | None = None,
+    ) -> RolloutReport[N]:
+        """Runs `fn` for every node in worker threads, one batch at a time
+
+        Same as `run` for asyncio. `fn` blocks so it runs in a thread, which
+        can't be interrupted: a node past its deadline is reported as timed
+        out right away while its thread gives up on its next blocking call,
+        see `ogc.timeouts.remaining`.
+
+        Args:
+            nodes: nodes to run on
+            fn: work to do on a node, returns whether it succeeded
+            limiter: returns the limiter bounding how many nodes like this
+                one run at once, unbounded if None
+            executor: threads to run `fn` in, the loop's default if None
+
+        Returns:
+            Report of the rollout
+        """
+        loop = asyncio.get_running_loop()
+        report: RolloutReport[N] = RolloutReport()
+        running: dict[asyncio.Task, N] = {}
+        limiters: dict[asyncio.Task, AdaptiveLimiter] = {}
+        seen: dict[int, AdaptiveLimiter] = {}
+        end = time.monotonic() + self.timeout if self.timeout else None
+
+        def _left() -> float | None:
+            return max(end - time.monotonic(), 0) if end else None
+
+        def _abort(reason: str, expired: bool = False) -> None:
+            if report.aborted:
+                return
+            report.aborted = reason
+            log.error("Aborting rollout", reason=reason)
+            current = asyncio.current_task()
+            victims = [x for x in running if x is not current and not x.done()]
+            (report.timed_out if expired else report.cancelled).extend(
+                running[x] for x in victims
+            )
+            for victim in victims:
+                victim.cancel()
+
+        def _call(node: N, seconds: float | None) -> bool:
+            with timeouts.deadline(seconds, interrupt=False):
+                return fn(node)
+
+        async def _run(node: N, budget: int | None) -> bool | BaseException:
+            limits = [x for x in (self.node_timeout, _left()) if x is not None]
+            seconds = min(limits, default=None)
+            call = functools.partial(
+                contextvars.copy_context().run, _call, node, seconds
+            )
+            try:
+                ok = await asyncio.wait_for(
+                    loop.run_in_executor(executor, call), seconds
+                )
+            except (asyncio.TimeoutError, timeouts.NodeTimeout) as exc:
+                log.error("Node timed out", node=getattr(node, "name", node))
+                report.timed_out.append(node)
+                ok = exc
+            except Exception as exc:
+                log.error("Node failed", exc_info=True)
+                ok = exc
+            if node_limiter := limiters.get(asyncio.current_task()):
+                if isinstance(ok, BaseException):
+                    node_limiter.failure(ok)
+                else:
+                    node_limiter.success()
+            if ok and not isinstance(ok, BaseException):
+                report.succeeded += 1
+                return ok
+            report.failed += 1
+            if budget is not None and report.failed > budget:
+                _abort(f"{report.failed} failure(s), budget is {budget}")
+            return ok
+
+        async def _wait_available(node_limiter: AdaptiveLimiter | None) -> None:
+            while node_limiter and not report.aborted:
+                busy = [x for x, y in limiters.items() if y is node_limiter]
+                if len(busy) < node_limiter.limit or _left() == 0:
+                    return
+                await asyncio.wait(
+                    busy, timeout=_left(), return_when=asyncio.FIRST_COMPLETED
+                )
+
+        def _done(task: asyncio.Task) -> None:
+            running.pop(task, None)
+            limiters.pop(task, None)
+
+        for index, batch in enumerate(self.batches(nodes)):
+            it = iter(batch)
+            if report.aborted:
+                report.cancelled.extend(it)
+                continue
+            report.batches += 1
+            canary = index == 0 and bool(self.canary)
+            budget = report.failed if canary else self.max_failures
+            for node in it:
+                node_limiter = limiter(node) if limiter else None
+                await _wait_available(node_limiter)
+                if end and not _left():
+                    _abort(f"timed out after {self.timeout}s", expired=True)
+                if report.aborted:
+                    report.cancelled.append(node)
+                    continue
+                task = asyncio.ensure_future(_run(node, budget))
+                running[task] = node
+                if node_limiter:
+                    limiters[task] = node_limiter
+                    seen[id(node_limiter)] = node_limiter
+                task.add_done_callback(_done)
+            if running:
+                await asyncio.wait(list(running), timeout=_left())
+            if any(not x.done() for x in running):
+                _abort(f"timed out after {self.timeout}s", expired=True)
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+            log.info(
+                "Batch complete",
+                batch=index + 1,
+                canary=canary,
+                succeeded=report.succeeded,
+                failed=report.failed,
+            )
+        for used in seen.values():
+            log.info("Concurrency", **used.report())
+        return report
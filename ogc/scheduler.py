@@ -0,0 +1,322 @@
+"""Central task scheduler
+
+Every command submits its work here instead of to a pool of its own. Work is
+admitted against one of a few budgets:
+
+| Budget | Used for | Limit |
+| ------ | -------- | ----- |
+| `api` | provider API calls, one budget per provider | `OGC_API_MAX_WORKERS`, `OGC_API_MAX_WORKERS_<PROVIDER>` |
+| `ssh` | commands and scripts on machines | `OGC_MIN_WORKERS` to `OGC_MAX_WORKERS`, adaptive |
+| `transfer` | file uploads and downloads | `OGC_TRANSFER_MAX_WORKERS` |
+
+Each budget has its own adaptive limit, see `ogc.limiter`. Work waiting for a
+budget is admitted by priority, teardown first, and in submission order
+within a priority. Queue depths and wait times are kept for `report`.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import enum
+import heapq
+import itertools
+import os
+import time
+import typing as t
+
+import gevent
+import structlog
+from gevent.event import Event
+from gevent.pool import Group
+
+from ogc import limiter as _limiter
+from ogc import timeouts
+from ogc.limiter import AdaptiveLimiter
+
+log = structlog.getLogger()
+
+API_MAX_WORKERS = int(os.environ.get("OGC_API_MAX_WORKERS", 16))
+TRANSFER_MAX_WORKERS = int(os.environ.get("OGC_TRANSFER_MAX_WORKERS", 8))
+
+
+class Priority(enum.IntEnum):
+    """Priority classes, lower is admitted first"""
+
+    TEARDOWN = 0
+    PROVISION = 1
+    EXEC = 2
+    BACKGROUND = 3
+
+
+class Budget:
+    """Concurrency budget with a priority queue of waiters
+
+    Args:
+        name: name of the budget, eg. `api:google`
+        limiter: limiter deciding how much work may run at once
+    """
+
+    def __init__(self, name: str, limiter: AdaptiveLimiter):
+        self.name = name
+        self.limiter = limiter
+        self.active = 0
+        self._waiters: list[list[t.Any]] = []
+        self._seq = itertools.count()
+        self._changed = Event()
+        self.admitted = 0
+        self.queued = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def depth(self) -> int:
+        """Number of waiters"""
+        return sum(1 for entry in self._waiters if entry[2] is not None)
+
+    def _first_waiter(self) -> int | None:
+        while self._waiters and self._waiters[0][2] is None:
+            heapq.heappop(self._waiters)
+        return self._waiters[0][0] if self._waiters else None
+
+    def _wake(self) -> None:
+        while self.active < self.limiter.limit and self._first_waiter() is not None:
+            entry = heapq.heappop(self._waiters)
+            self.active += 1
+            entry[2].set()
+            entry[2] = None
+        self._changed.set()
+
+    def _admit(self, waited: float) -> None:
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def available(self, priority: int) -> bool:
+        """Whether work of `priority` would be admitted right away"""
+        first = self._first_waiter()
+        return self.active < self.limiter.limit and (first is None or first > priority)
+
+    def wait_available(self, priority: int, timeout: float | None = None) -> bool:
+        """Waits until work of `priority` would be admitted right away"""
+        end = time.monotonic() + timeout if timeout is not None else None
+        while not self.available(priority):
+            self._changed.clear()
+            left = None if end is None else end - time.monotonic()
+            if left is not None and left <= 0:
+                return False
+            self._changed.wait(left)
+        return True
+
+    def acquire(self, priority: int, timeout: float | None = None) -> bool:
+        """Takes a slot, waiting behind work of the same or higher priority
+
+        Returns:
+            False if the timeout passed before a slot was free
+        """
+        if self.available(priority):
+            self.active += 1
+            self._admit(0.0)
+            return True
+        started = time.monotonic()
+        event = Event()
+        entry = [priority, next(self._seq), event]
+        heapq.heappush(self._waiters, entry)
+        self.queued += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        try:
+            admitted = event.wait(timeout)
+        except BaseException:
+            admitted = event.is_set()
+            if admitted:
+                self.release()
+            entry[2] = None
+            raise
+        if not admitted:
+            # Not woken up, give up our place in the queue
+            entry[2] = None
+            return False
+        self._admit(time.monotonic() - started)
+        return True
+
+    def release(self) -> None:
+        self.active -= 1
+        self._wake()
+
+    def report(self) -> dict[str, t.Any]:
+        """Queue depths, wait times and the limit chosen"""
+        return {
+            "budget": self.name,
+            "limit": self.limiter.limit,
+            "active": self.active,
+            "queued": self.queued,
+            "max_depth": self.max_depth,
+            "avg_wait_ms": round(self.total_wait / self.admitted * 1000, 1)
+            if self.admitted
+            else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            **{k: v for k, v in self.limiter.report().items() if k != "concurrency"},
+        }
+
+
+class Lane:
+    """Work of a single kind submitted to a budget, usable as a gevent pool
+
+    Args:
+        scheduler: scheduler the work is submitted to
+        budget: budget kind, `api`, `ssh` or `transfer`
+        priority: priority of the work
+        key: budget key, eg. the provider, or a function returning it for
+            the first argument of the work
+    """
+
+    def __init__(
+        self,
+        scheduler: Scheduler,
+        budget: str,
+        priority: int,
+        key: str | t.Callable[[t.Any], str] | None = None,
+    ):
+        self.scheduler = scheduler
+        self.budget = budget
+        self.priority = priority
+        self.key = key
+        self.group = Group()
+        self.used: set[str] = set()
+
+    def _budget(self, args: tuple) -> Budget:
+        key = self.key(args[0]) if callable(self.key) else self.key
+        budget = self.scheduler.budget(self.budget, key)
+        self.used.add(budget.name)
+        return budget
+
+    def wait_available(self, timeout: float | None = None) -> bool:
+        """Waits for room in the budget, only known upfront without a key function"""
+        if callable(self.key):
+            return True
+        return self._budget(()).wait_available(self.priority, timeout)
+
+    def spawn(self, func: t.Callable, *args: t.Any, **kwargs: t.Any) -> gevent.Greenlet:
+        """Waits for a slot in the budget and runs `func` in a greenlet
+
+        Greenlets raising or returning an exception count as failures for the
+        budget's limiter, anything else as a completion.
+
+        Raises:
+            NodeTimeout: if the current deadline passed before a slot was free
+        """
+        budget = self._budget(args)
+        if not budget.acquire(self.priority, timeouts.remaining()):
+            raise timeouts.NodeTimeout()
+        greenlet = gevent.Greenlet(_tracked, budget.limiter, func, *args, **kwargs)
+        # Released once dead, even when killed before it got to run
+        greenlet.rawlink(lambda _: budget.release())
+        self.group.add(greenlet)
+        greenlet.start()
+        return greenlet
+
+    def join(self, timeout: float | None = None) -> bool:
+        return self.group.join(timeout)
+
+    def __len__(self) -> int:
+        return len(self.group)
+
+    def report(self) -> list[dict[str, t.Any]]:
+        """Reports of the budgets this lane used"""
+        return [self.scheduler.budgets[name].report() for name in sorted(self.used)]
+
+
+def _tracked(
+    limiter: AdaptiveLimiter, func: t.Callable, *args: t.Any, **kwargs: t.Any
+) -> t.Any:
+    try:
+        result = func(*args, **kwargs)
+    except gevent.GreenletExit:
+        raise
+    except BaseException as exc:
+        limiter.failure(exc)
+        raise
+    if isinstance(result, BaseException):
+        limiter.failure(result)
+    else:
+        limiter.success()
+    return result
+
+
+class Scheduler:
+    """Budgets shared by every command of the process"""
+
+    def __init__(self) -> None:
+        self.budgets: dict[str, Budget] = {}
+
+    @staticmethod
+    def _limiter(kind: str, key: str | None) -> AdaptiveLimiter:
+        if kind == "ssh":
+            return _limiter.get_limiter()
+        if kind == "api":
+            env = f"OGC_API_MAX_WORKERS_{key}".upper().replace("-", "_")
+            ceiling = int(os.environ.get(env, API_MAX_WORKERS))
+            return AdaptiveLimiter(floor=min(2, ceiling), ceiling=ceiling)
+        if kind == "transfer":
+            return AdaptiveLimiter(
+                floor=min(2, TRANSFER_MAX_WORKERS), ceiling=TRANSFER_MAX_WORKERS
+            )
+        raise ValueError(f"Unknown budget: {kind}")
+
+    def budget(self, kind: str, key: str | None = None) -> Budget:
+        """Returns the budget of a kind of work, per key if given"""
+        name = f"{kind}:{key}" if key else kind
+        if name not in self.budgets:
+            self.budgets[name] = Budget(name, self._limiter(kind, key))
+        return self.budgets[name]
+
+    def lane(
+        self,
+        budget: str,
+        priority: int = Priority.EXEC,
+        key: str | t.Callable[[t.Any], str] | None = None,
+    ) -> Lane:
+        """Returns a pool-like lane submitting work to a budget
+
+        Example:
+            ``` python
+            lane = scheduler.get_scheduler().lane("api", Priority.TEARDOWN, key="google")
+            lane.spawn(provisioner.destroy, nodes)
+            lane.join()
+            ```
+        """
+        return Lane(self, budget, priority, key)
+
+    @contextlib.contextmanager
+    def slot(
+        self, budget: str, priority: int = Priority.EXEC, key: str | None = None
+    ) -> t.Iterator[None]:
+        """Holds a slot of a budget for the duration of the block"""
+        _budget = self.budget(budget, key)
+        _budget.acquire(priority)
+        try:
+            yield
+        except gevent.GreenletExit:
+            raise
+        except BaseException as exc:
+            _budget.limiter.failure(exc)
+            raise
+        else:
+            _budget.limiter.success()
+        finally:
+            _budget.release()
+
+    def report(self) -> list[dict[str, t.Any]]:
+        """Reports of every budget used so far"""
+        return [self.budgets[name].report() for name in sorted(self.budgets)]
+
+
+_scheduler: Scheduler | None = None
+
+
+def get_scheduler() -> Scheduler:
+    """Returns the process wide scheduler"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler()
+    return _scheduler
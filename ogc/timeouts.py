@@ -0,0 +1,83 @@
+"""Deadlines for work done on machines
+
+A deadline is set for the greenlet working on a machine, the greenlet is
+interrupted with `NodeTimeout` once it passes. Blocking calls made on its
+behalf, SSH connects and commands or waiting on the provider, clamp their own
+timeouts to what is left with `remaining` so they give up in time as well.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import os
+import time
+import typing as t
+
+import gevent
+
+
+def _seconds(name: str) -> float | None:
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+# Seconds a single machine may take, unbounded if unset
+NODE_TIMEOUT = _seconds("OGC_NODE_TIMEOUT")
+
+# Seconds a whole command may take, unbounded if unset
+TIMEOUT = _seconds("OGC_TIMEOUT")
+
+# Exit code reported for commands that were interrupted, same as timeout(1)
+EXIT_CODE = 124
+
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "deadline", default=None
+)
+
+
+class NodeTimeout(gevent.Timeout):
+    """Raised in a greenlet that ran past its deadline"""
+
+
+def remaining(timeout: float | None = None) -> float | None:
+    """Seconds left before the current deadline
+
+    Args:
+        timeout: timeout the caller would use without a deadline
+
+    Returns:
+        The smaller of `timeout` and the time left, None if both are unbounded
+    """
+    end = _deadline.get()
+    if end is None:
+        return timeout
+    left = max(end - time.monotonic(), 0.0)
+    return left if timeout is None else min(timeout, left)
+
+
+@contextlib.contextmanager
+def deadline(seconds: float | None, interrupt: bool = True) -> t.Iterator[None]:
+    """Interrupts the block with `NodeTimeout` after `seconds`
+
+    Nested deadlines never extend an enclosing one.
+
+    Args:
+        seconds: time allowed, unbounded if None
+        interrupt: whether to interrupt the block, otherwise only the
+            blocking calls in it are clamped, eg. in a worker thread that
+            gevent can't interrupt
+    """
+    seconds = remaining(seconds)
+    if seconds is None:
+        yield
+        return
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        if interrupt:
+            with NodeTimeout(seconds):
+                yield
+        else:
+            yield
+    finally:
+        _deadline.reset(token)
@@ -0,0 +1,666 @@
+"""Bulk file transfers to and from machines
+
+Files are copied over SFTP with pipelined requests: writes are sent without
+waiting for each acknowledgement and reads are prefetched, so a copy isn't
+bound by the round trip time. Small files are spread over `STREAMS` SFTP
+sessions per machine, files larger than `CHUNK_SIZE` are split into chunks
+copied over `STREAMS` sessions at the same time.
+
+Copies are written to a `.ogc-part` file renamed into place once complete and
+get the modification time of their source, unchanged files are skipped the
+next time. Chunks are recorded as they are written so an interrupted copy of
+a large file resumes with the chunks it is missing.
+
+With compression every file is streamed through gzip over an exec channel
+instead, for compressible data on slow links. Those copies aren't chunked or
+resumed.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import math
+import os
+import posixpath
+import shlex
+import stat
+import threading
+import time
+import typing as t
+import zlib
+from fnmatch import fnmatch
+from pathlib import Path
+
+import structlog
+from attrs import define, field
+
+from ogc import connections, db
+from ogc.executor import get_executor
+from ogc.rollout import Rollout
+from ogc.scheduler import Priority
+
+if t.TYPE_CHECKING:
+    import paramiko
+
+    from ogc.models.machine import MachineModel
+
+log = structlog.getLogger()
+
+# Files larger than this are copied in chunks of this size
+CHUNK_SIZE = int(os.environ.get("OGC_TRANSFER_CHUNK_SIZE", 64 * 2**20))
+
+# SFTP sessions per machine
+STREAMS = int(os.environ.get("OGC_TRANSFER_STREAMS", 4))
+
+# gzip level of compressed transfers
+COMPRESS_LEVEL = int(os.environ.get("OGC_TRANSFER_COMPRESS_LEVEL", 6))
+
+# Seconds the chunks of an interrupted transfer are kept
+RESUME_TTL = int(os.environ.get("OGC_TRANSFER_RESUME_TTL", 7 * 86400))
+
+# Largest SFTP read or write request
+BLOCK_SIZE = 32768
+
+PART_SUFFIX = ".ogc-part"
+
+
+class TransferClient(t.Protocol):
+    """Opens SFTP sessions to and runs commands on a node"""
+
+    name: str
+
+    def sftp(self) -> t.ContextManager[paramiko.SFTPClient]:
+        ...
+
+    def run(self, cmd: str, **kwargs: t.Any) -> tuple[str, str, int]:
+        ...
+
+
+@define
+class Entry:
+    """File to copy
+
+    Attributes:
+        src: path of the source
+        dest: path of the copy
+        size: size of the source in bytes
+        mtime: modification time of the source
+        mode: permissions of the source
+    """
+
+    src: str
+    dest: str
+    size: int
+    mtime: int
+    mode: int
+
+
+@define
+class TransferReport:
+    """Outcome of the transfers of a machine
+
+    Attributes:
+        files: files copied
+        skipped: files left alone as the copy was unchanged
+        resumed: files whose interrupted copy was resumed
+        bytes: bytes sent or received, compressed if compression was used
+        elapsed: seconds the transfers took
+        failed: sources of the files that couldn't be copied
+    """
+
+    files: int = 0
+    skipped: int = 0
+    resumed: int = 0
+    bytes: int = 0
+    elapsed: float = 0.0
+    failed: list[str] = field(factory=list)
+
+
+def excluded(path: str, patterns: t.Iterable[str]) -> bool:
+    """Whether a relative path, or one of its directories, matches a pattern"""
+    parts = path.split("/")
+    return any(
+        fnmatch(path, pattern) or any(fnmatch(part, pattern) for part in parts)
+        for pattern in patterns
+    )
+
+
+def plan_push(src: Path, dest: str, exclude: t.Iterable[str] = ()) -> list[Entry]:
+    """Lists the files to push
+
+    Args:
+        src: local file or directory
+        dest: remote path, a file pushed to a path ending with `/` keeps its name
+        exclude: glob patterns of files and directories to leave out
+
+    Returns:
+        Files to copy
+    """
+
+    def _entry(path: Path, target: str) -> Entry:
+        _stat = path.stat()
+        return Entry(
+            str(path),
+            target,
+            _stat.st_size,
+            int(_stat.st_mtime),
+            stat.S_IMODE(_stat.st_mode),
+        )
+
+    if not src.is_dir():
+        return [_entry(src, dest + src.name if dest.endswith("/") else dest)]
+    entries = []
+    for path in sorted(src.rglob("*")):
+        rel = path.relative_to(src).as_posix()
+        if path.is_file() and not excluded(rel, exclude):
+            entries.append(_entry(path, f"{dest.rstrip('/')}/{rel}"))
+    return entries
+
+
+def plan_pull(
+    sftp: paramiko.SFTPClient, src: str, dest: Path, exclude: t.Iterable[str] = ()
+) -> list[Entry]:
+    """Lists the files to pull
+
+    Args:
+        sftp: session to the machine
+        src: remote file or directory
+        dest: local directory, the file or directory is copied into it
+        exclude: glob patterns of files and directories to leave out
+
+    Returns:
+        Files to copy
+    """
+
+    def _entry(path: str, attr: paramiko.SFTPAttributes, target: Path) -> Entry:
+        return Entry(
+            path,
+            str(target),
+            attr.st_size or 0,
+            int(attr.st_mtime or 0),
+            stat.S_IMODE(attr.st_mode or 0o644),
+        )
+
+    attr = sftp.stat(src)
+    dest = dest / posixpath.basename(src.rstrip("/"))
+    if not stat.S_ISDIR(attr.st_mode or 0):
+        return [_entry(src, attr, dest)]
+    entries = []
+    dirs = [""]
+    while dirs:
+        prefix = dirs.pop()
+        for attr in sorted(
+            sftp.listdir_attr(posixpath.join(src, prefix)), key=lambda a: a.filename
+        ):
+            rel = posixpath.join(prefix, attr.filename)
+            if excluded(rel, exclude):
+                continue
+            if stat.S_ISDIR(attr.st_mode or 0):
+                dirs.append(rel)
+            elif stat.S_ISREG(attr.st_mode or 0):
+                entries.append(_entry(posixpath.join(src, rel), attr, dest / rel))
+    return entries
+
+
+def _pump(src: t.BinaryIO, dest: t.BinaryIO, length: int) -> None:
+    remaining = length
+    while remaining:
+        data = src.read(min(BLOCK_SIZE, remaining))
+        if not data:
+            raise EOFError(f"{remaining} bytes short")
+        dest.write(data)
+        remaining -= len(data)
+
+
+def _workers(
+    client: TransferClient,
+    items: list[t.Any],
+    work: t.Callable[[paramiko.SFTPClient, t.Any], None],
+    streams: int,
+) -> None:
+    """Works through items over up to `streams` SFTP sessions
+
+    Stops at the first error and raises it.
+    """
+    pending = list(reversed(items))
+    errors: list[Exception] = []
+    lock = threading.Lock()
+
+    def _worker() -> None:
+        try:
+            with client.sftp() as sftp:
+                while True:
+                    with lock:
+                        if not pending or errors:
+                            return
+                        item = pending.pop()
+                    work(sftp, item)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [
+        threading.Thread(target=contextvars.copy_context().run, args=(_worker,))
+        for _ in range(min(max(streams, 1), len(items)))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _chunked(
+    client: TransferClient,
+    entry: Entry,
+    exists: bool,
+    create: t.Callable[[], None],
+    copy_chunk: t.Callable[[paramiko.SFTPClient, int, int], None],
+    resume: bool,
+    streams: int,
+) -> bool:
+    """Copies a file in chunks, skipping the ones an earlier attempt wrote
+
+    Args:
+        client: client of the machine
+        entry: file to copy
+        exists: whether the partial copy exists
+        create: creates an empty partial copy
+        copy_chunk: copies the chunk at an offset and of a length
+        resume: keep the chunks of an earlier attempt
+        streams: chunks copied at the same time
+
+    Returns:
+        Whether the copy was resumed
+    """
+    cache = db.transfers_path()
+    key = (client.name, entry.src, entry.dest)
+    identity = [entry.size, entry.mtime]
+    saved = cache.get(key) if resume and exists else None
+    done = set(saved["chunks"]) if saved and saved["identity"] == identity else set()
+    if not done:
+        cache.delete(key)
+        create()
+    else:
+        log.debug("Resuming transfer", machine=client.name, path=entry.src)
+
+    def _copy(sftp: paramiko.SFTPClient, idx: int) -> None:
+        offset = idx * CHUNK_SIZE
+        copy_chunk(sftp, offset, min(CHUNK_SIZE, entry.size - offset))
+        with cache.transact():
+            state = cache.get(key) or {"identity": identity, "chunks": []}
+            state["chunks"].append(idx)
+            cache.set(key, state, expire=RESUME_TTL)
+
+    chunks = math.ceil(entry.size / CHUNK_SIZE)
+    _workers(client, [idx for idx in range(chunks) if idx not in done], _copy, streams)
+    cache.delete(key)
+    return bool(done)
+
+
+def _put(
+    client: TransferClient,
+    sftp: paramiko.SFTPClient,
+    entry: Entry,
+    resume: bool,
+    streams: int,
+) -> bool:
+    part = entry.dest + PART_SUFFIX
+
+    def _create() -> None:
+        sftp.open(part, "wb").close()
+
+    def _copy_chunk(_sftp: paramiko.SFTPClient, offset: int, length: int) -> None:
+        with open(entry.src, "rb") as src, _sftp.open(part, "r+b") as dest:
+            dest.set_pipelined(True)
+            src.seek(offset)
+            dest.seek(offset)
+            _pump(src, dest, length)
+
+    resumed = False
+    if entry.size <= CHUNK_SIZE:
+        with open(entry.src, "rb") as src, sftp.open(part, "wb") as dest:
+            dest.set_pipelined(True)
+            _pump(src, dest, entry.size)
+    else:
+        resumed = _chunked(
+            client,
+            entry,
+            _remote_stat(sftp, part) is not None,
+            _create,
+            _copy_chunk,
+            resume,
+            streams,
+        )
+    sftp.chmod(part, entry.mode)
+    sftp.utime(part, (entry.mtime, entry.mtime))
+    sftp.posix_rename(part, entry.dest)
+    return resumed
+
+
+def _get(
+    client: TransferClient,
+    sftp: paramiko.SFTPClient,
+    entry: Entry,
+    resume: bool,
+    streams: int,
+) -> bool:
+    dest = Path(entry.dest)
+    part = dest.with_name(dest.name + PART_SUFFIX)
+
+    def _copy_chunk(_sftp: paramiko.SFTPClient, offset: int, length: int) -> None:
+        with _sftp.open(entry.src, "rb") as src, part.open("r+b") as _dest:
+            src.seek(offset)
+            src.prefetch(offset + length)
+            _dest.seek(offset)
+            _pump(src, _dest, length)
+
+    resumed = False
+    if entry.size <= CHUNK_SIZE:
+        with sftp.open(entry.src, "rb") as src, part.open("wb") as _dest:
+            src.prefetch(entry.size)
+            _pump(src, _dest, entry.size)
+    else:
+        resumed = _chunked(
+            client,
+            entry,
+            part.exists(),
+            part.touch,
+            _copy_chunk,
+            resume,
+            streams,
+        )
+    part.chmod(entry.mode)
+    os.utime(part, (entry.mtime, entry.mtime))
+    part.replace(dest)
+    return resumed
+
+
+def _put_compressed(client: TransferClient, entry: Entry) -> int:
+    sent = 0
+
+    def _stream() -> t.Iterator[bytes]:
+        nonlocal sent
+        gz = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+        with open(entry.src, "rb") as src:
+            for block in iter(lambda: src.read(2**20), b""):
+                data = gz.compress(block)
+                sent += len(data)
+                yield data
+        data = gz.flush()
+        sent += len(data)
+        yield data
+
+    dest = shlex.quote(entry.dest)
+    part = shlex.quote(entry.dest + PART_SUFFIX)
+    _, err, exit_code = client.run(
+        f"gzip -dc > {part} && chmod {entry.mode:o} {part}"
+        f" && touch -d @{entry.mtime} {part} && mv {part} {dest}",
+        stdin=_stream(),
+    )
+    if exit_code != 0:
+        raise OSError(f"Could not write {entry.dest}: {err.strip()}")
+    return sent
+
+
+def _get_compressed(client: TransferClient, entry: Entry) -> int:
+    dest = Path(entry.dest)
+    part = dest.with_name(dest.name + PART_SUFFIX)
+    received = 0
+    gz = zlib.decompressobj(31)
+    with part.open("wb") as _dest:
+
+        def _write(data: bytes) -> None:
+            nonlocal received
+            received += len(data)
+            _dest.write(gz.decompress(data))
+
+        _, err, exit_code = client.run(
+            f"gzip -{COMPRESS_LEVEL} -c < {shlex.quote(entry.src)}", on_stdout=_write
+        )
+        _dest.write(gz.flush())
+    if exit_code != 0:
+        part.unlink()
+        raise OSError(f"Could not read {entry.src}: {err.strip()}")
+    part.chmod(entry.mode)
+    os.utime(part, (entry.mtime, entry.mtime))
+    part.replace(dest)
+    return received
+
+
+def _remote_stat(
+    sftp: paramiko.SFTPClient, path: str
+) -> paramiko.SFTPAttributes | None:
+    try:
+        return sftp.stat(path)
+    except OSError:
+        return None
+
+
+def _makedirs(sftp: paramiko.SFTPClient, path: str, made: set[str]) -> None:
+    if path in ("", ".", "/") or path in made:
+        return
+    if _remote_stat(sftp, path) is None:
+        _makedirs(sftp, posixpath.dirname(path), made)
+        try:
+            sftp.mkdir(path)
+        except OSError:
+            # Made by another session in the meantime
+            if _remote_stat(sftp, path) is None:
+                raise
+    made.add(path)
+
+
+def _transfer(
+    client: TransferClient,
+    entries: t.Callable[[paramiko.SFTPClient], list[Entry]],
+    push: bool,
+    compress: bool,
+    resume: bool,
+    streams: int,
+) -> TransferReport:
+    """Copies files to or from a machine"""
+    report = TransferReport()
+    started = time.monotonic()
+    lock = threading.Lock()
+    made: set[str] = set()
+    listings: dict[str, dict[str, paramiko.SFTPAttributes]] = {}
+
+    def _remote_copy(
+        sftp: paramiko.SFTPClient, path: str
+    ) -> paramiko.SFTPAttributes | None:
+        # One listing per directory rather than a round trip per file
+        parent, name = posixpath.split(path)
+        if parent not in listings:
+            try:
+                listing = {
+                    attr.filename: attr for attr in sftp.listdir_attr(parent or ".")
+                }
+            except OSError:
+                listing = {}
+            else:
+                made.add(parent)
+            with lock:
+                listings[parent] = listing
+        return listings[parent].get(name)
+
+    def _copy(sftp: paramiko.SFTPClient, entry: Entry) -> None:
+        if push:
+            copy = _remote_copy(sftp, entry.dest)
+            size, mtime = (copy.st_size, copy.st_mtime) if copy else (None, None)
+        else:
+            dest = Path(entry.dest)
+            copy = dest.stat() if dest.exists() else None
+            size, mtime = (copy.st_size, copy.st_mtime) if copy else (None, None)
+        if size == entry.size and mtime is not None and int(mtime) == entry.mtime:
+            with lock:
+                report.skipped += 1
+            return
+        try:
+            if push:
+                _makedirs(sftp, posixpath.dirname(entry.dest), made)
+            else:
+                Path(entry.dest).parent.mkdir(parents=True, exist_ok=True)
+            resumed = False
+            if compress:
+                sent = (_put_compressed if push else _get_compressed)(client, entry)
+            else:
+                resumed = (_put if push else _get)(client, sftp, entry, resume, streams)
+                sent = entry.size
+        except Exception:
+            log.error(
+                "Transfer failed", machine=client.name, path=entry.src, exc_info=True
+            )
+            with lock:
+                report.failed.append(entry.src)
+            return
+        with lock:
+            report.files += 1
+            report.resumed += resumed
+            report.bytes += sent
+
+    with client.sftp() as sftp:
+        files = entries(sftp)
+    small = [entry for entry in files if compress or entry.size <= CHUNK_SIZE]
+    large = [entry for entry in files if not compress and entry.size > CHUNK_SIZE]
+    _workers(client, small, _copy, streams)
+    # Large files are spread over the sessions chunk by chunk instead
+    _workers(client, large, _copy, 1)
+    report.elapsed = time.monotonic() - started
+    return report
+
+
+def _run(
+    machines: t.Iterable[MachineModel],
+    src: str | Path,
+    entries: t.Callable[[TransferClient, paramiko.SFTPClient], list[Entry]],
+    push: bool,
+    compress: bool,
+    resume: bool,
+    streams: int,
+    rollout: Rollout | None,
+    client: t.Callable[[t.Any], TransferClient],
+) -> dict[str, TransferReport]:
+    reports: dict[str, TransferReport] = {}
+    started = time.monotonic()
+
+    def _node(_client: TransferClient) -> bool:
+        report = _transfer(
+            _client,
+            lambda sftp: entries(_client, sftp),
+            push,
+            compress,
+            resume,
+            streams,
+        )
+        reports[_client.name] = report
+        log.debug("Transferred files", machine=_client.name, **_summary(report))
+        return not report.failed
+
+    clients = [client(machine) for machine in machines]
+    get_executor().run(rollout or Rollout(), clients, _node, "transfer", Priority.EXEC)
+    for _client in clients:
+        # Nodes that errored, timed out or were cancelled
+        reports.setdefault(_client.name, TransferReport(failed=[str(src)]))
+    elapsed = time.monotonic() - started
+    sent = sum(report.bytes for report in reports.values())
+    log.info(
+        f"{'Pushed' if push else 'Pulled'} files on {len(reports)} node(s)",
+        files=sum(report.files for report in reports.values()),
+        skipped=sum(report.skipped for report in reports.values()),
+        failed=sum(len(report.failed) for report in reports.values()),
+        mb=round(sent / 2**20, 1),
+        mb_per_sec=round(sent / 2**20 / elapsed, 1) if elapsed else 0,
+    )
+    return reports
+
+
+def _summary(report: TransferReport) -> dict[str, t.Any]:
+    return {
+        "files": report.files,
+        "skipped": report.skipped,
+        "resumed": report.resumed,
+        "failed": len(report.failed),
+        "elapsed": round(report.elapsed, 2),
+    }
+
+
+def push(
+    machines: t.Iterable[MachineModel],
+    src: Path,
+    dest: str,
+    exclude: t.Iterable[str] = (),
+    compress: bool = False,
+    resume: bool = True,
+    streams: int = STREAMS,
+    rollout: Rollout | None = None,
+    client: t.Callable[[t.Any], TransferClient] = connections.PooledClient,
+) -> dict[str, TransferReport]:
+    """Copies local files to machines
+
+    Args:
+        machines: machines to copy to
+        src: local file or directory
+        dest: path on the machines, relative to the home directory
+        exclude: glob patterns of files and directories to leave out
+        compress: stream the files through gzip
+        resume: keep the chunks of interrupted copies
+        streams: SFTP sessions per machine
+        rollout: batches and timeouts, all machines at once if unset
+        client: returns the client of a machine
+
+    Returns:
+        Report of every machine, by name
+    """
+    files = plan_push(src, dest, exclude)
+    return _run(
+        machines,
+        src,
+        lambda _client, sftp: files,
+        True,
+        compress,
+        resume,
+        streams,
+        rollout,
+        client,
+    )
+
+
+def pull(
+    machines: t.Iterable[MachineModel],
+    src: str,
+    dest: Path,
+    exclude: t.Iterable[str] = (),
+    compress: bool = False,
+    resume: bool = True,
+    streams: int = STREAMS,
+    rollout: Rollout | None = None,
+    client: t.Callable[[t.Any], TransferClient] = connections.PooledClient,
+) -> dict[str, TransferReport]:
+    """Copies files from machines, into a directory per machine
+
+    Args:
+        machines: machines to copy from
+        src: file or directory on the machines, relative to the home directory
+        dest: local directory, files of a machine go to `dest/<name>`
+        exclude: glob patterns of files and directories to leave out
+        compress: stream the files through gzip
+        resume: keep the chunks of interrupted copies
+        streams: SFTP sessions per machine
+        rollout: batches and timeouts, all machines at once if unset
+        client: returns the client of a machine
+
+    Returns:
+        Report of every machine, by name
+    """
+    return _run(
+        machines,
+        src,
+        lambda _client, sftp: plan_pull(sftp, src, dest / _client.name, exclude),
+        False,
+        compress,
+        resume,
+        streams,
+        rollout,
+        client,
+    )
@@ -0,0 +1,3 @@
+# Importing ogc monkey patches the standard library, do it before the fixtures
+# in conftest import libcloud and with it ssl
+import ogc  # noqa: F401
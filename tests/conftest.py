@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import pytest
+from libcloud.compute.base import Node
+
+from ogc import db
+from ogc.models.layout import LayoutModel
+from ogc.models.machine import MachineModel
+
+
+def _machine(idx: int, tags: list[str], provider: str = "google") -> MachineModel:
+    layout = LayoutModel(
+        instance_size="e2-standard-4",
+        provider=provider,
+        remote_path="/home/ubuntu",
+        runs_on="ubuntu-2204-lts",
+        scale=1,
+        username="ubuntu",
+        ssh_private_key="~/.ssh/id_rsa_libcloud",
+        ssh_public_key="~/.ssh/id_rsa_libcloud.pub",
+        tags=tags,
+        labels={"team": "observability"},
+        ports=["22:22"],
+    )
+    node = Node(
+        id=str(idx),
+        name=f"node-{idx}",
+        state="running",
+        public_ips=[f"10.0.0.{idx}"],
+        private_ips=[f"192.168.0.{idx}"],
+        driver=None,
+    )
+    return MachineModel(layout=layout, node=node)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _store = db.store()
+    _store.put(_machine(1, ["ogc-worker", "ogc-manager"]))
+    _store.put(_machine(2, ["ogc-worker"]))
+    _store.put(_machine(3, ["ogc-worker"], provider="aws"))
+    return _store
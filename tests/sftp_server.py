@@ -0,0 +1,239 @@
+"""In-process SSH server on the loopback, serving a local directory
+
+Supports the SFTP subsystem and exec requests, which run in a shell in the
+served directory. Any username is accepted without authentication.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import os
+import posixpath
+import socket
+import subprocess
+import threading
+import typing as t
+from pathlib import Path
+
+import paramiko
+
+_KEY = paramiko.RSAKey.generate(2048)
+
+
+class _Handle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        paramiko.SFTPServer.set_file_attr(self.filename, attr)
+        return paramiko.SFTP_OK
+
+
+class _SFTP(paramiko.SFTPServerInterface):
+    def __init__(self, server, root: Path, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _path(self, path: str) -> str:
+        return str(self.root / path.lstrip("/"))
+
+    def _call(self, fn, *args):
+        try:
+            fn(*args)
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+        return paramiko.SFTP_OK
+
+    def canonicalize(self, path):
+        # The served directory is the root and the home of the session
+        return posixpath.normpath(posixpath.join("/", path))
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            attrs = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(
+                    os.stat(os.path.join(path, name))
+                )
+                attr.filename = name
+                attrs.append(attr)
+            return attrs
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, getattr(attr, "st_mode", None) or 0o666)
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, self._path(path))
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, self._path(oldpath), self._path(newpath))
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.replace, self._path(oldpath), self._path(newpath))
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self._path(path))
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self._path(path))
+
+    def chattr(self, path, attr):
+        return self._call(paramiko.SFTPServer.set_file_attr, self._path(path), attr)
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, root: Path):
+        self.root = root
+
+    def get_allowed_auths(self, username):
+        return "none"
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(
+            target=self._exec, args=(channel, command.decode()), daemon=True
+        ).start()
+        return True
+
+    def _exec(self, channel: paramiko.Channel, command: str) -> None:
+        proc = subprocess.Popen(
+            command,
+            shell=True,
+            cwd=self.root,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        def _stdin() -> None:
+            while data := channel.recv(32768):
+                proc.stdin.write(data)
+            proc.stdin.close()
+
+        def _stderr() -> None:
+            while data := proc.stderr.read1(32768):
+                channel.sendall_stderr(data)
+
+        threads = [threading.Thread(target=_stdin), threading.Thread(target=_stderr)]
+        for thread in threads:
+            thread.start()
+        while data := proc.stdout.read1(32768):
+            channel.sendall(data)
+        for thread in threads:
+            thread.join()
+        channel.send_exit_status(proc.wait())
+        channel.close()
+
+
+class LoopbackServer:
+    """SSH server serving a directory
+
+    Args:
+        root: directory served, the home of every user
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        self.transports: list[paramiko.Transport] = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(_KEY)
+            transport.set_subsystem_handler(
+                "sftp", paramiko.SFTPServer, _SFTP, self.root
+            )
+            transport.start_server(server=_Server(self.root))
+            self.transports.append(transport)
+
+    def close(self) -> None:
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class SFTPNode:
+    """Client of a node served by a `LoopbackServer`
+
+    Args:
+        name: name of the node
+        port: port the server listens on, eg. of a proxy in front of it
+    """
+
+    def __init__(self, name: str, port: int):
+        self.name = name
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.transport = paramiko.Transport(sock)
+        self.transport.connect()
+        self.transport.auth_none(name)
+
+    @contextlib.contextmanager
+    def sftp(self) -> t.Iterator[paramiko.SFTPClient]:
+        sftp = paramiko.SFTPClient.from_transport(self.transport)
+        try:
+            yield sftp
+        finally:
+            sftp.close()
+
+    def run(
+        self,
+        cmd: str,
+        on_stdout: t.Callable[[bytes], t.Any] | None = None,
+        stdin: t.Iterable[bytes] | None = None,
+    ) -> tuple[str, str, int]:
+        stdout, stderr = bytearray(), bytearray()
+        with self.transport.open_session() as channel:
+            channel.exec_command(cmd)
+            for chunk in stdin or ():
+                channel.sendall(chunk)
+            channel.shutdown_write()
+            while data := channel.recv(32768):
+                (on_stdout or stdout.extend)(data)
+            while data := channel.recv_stderr(32768):
+                stderr.extend(data)
+            exit_code = channel.recv_exit_status()
+        return stdout.decode(), stderr.decode(), exit_code
+
+    def close(self) -> None:
+        self.transport.close()
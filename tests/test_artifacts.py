@@ -0,0 +1,69 @@
+"""Tests for streaming artifact collection, against in-process SSH servers"""
+
+from __future__ import annotations
+
+import tarfile
+
+import pytest
+
+from ogc import artifacts
+from tests.sftp_server import LoopbackServer, SFTPNode
+
+
+@pytest.fixture
+def nodes(tmp_path):
+    servers, _nodes = [], {}
+    for idx in range(2):
+        home = tmp_path / f"node-{idx}"
+        (home / "logs/agent").mkdir(parents=True)
+        (home / "logs/agent/agent.log").write_text("started\n")
+        (home / "logs/agent/notes.txt").write_text("skip me")
+        (home / "results.xml").write_text(f"<testsuite id='{idx}'/>")
+        servers.append(LoopbackServer(home))
+        _nodes[home.name] = SFTPNode(home.name, servers[-1].port)
+    yield _nodes
+    for node in _nodes.values():
+        node.close()
+    for server in servers:
+        server.close()
+
+
+PATTERNS = ["logs/**/*.log", "*.xml", "missing.txt"]
+
+
+def test_per_node_directories(tmp_path, nodes):
+    dest = tmp_path / "artifacts"
+    reports = artifacts.pull(nodes, PATTERNS, dest=dest, client=nodes.get)
+    assert sorted(reports) == ["node-0", "node-1"]
+    assert sum(report.files for report in reports.values()) == 4
+    assert sum(report.duplicates for report in reports.values()) == 1
+    for name in nodes:
+        assert (dest / name / "logs/agent/agent.log").read_text() == "started\n"
+        assert not (dest / name / "logs/agent/notes.txt").exists()
+    # Identical logs share one copy
+    assert (dest / "node-0/logs/agent/agent.log").samefile(
+        dest / "node-1/logs/agent/agent.log"
+    )
+    assert (dest / "node-1/results.xml").read_text() == "<testsuite id='1'/>"
+
+
+def test_combined_archive(tmp_path, nodes):
+    archive = tmp_path / "soak.tar.gz"
+    artifacts.pull(nodes, PATTERNS, archive=archive, client=nodes.get)
+    with tarfile.open(archive) as tar:
+        members = {member.name: member for member in tar}
+        assert sorted(members) == [
+            f"{name}/{path}"
+            for name in ("node-0", "node-1")
+            for path in ("logs/agent/agent.log", "results.xml")
+        ]
+        assert sum(member.islnk() for member in members.values()) == 1
+        log = tar.extractfile(members["node-1/logs/agent/agent.log"])
+        assert log.read() == b"started\n"
+
+
+def test_no_matches(tmp_path, nodes):
+    reports = artifacts.pull(
+        nodes, ["nothing/*.log"], dest=tmp_path / "a", client=nodes.get
+    )
+    assert all(report.files == 0 for report in reports.values())
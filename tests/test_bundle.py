@@ -0,0 +1,81 @@
+"""Tests for content-addressed script bundles, against an in-process SSH server"""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from ogc import bundle
+from tests.sftp_server import LoopbackServer, SFTPNode
+
+
+class Node(SFTPNode):
+    """Counts the SFTP sessions opened"""
+
+    sessions = 0
+
+    def sftp(self):
+        self.sessions += 1
+        return super().sftp()
+
+
+class TarlessNode(Node):
+    """Node without tar"""
+
+    def run(self, cmd, **kwargs):
+        if cmd.startswith("tar "):
+            return "", "tar: command not found", 127
+        return super().run(cmd, **kwargs)
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = LoopbackServer(tmp_path)
+    yield server
+    server.close()
+
+
+def _bundle(greeting: str) -> bundle.Bundle:
+    _bundle = bundle.Bundle()
+    _bundle.add("01-setup", f"#!/bin/sh\necho {greeting}\n")
+    _bundle.add("teardown", "#!/bin/sh\necho bye\n")
+    _bundle.add(".ogc/services/agent/env", "A=1\n")
+    return _bundle
+
+
+def _archives(home: Path) -> list[Path]:
+    return list(home.rglob("*.tar.gz"))
+
+
+def test_pack_is_reproducible():
+    assert _bundle("hi").pack() == _bundle("hi").pack()
+    assert _bundle("hi").digest != _bundle("hello").digest
+
+
+def test_upload_skips_unchanged(tmp_path, server):
+    node = Node("node-0", server.port)
+    assert bundle.upload(node, _bundle("hi"))
+    assert node.run("./01-setup")[0] == "hi\n"
+    assert not _archives(tmp_path)
+
+    assert not bundle.upload(node, _bundle("hi"))
+    assert node.sessions == 1
+
+    # A second upload on the same connection lands in the home as well
+    assert bundle.upload(node, _bundle("hello"))
+    assert node.run("./01-setup")[0] == "hello\n"
+    assert bundle.remote_digest(node) == _bundle("hello").digest
+    assert not (tmp_path / ".ogc/.ogc").exists() and not _archives(tmp_path)
+    node.close()
+
+
+def test_upload_without_tar(tmp_path, server):
+    node = TarlessNode("node-0", server.port)
+    for greeting in ("hi", "hello"):
+        assert bundle.upload(node, _bundle(greeting))
+        assert node.run("./01-setup")[0] == f"{greeting}\n"
+    assert (tmp_path / ".ogc/services/agent/env").read_text() == "A=1\n"
+    assert bundle.remote_digest(node) == _bundle("hello").digest
+    assert not (tmp_path / ".ogc/.ogc").exists() and not _archives(tmp_path)
+    node.close()
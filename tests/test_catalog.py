@@ -0,0 +1,78 @@
+"""Tests for the provider catalog cache"""
+
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+from libcloud.compute.providers import get_driver
+from libcloud.compute.types import Provider
+
+from ogc import catalog
+from ogc.exceptions import ProvisionException
+from ogc.provision import BaseProvisioner
+
+
+class CountingDriver(get_driver(Provider.DUMMY)):
+    """Offline driver counting catalog calls"""
+
+    def __init__(self):
+        super().__init__(creds=0)
+        self.calls = 0
+
+    def list_sizes(self, location=None):
+        self.calls += 1
+        time.sleep(0.01)
+        return super().list_sizes(location)
+
+
+class DummyProvisioner(BaseProvisioner):
+    scope = ("dummy", "region-1")
+
+    def __init__(self, driver):
+        self.provisioner = driver
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(catalog, "_catalog", None)
+
+
+def test_sizes_fetched_once():
+    driver = CountingDriver()
+    provisioners = [DummyProvisioner(driver) for _ in range(30)]
+    threads = [
+        threading.Thread(target=prov.sizes, args=("Small",)) for prov in provisioners
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert driver.calls == 1
+    size = provisioners[0].sizes("Small")[0]
+    assert size.name == "Small" and size.driver is driver
+    with pytest.raises(ProvisionException):
+        provisioners[0].sizes("Gigantic")
+
+
+def test_disk_ttl_and_refresh():
+    driver = CountingDriver()
+    key = ("dummy", "region-1", "sizes")
+    catalog.Catalog().get(key, driver.list_sizes)
+    # Another process reads it from disk, without drivers
+    sizes = catalog.Catalog().get(key, driver.list_sizes)
+    assert driver.calls == 1 and all(size.driver is None for size in sizes)
+
+    _catalog = catalog.Catalog()
+    _catalog.refresh("dummy")
+    _catalog.get(key, driver.list_sizes)
+    assert driver.calls == 2
+
+    short = catalog.Catalog(ttl=0.05)
+    short.refresh()
+    short.get(key, driver.list_sizes)
+    time.sleep(0.1)
+    short.get(key, driver.list_sizes)
+    assert driver.calls == 4
@@ -0,0 +1,95 @@
+"""Tests for exec-scripts step records"""
+
+from __future__ import annotations
+
+import types
+
+import pytest
+from libcloud.compute.base import Node
+from libcloud.compute.ssh import SSHCommandTimeoutError
+from libcloud.compute.types import NodeState
+
+from ogc import bundle, catalog, checkpoints, db, deployer, timeouts
+from ogc.executor import get_executor
+from ogc.models.layout import LayoutModel
+from ogc.models.machine import MachineModel
+
+STEPS = [("01-setup", "a"), ("02-install", "b"), ("03-configure", "c")]
+
+
+def test_records_roundtrip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    checkpoints.record("1", "scripts", "01-setup", "a", 0, 1.23456)
+    checkpoints.record("1", "scripts", "02-install", "b", 2, 0.5)
+    checkpoints.record("2", "scripts", "01-setup", "a", 0, 1.0)
+    done = checkpoints.records("1", "scripts")
+    assert sorted(done) == ["01-setup", "02-install"]
+    assert done["01-setup"].ok and done["01-setup"].duration == 1.235
+    assert not done["02-install"].ok
+    assert checkpoints.records("1", "other") == {}
+    checkpoints.forget("1")
+    assert checkpoints.records("1", "scripts") == {}
+    assert checkpoints.records("2", "scripts")
+
+
+def test_pending(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    checkpoints.record("1", "s", "01-setup", "a", 0, 1)
+    checkpoints.record("1", "s", "02-install", "b", 1, 1)
+    checkpoints.record("1", "s", "03-configure", "old", 0, 1)
+    done = checkpoints.records("1", "s")
+    assert checkpoints.pending(STEPS, done) == ["01-setup", "02-install", "03-configure"]
+    assert checkpoints.pending(STEPS, done, resume=True) == ["02-install", "03-configure"]
+    assert checkpoints.pending(STEPS, done, from_step="03-configure") == ["03-configure"]
+    assert checkpoints.pending(STEPS, {}, resume=True) == [name for name, _ in STEPS]
+    with pytest.raises(ValueError):
+        checkpoints.pending(STEPS, done, from_step="04-missing")
+
+
+class TimingOutClient:
+    """SSH client whose steps run past their timeout"""
+
+    def run(self, cmd, timeout=None):
+        raise SSHCommandTimeoutError(cmd, timeout, stdout="partial")
+
+
+@pytest.mark.parametrize("executor", ["gevent", "asyncio"])
+def test_step_timeout_is_recorded(tmp_path, monkeypatch, executor):
+    """A step running past its timeout is recorded and reported as timed out"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(catalog, "_catalog", None)
+    scripts = tmp_path / "scripts"
+    scripts.mkdir()
+    (scripts / "01-setup").write_text("#!/bin/sh\nsleep 600\n")
+    layout = LayoutModel(
+        instance_size="Small",
+        provider="aws",
+        remote_path="/home/ubuntu",
+        runs_on="ami-1234",
+        scale=1,
+        username="ubuntu",
+        ssh_private_key=tmp_path / "id_rsa",
+        ssh_public_key=tmp_path / "id_rsa.pub",
+        tags=[],
+        labels={},
+        ports=[],
+    )
+    node = Node("i-1", "node", NodeState.RUNNING, ["10.0.0.1"], ["10.0.1.1"], None)
+    db.store().put(MachineModel(layout=layout, node=node))
+    monkeypatch.setattr(MachineModel, "ssh", lambda self: TimingOutClient())
+    monkeypatch.setattr(bundle, "upload", lambda *args, **kwargs: True)
+    reports = []
+    _run = get_executor(executor).run
+    monkeypatch.setattr(
+        deployer,
+        "get_executor",
+        lambda: types.SimpleNamespace(
+            run=lambda *args, **kwargs: reports.append(_run(*args, **kwargs))
+            or reports[-1]
+        ),
+    )
+
+    assert not deployer.exec_scripts(scripts)
+    assert [node.instance_id for node in reports[0].timed_out] == ["i-1"]
+    record = checkpoints.records("i-1", str(scripts.resolve()))["01-setup"]
+    assert record.exit_code == timeouts.EXIT_CODE
@@ -0,0 +1,124 @@
+"""Tests for the SSH connection pool"""
+
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import pytest
+
+from ogc import connections
+from ogc.connections import SSHPool
+
+
+class FakeTransport:
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+
+class FakeClient:
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.client = SimpleNamespace(get_transport=lambda: self.transport)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _machine(idx: int):
+    return SimpleNamespace(
+        name=f"machine-{idx}",
+        instance_id=str(idx),
+        username="ubuntu",
+        public_ip=f"10.0.0.{idx}",
+    )
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    _pool = SSHPool(idle_timeout=60)
+    connects = []
+
+    def _connect(machine):
+        connects.append(machine.instance_id)
+        return FakeClient()
+
+    monkeypatch.setattr(_pool, "_connect", _connect)
+    _pool.connects = connects
+    return _pool
+
+
+def test_reuses_connection(pool):
+    machine = _machine(1)
+    assert pool.client(machine) is pool.client(machine)
+    assert pool.client(_machine(2)) is not pool.client(machine)
+    assert pool.connects == ["1", "2"]
+
+
+def test_replaces_broken_connection(pool):
+    machine = _machine(1)
+    client = pool.client(machine)
+    client.transport.active = False
+    assert pool.client(machine) is not client
+    assert client.closed
+    assert pool.connects == ["1", "1"]
+
+
+def test_evicts_idle_connections(pool):
+    client = pool.client(_machine(1))
+    pool.idle_timeout = 0
+    pool.evict_idle()
+    assert client.closed
+    pool.client(_machine(1))
+    assert pool.connects == ["1", "1"]
+
+
+def test_keeps_connections_in_use(pool):
+    busy, idle = _machine(1), _machine(2)
+    client = pool.client(busy)
+    pool.idle_timeout = 0
+    with pool.hold(busy):
+        # A long command on one node, another node checked out meanwhile
+        pool.client(idle)
+        assert not client.closed
+        pool._connections[pool.key(busy)].last_used = 0
+    assert pool.connects == ["1", "2"]
+    pool.idle_timeout = 60
+    pool.evict_idle()
+    # Checked out long ago but released just now, so it isn't idle yet
+    assert not client.closed
+
+
+def test_close(pool):
+    clients = [pool.client(_machine(idx)) for idx in range(3)]
+    pool.close()
+    assert all(client.closed for client in clients)
+
+
+def test_ssh_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    machines = [
+        SimpleNamespace(
+            instance_name=f"ogc-{idx}",
+            public_ip=f"10.0.0.{idx}",
+            username="ubuntu",
+            layout=SimpleNamespace(ssh_private_key="~/.ssh/id_rsa"),
+        )
+        for idx in range(2)
+    ]
+    config = connections.write_ssh_config(machines)
+    contents = config.read_text()
+    assert "Host ogc-1\n    HostName 10.0.0.1\n    User ubuntu" in contents
+    assert "ControlMaster auto" in contents
+    mtime = config.stat().st_mtime_ns
+    assert connections.write_ssh_config(machines) == config
+    assert config.stat().st_mtime_ns == mtime
+    assert connections.openssh_args(machines[0], config) == [
+        "-F",
+        str(config),
+        "ogc-0",
+    ]
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import msgpack
+from libcloud.compute.base import NodeLocation, StorageVolume
+from libcloud.compute.providers import get_driver
+from libcloud.compute.types import NodeState, Provider
+
+from ogc import catalog, db
+from ogc.models.machine import MachineModel
+from tests.conftest import _machine
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def test_query_all(store) -> None:
+    """Test all machines are returned without filters"""
+    assert len(db.query()) == 3
+
+
+def test_query_indexed(store) -> None:
+    """Test lookups against the secondary indexes"""
+    assert [m.instance_id for m in db.query(tag="ogc-manager")] == ["1"]
+    assert len(db.query(tag="ogc-worker")) == 3
+    assert len(db.query(**{"label.team": "observability"})) == 3
+    assert db.query(instance_id="4") is None
+
+
+def test_query_filters_are_anded(store) -> None:
+    """Test that every filter must match and machines are not duplicated"""
+    machines = db.query(tag="ogc-worker", provider="google")
+    assert sorted(m.instance_id for m in machines) == ["1", "2"]
+    machines = db.query(provider="aws", instance_name="node-3")
+    assert [m.instance_id for m in machines] == ["3"]
+
+
+def test_delete_unindexes(store) -> None:
+    """Test removing a machine drops its index entries"""
+    store.delete("1")
+    assert db.query(tag="ogc-manager") is None
+    assert store.lookup("tag", "ogc-worker") == {"2", "3"}
+
+
+def test_reindex(store) -> None:
+    """Test index can be rebuilt from the stored records"""
+    store.cache.delete(("idx", "tag", "ogc-worker"))
+    store.reindex()
+    assert store.lookup("tag", "ogc-worker") == {"1", "2", "3"}
+
+
+def test_machine_encoding_roundtrip() -> None:
+    """Test machines survive the compact encoding without the libcloud node"""
+    machine = _machine(7, ["ogc-worker"])
+    data = db.machine_as_bytes(machine)
+    assert not db.is_legacy_record(data)
+    decoded = db.bytes_to_machine(data)
+    assert decoded == machine
+    assert decoded.node.id == "7"
+    assert decoded.node.public_ips == ["10.0.0.7"]
+
+
+def test_machine_node_rebuilt_for_driver_calls() -> None:
+    """Test the rebuilt node keeps the state, zone and boot disk drivers read"""
+    machine = _machine(7, ["ogc-worker"])
+    zone = NodeLocation(id="us-a", name="us-a", country="", driver=None)
+    node = machine.node
+    node.extra.update(
+        zone=zone,
+        boot_disk=StorageVolume(id="d", name="node-7", size=100, driver=None),
+    )
+    machine = MachineModel(layout=machine.layout, node=node)
+    decoded = db.bytes_to_machine(db.machine_as_bytes(machine))
+    # Provisioners attach their driver before handing nodes to it
+    node = catalog.bind(decoded.node, get_driver(Provider.DUMMY)(0))
+    assert node.state == NodeState.RUNNING and "state=RUNNING" in repr(node)
+    assert node.extra["zone"].name == "us-a"
+    assert node.extra["boot_disk"].name == "node-7"
+    assert node.extra["boot_disk"].extra["zone"].name == "us-a"
+
+    # Records written before the boot disk was kept still decode
+    data = db.machine_as_bytes(decoded)
+    payload = msgpack.unpackb(data[len(db.RECORD_MAGIC) + 1 :])
+    del payload["boot_disk"]
+    old = db.RECORD_MAGIC + bytes([1]) + msgpack.packb(payload)
+    assert db.bytes_to_machine(old).node.extra["boot_disk"] is None
+
+
+def test_migrate_legacy_records(store) -> None:
+    """Test dill pickled records are rewritten in the current encoding
+
+    The fixture was pickled by the unversioned store, its machine holds the
+    node as `node` and has no zone or boot disk.
+    """
+    store.cache["i-0123456789"] = (FIXTURES / "legacy-machine.dill").read_bytes()
+    assert db.is_legacy_record(store.cache["i-0123456789"])
+    assert store.migrate() == 1
+    assert not db.is_legacy_record(store.cache["i-0123456789"])
+    machine = store.get("i-0123456789")
+    assert machine.instance_name == "ogc-legacy-000"
+    assert machine.layout.tags == ["ogc-worker", "ogc-manager"]
+    assert (machine.public_ip, machine.private_ip) == ("10.0.0.1", "192.168.0.1")
+    assert machine.zone == "us-east-2a" and machine.boot_disk is None
+    assert machine.node.state == NodeState.RUNNING
+    assert store.lookup("tag", "ogc-manager") == {"1", "i-0123456789"}
+
+
+def test_shared_handles(store) -> None:
+    """Test the cache and store are opened once per process"""
+    assert db.cache_path() is db.cache_path()
+    assert db.store() is store
+
+
+def test_batch_commits_once(store) -> None:
+    """Test batched writes are only visible once the batch exits"""
+    with store.batch() as batch:
+        batch.put(_machine(4, ["ogc-worker"]))
+        batch.delete("1")
+        assert store.get("4") is None
+        assert store.get("1") is not None
+    assert store.lookup("tag", "ogc-worker") == {"2", "3", "4"}
+    assert db.query(tag="ogc-manager") is None
+
+
+def test_query_language(store) -> None:
+    """Test filter queries and keyword filters are ANDed"""
+    machines = db.query("tag=ogc-worker and not provider=aws", instance_id="2")
+    assert [m.instance_id for m in machines] == ["2"]
+    machines = db.query("provider=aws or tag=ogc-manager")
+    assert sorted(m.instance_id for m in machines) == ["1", "3"]
+
+
+def test_iter_machines_is_lazy(store, monkeypatch) -> None:
+    """Test machines are decoded one at a time as they are consumed"""
+    decoded = []
+    bytes_to_machine = db.bytes_to_machine
+    monkeypatch.setattr(
+        db, "bytes_to_machine", lambda data: decoded.append(data) or bytes_to_machine(data)
+    )
+    machines = db.iter_machines(tag="ogc-worker")
+    assert not decoded
+    next(machines)
+    assert len(decoded) == 1
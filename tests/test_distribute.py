@@ -0,0 +1,113 @@
+"""Tests for tree fan-out of files, nodes are local directories"""
+
+from __future__ import annotations
+
+import shutil
+import subprocess
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+from ogc import distribute
+
+
+class LocalNode:
+    """Node whose home is a local directory, serving on the loopback"""
+
+    address = "127.0.0.1"
+
+    def __init__(self, home: Path):
+        self.home = home
+        self.name = home.name
+        self.uploads = 0
+        self.commands: list[str] = []
+
+    def run(self, cmd: str, stdin=None) -> tuple[str, str, int]:
+        self.commands.append(cmd)
+        proc = subprocess.run(
+            cmd,
+            shell=True,
+            cwd=self.home,
+            input=b"".join(stdin or ()).decode(),
+            capture_output=True,
+            text=True,
+        )
+        return proc.stdout, proc.stderr, proc.returncode
+
+    def upload(self, src: Path, dest: str) -> None:
+        self.uploads += 1
+        shutil.copyfile(src, self.home / dest)
+
+
+class CorruptingNode(LocalNode):
+    """Node whose fetched copies get corrupted"""
+
+    def run(self, cmd: str, stdin=None) -> tuple[str, str, int]:
+        result = super().run(cmd, stdin)
+        if "curl" in cmd:
+            with (self.home / "data/agent.tar.gz").open("ab") as fp:
+                fp.write(b"garbage")
+        return result
+
+
+@pytest.fixture
+def artifact(tmp_path) -> Path:
+    path = tmp_path / "agent.tar.gz"
+    path.write_bytes(b"elastic-agent" * 100_000)
+    return path
+
+
+def _nodes(tmp_path: Path, count: int, cls=LocalNode) -> list[LocalNode]:
+    homes = [tmp_path / f"node-{idx}" for idx in range(count)]
+    for home in homes:
+        home.mkdir()
+    return [cls(home) for home in homes]
+
+
+def test_tree_fanout(tmp_path, artifact):
+    nodes = _nodes(tmp_path, 7)
+    report = distribute.distribute(
+        nodes, artifact, "data/agent.tar.gz", fanout=2, seeds=1, client=lambda n: n
+    )
+    assert report.uploaded == ["node-0"]
+    assert len(report.relayed) == 6
+    assert report.rounds == 2
+    assert not report.failed
+    for node in nodes:
+        assert (node.home / "data/agent.tar.gz").read_bytes() == artifact.read_bytes()
+    assert sum(node.uploads for node in nodes) == 1
+    # Tokens don't show in command lines
+    assert not any("http://" in cmd for node in nodes for cmd in node.commands)
+    assert not list(Path("/tmp").glob("ogc-distribute-*"))
+
+
+def test_corrupt_relay_falls_back_to_upload(tmp_path, artifact):
+    nodes = _nodes(tmp_path, 2)
+    (tmp_path / "bad").mkdir()
+    bad = CorruptingNode(tmp_path / "bad")
+    report = distribute.distribute(
+        [*nodes, bad], artifact, "data/agent.tar.gz", seeds=1, client=lambda n: n
+    )
+    assert "bad" in report.uploaded
+    assert "bad" not in report.relayed
+    assert (bad.home / "data/agent.tar.gz").read_bytes() == artifact.read_bytes()
+    assert not report.failed
+
+
+def test_holder_serves_token_path_only(tmp_path, artifact):
+    (node,) = _nodes(tmp_path, 1)
+    shutil.copyfile(artifact, node.home / "agent.tar.gz")
+    holder = distribute._Holder(node, "agent.tar.gz")
+    try:
+        base = holder.url.rsplit("/", 1)[0]
+        for path in ("/file", "/", "/agent.tar.gz"):
+            with pytest.raises(urllib.error.HTTPError) as err:
+                urllib.request.urlopen(base + path, timeout=5)
+            assert err.value.code == 404
+        with urllib.request.urlopen(holder.url, timeout=5) as resp:
+            assert resp.read() == artifact.read_bytes()
+    finally:
+        holder.stop()
+    assert not Path(holder.dir).exists()
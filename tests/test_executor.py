@@ -0,0 +1,30 @@
+"""Tests for the execution backends"""
+
+from __future__ import annotations
+
+import pytest
+
+from ogc.exceptions import ExecutorException
+from ogc.executor import get_executor
+from ogc.rollout import Rollout
+from ogc.scheduler import Priority
+
+
+@pytest.mark.parametrize("name", ["gevent", "asyncio"])
+def test_executors_run_every_node(name):
+    done = []
+    report = get_executor(name).run(
+        Rollout(batch_size=4),
+        range(10),
+        lambda node: done.append(node) or True,
+        "ssh",
+        Priority.EXEC,
+    )
+    assert sorted(done) == list(range(10))
+    assert report.succeeded == 10
+    assert report.batches == 3
+
+
+def test_unknown_executor():
+    with pytest.raises(ExecutorException):
+        get_executor("threads")
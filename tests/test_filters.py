@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import datetime
+
+import pytest
+
+from ogc import filters
+from ogc.exceptions import QueryException
+
+
+def _record(**overrides) -> filters.Record:
+    summary = {
+        "instance_id": "1",
+        "name": "ogc-machine-abc",
+        "instance_name": "ubuntu-001",
+        "layout.name": "ogc-layout-abc",
+        "provider": "google",
+        "state": "running",
+        "tag": ["ogc-worker", "ogc-manager"],
+        "label": ["team=observability"],
+        "created": datetime.datetime.utcnow().isoformat(),
+    }
+    summary.update(overrides)
+    return filters.Record(summary, lambda: None)
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ("tag=ogc-worker", True),
+        ("tag=ogc-worker and provider=aws", False),
+        ("tag=ogc-worker provider=google", True),
+        ("provider=aws or state=running", True),
+        ("not state=running", False),
+        ("provider in (aws, google)", True),
+        ("name~ogc-machine-*", True),
+        ("instance_name=~'^ubuntu-[0-9]+$'", True),
+        ("label.team=observability", True),
+        ("label.team!=observability", False),
+        ("tag!=ogc-db", True),
+        ("age<1h", True),
+        ("age>1h", False),
+        ("created>1h", True),
+        ("created<1h", False),
+        ("(provider=aws or tag=ogc-manager) and not state=terminated", True),
+    ],
+)
+def test_matches(query: str, expected: bool) -> None:
+    """Test filter queries against a machine summary"""
+    assert filters.parse(query).matches(_record()) is expected
+
+
+def test_created_dates() -> None:
+    """Test durations and dates order the same way for created and for age"""
+    record = _record(created="2023-12-01T10:00:00")
+    # Created after the date, and longer than two days ago
+    assert filters.parse("created>2023-11-30 and created<2d").matches(record)
+    assert filters.parse("age<2023-11-30 and age>2d").matches(record)
+    assert not filters.parse("created<2023-11-30 or created>2d").matches(record)
+    assert not filters.parse("age>2023-11-30 or age<2d").matches(record)
+    with pytest.raises(QueryException):
+        filters.parse("created>yesterday")
+
+
+def test_durations_follow_the_clock(monkeypatch) -> None:
+    """A cached query compares against the time it is matched at"""
+    now = datetime.datetime(2024, 1, 1, 12)
+    monkeypatch.setattr(filters, "_now", lambda: now)
+    record = _record(created="2024-01-01T11:30:00")
+    assert filters.parse("age<1h").matches(record)
+    assert not filters.parse("created<1h").matches(record)
+    now += datetime.timedelta(hours=1)
+    assert not filters.parse("age<1h").matches(record)
+    assert filters.parse("created<1h").matches(record)
+
+
+def test_candidates() -> None:
+    """Test index lookups are intersected and unioned"""
+    index = {
+        ("tag", "ogc-worker"): {"1", "2", "3"},
+        ("provider", "aws"): {"3"},
+        ("label", "team=obs"): {"2"},
+    }
+
+    def lookup(name: str, value: str) -> set[str]:
+        return index.get((name, value), set())
+
+    assert filters.parse("tag=ogc-worker and provider=aws").candidates(lookup) == {
+        "3"
+    }
+    assert filters.parse("provider=aws or label.team=obs").candidates(lookup) == {
+        "2",
+        "3",
+    }
+    assert filters.parse("tag=ogc-worker or created>1h").candidates(lookup) is None
+    assert filters.parse("not provider=aws").candidates(lookup) is None
+
+
+@pytest.mark.parametrize("query", ["tag=", "(tag=a", "tag=a or", "name=~'('"])
+def test_invalid(query: str) -> None:
+    """Test invalid queries are rejected when parsed"""
+    with pytest.raises(QueryException):
+        filters.parse(query)
@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+from jinja2 import Template
+
+from ogc.fleet import FleetView
+
+
+def test_snapshot_is_lazy(store, monkeypatch) -> None:
+    """Test machines are only decoded once and when used"""
+    decoded = []
+    get = store.get
+    monkeypatch.setattr(store, "get", lambda _id: decoded.append(_id) or get(_id))
+    nodes = FleetView.snapshot(store)
+    assert len(nodes) == 3
+    assert decoded == []
+    workers = nodes.where(tag="ogc-worker", provider="google")
+    assert len(workers) == 2
+    assert nodes.where("tag=ogc-worker and provider=google") is workers
+    assert decoded == []
+    assert nodes.by_name[nodes[2].instance_name].instance_id == nodes[2].instance_id
+    assert [m.instance_id for m in workers] == ["1", "2"]
+    assert sorted(decoded) == ["1", "2", "3"]
+
+
+def test_snapshot_in_template(store) -> None:
+    """Test templates can use the view like the list of machines"""
+    nodes = FleetView.snapshot(store)
+    template = Template(
+        "{{ nodes | length }} "
+        "{% for n in nodes.where(tag='ogc-manager') %}{{ n.public_ip }}{% endfor %}"
+    )
+    assert template.render(nodes=nodes) == "3 10.0.0.1"
@@ -0,0 +1,67 @@
+"""Tests for the adaptive concurrency limiter"""
+
+from __future__ import annotations
+
+import pytest
+
+from ogc.limiter import AdaptiveLimiter, is_throttle
+
+
+def test_slow_start_grows_to_ceiling():
+    limiter = AdaptiveLimiter(floor=2, ceiling=10)
+    assert limiter.limit == 2
+    for _ in range(20):
+        limiter.success()
+    assert limiter.limit == 10
+    assert limiter.peak == 10
+
+
+def test_backs_off_once_per_window():
+    limiter = AdaptiveLimiter(floor=2, ceiling=64)
+    for _ in range(30):
+        limiter.success()
+    assert limiter.limit == 32
+    limiter.failure()
+    limiter.failure()
+    assert limiter.limit == 16
+    for _ in range(17):
+        limiter.success()
+    # Additive increase after the first congestion, about one per window
+    assert limiter.limit == 17
+    limiter.failure(RuntimeError("429 Too Many Requests"))
+    assert limiter.limit == 8
+    assert limiter.throttled == 1
+
+
+def test_never_below_floor():
+    limiter = AdaptiveLimiter(floor=3, ceiling=8)
+    for _ in range(50):
+        limiter.failure()
+        limiter.success()
+    assert limiter.limit >= 3
+
+
+def test_latency_over_baseline_backs_off():
+    limiter = AdaptiveLimiter(floor=1, ceiling=64)
+    for _ in range(20):
+        limiter.success()
+    for _ in range(10):
+        limiter.observe(0.05, "ssh-channel")
+    assert limiter.limit == 21
+    limiter.observe(0.5, "ssh-channel")
+    assert limiter.limit == 10
+    # Other kinds of round trips have their own baseline
+    limiter.observe(2.0, "ssh-connect")
+    assert limiter.limit == 10
+
+
+@pytest.mark.parametrize(
+    "exc,expected",
+    [
+        (RuntimeError("Rate Limit Exceeded"), True),
+        (Exception("RequestLimitExceeded: Request limit exceeded."), True),
+        (OSError("Connection refused"), False),
+    ],
+)
+def test_is_throttle(exc, expected):
+    assert is_throttle(exc) is expected
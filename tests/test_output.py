@@ -0,0 +1,48 @@
+"""Tests for per-node command output"""
+
+from __future__ import annotations
+
+import io
+
+from ogc import output
+
+
+def test_streams_prefixed_lines():
+    echo = io.StringIO()
+    with output.NodeOutput("node-1", stream=True, echo=echo) as out:
+        out.feed_out(b"hel")
+        assert echo.getvalue() == ""
+        out.feed_out(b"lo\nwor")
+        out.feed_err("oops\n")
+        out.feed_out(b"ld")
+    assert echo.getvalue() == "node-1: hello\nnode-1! oops\nnode-1: world\n"
+    assert out.out == "hello\nworld"
+    assert out.err == "oops\n"
+
+
+def test_tail_is_bounded():
+    with output.NodeOutput("node-1", tail_lines=3) as out:
+        for idx in range(100):
+            out.feed_out(f"{idx}\n".encode())
+    assert out.out == "97\n98\n99\n"
+    assert out.truncated
+
+
+def test_long_lines_are_split(monkeypatch):
+    monkeypatch.setattr(output, "MAX_LINE", 10)
+    with output.NodeOutput("node-1") as out:
+        out.feed_out(b"x" * 25)
+    assert out.out == "x" * 25
+    assert len(out._out.tail) == 3
+
+
+def test_spools_full_output(tmp_path):
+    with output.NodeOutput("node-1", tail_lines=1, spool_dir=tmp_path) as out:
+        for idx in range(10):
+            out.feed_out(f"{idx}\n".encode())
+        out.feed_err(b"done\n")
+    assert out.out == "9\n"
+    assert (tmp_path / "node-1.out").read_text() == "".join(
+        f"{idx}\n" for idx in range(10)
+    )
+    assert (tmp_path / "node-1.err").read_text() == "done\n"
@@ -0,0 +1,81 @@
+"""Tests for dependencies between script steps"""
+
+from __future__ import annotations
+
+import time
+
+import gevent
+import pytest
+
+from ogc import plan
+from ogc.exceptions import PlanException
+
+NAMES = ["01-setup", "02-install", "03-monitoring", "04-join"]
+
+PLAN = {
+    "steps": {
+        "02-install": {"needs": ["01-setup"]},
+        "03-monitoring": {"needs": ["01-setup"]},
+        "04-join": {"needs": ["02-install"], "after": ["manager:02-install"]},
+    }
+}
+
+
+def test_serial_without_plan():
+    steps = plan.load(None, NAMES)
+    assert [step.needs for step in steps] == [[], ["01-setup"], ["02-install"], ["03-monitoring"]]
+
+
+@pytest.mark.parametrize(
+    "steps",
+    [
+        {"05-missing": {}},
+        {"02-install": {"needs": ["04-join"]}, "04-join": {"needs": ["02-install"]}},
+        {"04-join": {"after": ["02-install"]}},
+    ],
+)
+def test_invalid_plans(steps):
+    with pytest.raises(PlanException):
+        plan.load({"steps": steps}, NAMES)
+
+
+def test_runs_independent_steps_concurrently():
+    steps = plan.load(PLAN, NAMES)
+    progress = plan.Progress({"manager": ["m"]})
+    started: dict[str, float] = {}
+
+    def run_step(node: str):
+        def _run(name: str) -> bool:
+            started[f"{node}/{name}"] = time.monotonic()
+            gevent.sleep(0.05 if node == "m" else 0.01)
+            return True
+
+        return _run
+
+    workers = [
+        gevent.spawn(plan.run_node, node, steps, run_step(node), progress)
+        for node in ["w1", "w2"]
+    ]
+    gevent.sleep(0.02)
+    assert "w1/04-join" not in started
+    manager = gevent.spawn(plan.run_node, "m", steps, run_step("m"), progress)
+    with gevent.Timeout(5):
+        assert all(g.get() for g in [*workers, manager])
+    assert abs(started["w1/02-install"] - started["w1/03-monitoring"]) < 0.01
+    assert started["w1/04-join"] >= started["m/02-install"] + 0.05
+
+
+def test_failed_prerequisite_skips_dependents():
+    steps = plan.load(PLAN, NAMES)
+    progress = plan.Progress({"manager": ["m"]})
+    ran = []
+
+    def run_step(name: str) -> bool:
+        ran.append(name)
+        return name != "01-setup"
+
+    worker = gevent.spawn(plan.run_node, "w1", steps, lambda name: True, progress)
+    with gevent.Timeout(5):
+        assert not plan.run_node("m", steps, run_step, progress)
+        assert not worker.get()
+    assert ran == ["01-setup"]
@@ -0,0 +1,328 @@
+"""Tests for bulk node creation and teardown of the provisioners"""
+
+from __future__ import annotations
+
+import functools
+import socket
+import time
+import types
+from xml.etree import ElementTree
+
+import attrs
+import pytest
+from libcloud.common.google import GoogleBaseError
+from libcloud.compute.base import Node, NodeImage, NodeLocation, StorageVolume
+from libcloud.compute.drivers.ec2 import NAMESPACE as EC2_NAMESPACE
+from libcloud.compute.drivers.gce import GCENodeDriver
+from libcloud.compute.providers import get_driver
+from libcloud.compute.ssh import ParamikoSSHClient
+from libcloud.compute.types import NodeState, Provider
+
+from ogc import catalog, connections, db, deployer, scheduler
+from ogc.models.layout import LayoutModel
+from ogc.models.machine import MachineModel
+from ogc.provision import AWSProvisioner, BaseProvisioner, GCEProvisioner
+
+
+class BulkDriver(get_driver(Provider.DUMMY)):
+    """Offline driver recording bulk creation calls"""
+
+    def __init__(self):
+        super().__init__(creds=0)
+        self.calls: list[dict] = []
+
+    def _nodes(self, names: list[str]) -> list[Node]:
+        return [
+            Node(
+                id=f"i-{idx}",
+                name=name,
+                state=NodeState.RUNNING,
+                public_ips=[f"10.0.0.{idx}"],
+                private_ips=[f"192.168.0.{idx}"],
+                driver=self,
+            )
+            for idx, name in enumerate(names)
+        ]
+
+    def get_image(self, image_id):
+        return NodeImage(id=image_id, name=image_id, driver=self)
+
+    def ex_get_image_from_family(self, family):
+        return self.get_image(family)
+
+    def create_node(self, name, ex_maxcount=1, **kwargs):
+        self.calls.append(dict(name=name, count=ex_maxcount))
+        nodes = self._nodes([name] * ex_maxcount)
+        return nodes[0] if len(nodes) == 1 else nodes
+
+    def wait_until_running(self, nodes, **kwargs):
+        return [(node, node.public_ips) for node in nodes]
+
+    def ex_create_multiple_nodes(self, base_name, number, **kwargs):
+        self.calls.append(dict(name=base_name, count=number))
+        return self._nodes([f"{base_name}-{idx:03}" for idx in range(number)])
+
+
+@pytest.fixture
+def layout(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(catalog, "_catalog", None)
+    pub_key = tmp_path / "id_rsa.pub"
+    pub_key.write_text("ssh-rsa AAAA test")
+    return LayoutModel(
+        instance_size="Small",
+        provider="aws",
+        remote_path="/home/ubuntu",
+        runs_on="ami-1234",
+        scale=50,
+        username="ubuntu",
+        ssh_private_key=tmp_path / "id_rsa",
+        ssh_public_key=pub_key,
+        tags=[],
+        labels={},
+        ports=[],
+    )
+
+
+@pytest.mark.parametrize("cls", [AWSProvisioner, GCEProvisioner])
+def test_create_honors_scale(cls, layout, monkeypatch):
+    driver = BulkDriver()
+    provisioner = cls(layout=layout)
+    provisioner.provisioner = driver
+    writes = []
+    batch = db.MachineStore.batch
+    monkeypatch.setattr(
+        db.MachineStore, "batch", lambda self: writes.append(1) or batch(self)
+    )
+    machines = provisioner.create()
+    assert driver.calls == [dict(name=layout.name, count=50)]
+    assert len({machine.instance_name for machine in machines}) == 50
+    assert f"{layout.name}-049" in {machine.instance_name for machine in machines}
+    assert len(machines) == 50 and len(writes) == 1
+    assert sorted(db.store().ids()) == sorted(f"i-{idx}" for idx in range(50))
+    assert {machine.public_ip for machine in machines} == {
+        f"10.0.0.{idx}" for idx in range(50)
+    }
+
+
+class FakeProvisioner(BaseProvisioner):
+    """Records teardown calls instead of talking to a provider"""
+
+    calls: list[tuple] = []
+
+    @property
+    def scope(self):
+        return (self.layout.provider, "region-1")
+
+    def connect(self):
+        self.calls.append(("connect", self.scope))
+        return BulkDriver()
+
+    def destroy(self, nodes):
+        self.calls.append(("destroy", self.layout.name, len(nodes)))
+        return [True] * len(nodes)
+
+    def cleanup(self):
+        self.calls.append(("cleanup", self.layout.name))
+        return True
+
+
+def test_down_groups_by_layout(layout, monkeypatch):
+    layouts = [layout, attrs.evolve(layout, name="ogc-layout-other")]
+    driver = BulkDriver()
+    with db.store().batch() as batch:
+        for idx, node in enumerate(driver._nodes(["node"] * 10)):
+            batch.put(MachineModel(layout=layouts[idx % 2], node=node))
+    FakeProvisioner.calls = []
+    monkeypatch.setattr(
+        BaseProvisioner,
+        "from_layout",
+        classmethod(lambda cls, layout, connect=True: FakeProvisioner(layout)),
+    )
+    scripts = []
+    monkeypatch.setattr(
+        deployer, "exec", lambda cmd, **kwargs: scripts.append(cmd) or True
+    )
+
+    # Only part of a layout, its firewall and key pair are kept
+    assert deployer.down(query="instance_id=i-0")
+    assert len(scripts) == 1 and "./teardown" in scripts[0]
+    assert FakeProvisioner.calls == [
+        ("connect", ("aws", "region-1")),
+        ("destroy", layout.name, 1),
+    ]
+
+    FakeProvisioner.calls = []
+    assert deployer.down()
+    assert sorted(FakeProvisioner.calls[1:]) == sorted(
+        [
+            ("destroy", layout.name, 4),
+            ("cleanup", layout.name),
+            ("destroy", "ogc-layout-other", 5),
+            ("cleanup", "ogc-layout-other"),
+        ]
+    )
+    assert FakeProvisioner.calls[0][0] == "connect" and not db.store().ids()
+
+
+def test_down_unreachable_nodes(layout, monkeypatch):
+    """Teardown scripts of nodes that can't be reached don't hold up down"""
+    # Accepts connections but never answers, like a node that hung
+    blackhole = socket.socket()
+    blackhole.bind(("127.0.0.1", 0))
+    blackhole.listen(10)
+    monkeypatch.setattr(
+        connections,
+        "ParamikoSSHClient",
+        functools.partial(ParamikoSSHClient, port=blackhole.getsockname()[1]),
+    )
+    with db.store().batch() as batch:
+        for node in BulkDriver()._nodes(["node"] * 2):
+            node.public_ips = ["127.0.0.1"]
+            batch.put(MachineModel(layout=layout, node=node))
+    FakeProvisioner.calls = []
+    monkeypatch.setattr(
+        BaseProvisioner,
+        "from_layout",
+        classmethod(lambda cls, layout, connect=True: FakeProvisioner(layout)),
+    )
+    monkeypatch.setattr(deployer, "TEARDOWN_TIMEOUT", 0.5)
+    started = time.monotonic()
+    assert deployer.down()
+    assert time.monotonic() - started < 5
+    assert ("destroy", layout.name, 2) in FakeProvisioner.calls
+    assert not db.store().ids()
+    blackhole.close()
+
+
+class GCEConnection:
+    """Answers instance and disk deletes, failing the ones in `broken`"""
+
+    def __init__(self, broken=(), disks=()):
+        self.broken = set(broken)
+        self.disks = set(disks)
+        self.deleted: list[str] = []
+
+    def request_aggregated_items(self, api_name):
+        disks = [{"name": name} for name in sorted(self.disks)]
+        return {"items": {"zones/us-a": {api_name: disks}}}
+
+    def async_request(self, path, method="GET", **kwargs):
+        self.deleted.append(path)
+        self.disks.discard(path.rsplit("/", 1)[-1])
+
+    def request(self, path, method="GET", **kwargs):
+        if path in self.broken:
+            raise GoogleBaseError("backendError", 500, "backendError")
+        if method == "DELETE":
+            self.deleted.append(path)
+            return types.SimpleNamespace(object={"selfLink": f"op:{path}"})
+        return types.SimpleNamespace(object={"status": "DONE"})
+
+
+def test_down_gce_bulk_destroy(layout, monkeypatch):
+    """Runs libcloud's GCE bulk destroy on machines loaded from the store"""
+    layout = attrs.evolve(layout, provider="google", ports=["22:22"])
+    with db.store().batch() as batch:
+        for node in BulkDriver()._nodes([f"node-{idx}" for idx in range(4)]):
+            node.extra["zone"] = NodeLocation("us-a", "us-a", "", None)
+            node.extra["boot_disk"] = StorageVolume(node.id, node.name, 100, None)
+            batch.put(MachineModel(layout=layout, node=node))
+
+    driver = GCENodeDriver.__new__(GCENodeDriver)
+    # The disk of node-0 was auto deleted with it
+    driver.connection = GCEConnection(
+        broken={"/zones/us-a/instances/node-3"},
+        disks=[f"node-{idx}" for idx in range(1, 4)],
+    )
+    firewalls = []
+    monkeypatch.setattr(GCEProvisioner, "connect", lambda self: driver)
+    monkeypatch.setattr(GCEProvisioner, "delete_firewall", firewalls.append)
+    monkeypatch.setattr(deployer, "exec", lambda cmd, **kwargs: True)
+
+    # A failed delete keeps its machine, and the layout firewall with it
+    assert not deployer.down()
+    assert driver.connection.deleted == [
+        *[f"/zones/us-a/instances/node-{idx}" for idx in range(3)],
+        "/zones/us-a/disks/node-1",
+        "/zones/us-a/disks/node-2",
+    ]
+    assert db.store().ids() == ["i-3"] and not firewalls
+
+    driver.connection.broken.clear()
+    assert deployer.down()
+    assert not db.store().ids() and firewalls == [layout.name]
+    assert not driver.connection.disks
+
+
+def test_destroy_error_keeps_live_machines(layout, monkeypatch):
+    """Machines the provider still lists are kept when the destroy raises"""
+    driver = BulkDriver()
+    with db.store().batch() as batch:
+        for node in driver._nodes(["node"] * 3):
+            batch.put(MachineModel(layout=layout, node=node))
+
+    def _destroy(self, nodes):
+        raise TimeoutError("Timeout while waiting to delete multiple instances")
+
+    monkeypatch.setattr(AWSProvisioner, "connect", lambda self: driver)
+    monkeypatch.setattr(AWSProvisioner, "destroy", _destroy)
+    monkeypatch.setattr(AWSProvisioner, "cleanup", lambda self: pytest.fail())
+    monkeypatch.setattr(driver, "list_nodes", lambda: driver._nodes(["node"])[:1])
+    monkeypatch.setattr(deployer, "exec", lambda cmd, **kwargs: True)
+    assert not deployer.down()
+    assert db.store().ids() == ["i-0"]
+
+
+def test_aws_destroy_checks_every_instance(layout):
+    """One TerminateInstances call, each instance's state checked"""
+    calls = []
+
+    def _item(instance_id, state):
+        return (
+            f"<item><instanceId>{instance_id}</instanceId>"
+            f"<currentState><name>{state}</name></currentState></item>"
+        )
+
+    def _request(path, params):
+        calls.append(params)
+        body = _item("i-0", "shutting-down") + _item("i-1", "running")
+        return types.SimpleNamespace(
+            object=ElementTree.fromstring(
+                f'<TerminateInstancesResponse xmlns="{EC2_NAMESPACE}">'
+                f"<instancesSet>{body}</instancesSet></TerminateInstancesResponse>"
+            )
+        )
+
+    provisioner = AWSProvisioner(layout=layout)
+    provisioner.provisioner = types.SimpleNamespace(
+        path="/", connection=types.SimpleNamespace(request=_request)
+    )
+    nodes = BulkDriver()._nodes(["node"] * 3)
+    assert provisioner.destroy(nodes) == [True, False, False]
+    assert calls == [
+        {
+            "Action": "TerminateInstances",
+            "InstanceId.1": "i-0",
+            "InstanceId.2": "i-1",
+            "InstanceId.3": "i-2",
+        }
+    ]
+
+
+def test_provider_requests_feed_api_limiter(layout, monkeypatch):
+    """Slowing provider requests back off the provider's api budget"""
+    monkeypatch.setattr(scheduler, "_scheduler", None)
+    delays = iter([0.0, 0.0, 0.2])
+
+    def _request(path, **kwargs):
+        time.sleep(next(delays))
+        return path
+
+    driver = types.SimpleNamespace(connection=types.SimpleNamespace(request=_request))
+    AWSProvisioner(layout=layout).observed(driver)
+    limiter = scheduler.get_scheduler().budget("api", layout.provider).limiter
+    limiter.slow_start = True
+    for _ in range(3):
+        assert driver.connection.request("/") == "/"
+    assert "api" in limiter.baselines and not limiter.slow_start
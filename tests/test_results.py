@@ -0,0 +1,60 @@
+"""Tests for aggregated exec results"""
+
+from __future__ import annotations
+
+import io
+from types import SimpleNamespace
+
+import rich.console
+
+from ogc.output import NodeOutput
+from ogc.results import ResultSet
+
+
+def _run(results: ResultSet, name: str, chunks: list[bytes], exit_code: int = 0):
+    with NodeOutput(name, tail_lines=2) as out:
+        for chunk in chunks:
+            out.feed_out(chunk)
+    action = SimpleNamespace(
+        machine=SimpleNamespace(instance_name=name),
+        exit_code=exit_code,
+        out=out.out,
+        err=out.err,
+    )
+    results.add(action, out.digest)
+
+
+def test_groups_identical_output():
+    results = ResultSet(cmd="uptime")
+    for idx in range(10):
+        # Chunking does not change the digest
+        _run(results, f"node-{idx}", [b"same\n"] if idx % 2 else [b"sa", b"me\n"])
+    _run(results, "node-odd", [b"other\n"], exit_code=1)
+    assert results.total == 11
+    assert len(results.groups) == 2
+    largest = results.sorted_groups()[0]
+    assert len(largest.nodes) == 10
+    assert largest.out == "same\n"
+    assert results.exit_codes == {0: 10, 1: 1}
+    assert results.failed == ["node-odd"]
+    assert not results
+
+
+def test_digest_covers_truncated_output():
+    results = ResultSet(cmd="seq")
+    _run(results, "node-1", [b"1\n2\n3\n"])
+    _run(results, "node-2", [b"0\n2\n3\n"])
+    assert len(results.groups) == 2
+    assert results
+
+
+def test_print_summary():
+    results = ResultSet(cmd="hostname")
+    for idx in range(12):
+        _run(results, f"node-{idx}", [b"ok\n"])
+    con = rich.console.Console(file=io.StringIO(), width=200)
+    results.print_summary(con)
+    summary = con.file.getvalue()
+    assert "12 node(s) | exit 0 | node-0" in summary
+    assert "(+4 more)" in summary
+    assert "exit 0: 12" in summary
@@ -0,0 +1,150 @@
+"""Tests for rolling execution"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+
+import gevent
+import pytest
+from gevent.pool import Pool
+
+from ogc import timeouts
+from ogc.limiter import AdaptiveLimiter
+from ogc.rollout import Rollout
+
+
+def _batches(rollout: Rollout, count: int) -> list[list[int]]:
+    return [list(batch) for batch in rollout.batches(range(count))]
+
+
+@pytest.mark.parametrize(
+    "rollout,expected",
+    [
+        (Rollout(), [[0, 1, 2, 3, 4, 5, 6]]),
+        (Rollout(batch_size=3), [[0, 1, 2], [3, 4, 5], [6]]),
+        (Rollout(batch_percent=50), [[0, 1, 2, 3], [4, 5, 6]]),
+        (Rollout(canary=1, batch_size=4), [[0], [1, 2, 3, 4], [5, 6]]),
+        (Rollout(canary=2), [[0, 1], [2, 3, 4, 5, 6]]),
+    ],
+)
+def test_batches(rollout, expected):
+    assert _batches(rollout, 7) == expected
+
+
+def test_runs_every_node():
+    done = []
+    report = Rollout(batch_size=3).run(
+        range(10), lambda node: done.append(node) or True, Pool(4)
+    )
+    assert sorted(done) == list(range(10))
+    assert report.succeeded == 10
+    assert report.batches == 4
+    assert not report.aborted
+
+
+def test_canary_failure_stops_rollout():
+    done = []
+
+    def work(node: int) -> bool:
+        done.append(node)
+        return node != 0
+
+    report = Rollout(canary=1, batch_size=5).run(range(20), work, Pool(4))
+    assert done == [0]
+    assert report.failed == 1
+    assert report.cancelled == list(range(1, 20))
+    assert report.aborted
+
+
+def test_failure_budget_cancels_pending_nodes():
+    started = []
+
+    def work(node: int) -> bool:
+        started.append(node)
+        if node < 3:
+            return False
+        gevent.sleep(10)
+        return True
+
+    with gevent.Timeout(5):
+        report = Rollout(max_failures=2).run(range(50), work, Pool(5))
+    assert report.failed == 3
+    assert report.succeeded == 0
+    assert len(report.cancelled) == 47
+    assert len(started) < 50
+
+
+def test_node_timeout():
+    def work(node: int) -> bool:
+        gevent.sleep(10 if node % 2 else 0)
+        return True
+
+    with gevent.Timeout(5):
+        report = Rollout(node_timeout=0.1).run(range(6), work, Pool(6))
+    assert report.succeeded == 3
+    assert report.timed_out == [1, 3, 5]
+    assert not report.cancelled
+
+
+def test_overall_timeout_bounds_deadlines():
+    remaining = []
+
+    def work(node: int) -> bool:
+        remaining.append(timeouts.remaining(300))
+        gevent.sleep(10)
+        return True
+
+    with gevent.Timeout(5):
+        report = Rollout(node_timeout=60, timeout=0.2).run(range(4), work, Pool(2))
+    assert all(left <= 0.2 for left in remaining)
+    assert sorted(report.timed_out) == [0, 1]
+    assert report.cancelled == [2, 3]
+    assert report.aborted
+
+
+def test_deadline_is_per_greenlet():
+    seen = {}
+
+    def work(name: str, seconds: float | None) -> None:
+        with timeouts.deadline(seconds):
+            gevent.sleep(0)
+            seen[name] = timeouts.remaining()
+
+    gevent.joinall([gevent.spawn(work, "a", 30), gevent.spawn(work, "b", None)])
+    assert 0 < seen["a"] <= 30
+    assert seen["b"] is None
+
+
+def test_run_async_matches_run():
+    done = []
+
+    def work(node: int) -> bool:
+        done.append(node)
+        return node != 0
+
+    report = asyncio.run(
+        Rollout(canary=1, batch_size=5).run_async(range(20), work)
+    )
+    assert done == [0]
+    assert report.cancelled == list(range(1, 20))
+    assert report.aborted
+
+
+def test_run_async_limits_and_times_out():
+    limiter = AdaptiveLimiter(floor=2, ceiling=2)
+    running, peak = [0], [0]
+
+    def work(node: int) -> bool:
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        time.sleep(0.5 if node == 3 else 0.01)
+        running[0] -= 1
+        return True
+
+    report = asyncio.run(
+        Rollout(node_timeout=0.2).run_async(range(8), work, lambda node: limiter)
+    )
+    assert peak[0] <= 2
+    assert report.succeeded == 7
+    assert report.timed_out == [3]
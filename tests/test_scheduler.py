@@ -0,0 +1,126 @@
+"""Tests for the central task scheduler"""
+
+from __future__ import annotations
+
+import time
+
+import gevent
+
+from ogc.limiter import AdaptiveLimiter
+from ogc.rollout import Rollout
+from ogc.scheduler import Budget, Priority, Scheduler
+
+
+def _budget(floor: int, ceiling: int) -> Budget:
+    return Budget("test", AdaptiveLimiter(floor=floor, ceiling=ceiling))
+
+
+def test_lane_follows_limit(monkeypatch):
+    scheduler = Scheduler()
+    limiter = AdaptiveLimiter(floor=2, ceiling=6)
+    monkeypatch.setattr(Scheduler, "_limiter", staticmethod(lambda *_: limiter))
+    lane = scheduler.lane("ssh")
+    running, peak = [0], [0]
+
+    def work() -> bool:
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        gevent.sleep(0.01)
+        running[0] -= 1
+        return True
+
+    for _ in range(40):
+        lane.spawn(work)
+        assert scheduler.budget("ssh").active <= limiter.limit
+    lane.join()
+    assert peak[0] == 6
+    assert limiter.successes == 40
+    assert scheduler.budget("ssh").active == 0
+
+
+def test_lane_backs_off_on_errors(monkeypatch):
+    limiter = AdaptiveLimiter(floor=1, ceiling=16)
+    monkeypatch.setattr(Scheduler, "_limiter", staticmethod(lambda *_: limiter))
+    lane = Scheduler().lane("ssh")
+    for _ in range(20):
+        lane.spawn(lambda: True)
+    lane.join()
+    assert limiter.limit == 16
+    lane.spawn(lambda: RuntimeError("throttled"))
+    lane.join()
+    assert limiter.limit == 8
+
+
+def test_teardown_goes_first():
+    budget = _budget(1, 1)
+    order = []
+
+    def work(name: str, priority: Priority) -> None:
+        budget.acquire(priority)
+        order.append(name)
+        gevent.sleep(0.01)
+        budget.release()
+
+    budget.acquire(Priority.EXEC)
+    greenlets = [
+        gevent.spawn(work, "exec-1", Priority.EXEC),
+        gevent.spawn(work, "background", Priority.BACKGROUND),
+        gevent.spawn(work, "exec-2", Priority.EXEC),
+        gevent.spawn(work, "teardown", Priority.TEARDOWN),
+    ]
+    gevent.sleep(0)
+    budget.release()
+    gevent.joinall(greenlets)
+    assert order == ["teardown", "exec-1", "exec-2", "background"]
+    report = budget.report()
+    assert report["queued"] == 4
+    assert report["max_depth"] == 4
+    assert report["max_wait_ms"] > 0
+
+
+def test_acquire_timeout_leaves_queue():
+    budget = _budget(1, 1)
+    assert budget.acquire(Priority.EXEC)
+    assert not budget.acquire(Priority.EXEC, timeout=0.01)
+    assert budget.depth == 0
+    budget.release()
+    assert budget.available(Priority.BACKGROUND)
+
+
+def test_keyed_lane_honors_rollout_timeout(monkeypatch):
+    """Nodes queued for a slot of a keyed budget time out with the rollout"""
+    limiter = AdaptiveLimiter(floor=1, ceiling=1)
+    monkeypatch.setattr(Scheduler, "_limiter", staticmethod(lambda *_: limiter))
+    lane = Scheduler().lane("api", key=lambda node: "aws")
+
+    def work(node: int) -> bool:
+        gevent.sleep(5)
+        return True
+
+    started = time.monotonic()
+    report = Rollout(timeout=0.2).run(range(3), work, lane)
+    assert time.monotonic() - started < 1
+    assert sorted(report.timed_out) == [0, 1]
+    assert report.cancelled == [2]
+
+
+def test_budgets_per_provider(monkeypatch):
+    monkeypatch.setenv("OGC_API_MAX_WORKERS_AWS", "3")
+    scheduler = Scheduler()
+    assert scheduler.budget("api", "aws").limiter.ceiling == 3
+    assert scheduler.budget("api", "google") is not scheduler.budget("api", "aws")
+    assert scheduler.budget("ssh") is not scheduler.budget("transfer")
+
+
+def test_killed_work_releases_slot():
+    scheduler = Scheduler()
+    lane = scheduler.lane("api", Priority.TEARDOWN, key=lambda node: "aws")
+
+    def work(node: int) -> bool:
+        gevent.sleep(10)
+        return True
+
+    with gevent.Timeout(5):
+        report = Rollout(timeout=0.1).run(range(20), work, lane)
+    assert len(report.timed_out) + len(report.cancelled) == 20
+    assert scheduler.budget("api", "aws").active == 0
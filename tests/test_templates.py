@@ -0,0 +1,24 @@
+"""Tests for compiled script templates"""
+
+from __future__ import annotations
+
+import os
+
+from ogc import deployer
+
+
+def test_compiles_once_until_changed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    script = tmp_path / "scripts" / "setup.sh"
+    script.parent.mkdir()
+    script.write_text("echo {{ name }}")
+    template = deployer.compile_template(script)
+    assert deployer.compile_template(script) is template
+    assert deployer.render(script, {"name": "one"}) == "echo one"
+    assert list((tmp_path / ".ogc-cache" / "jinja").iterdir())
+
+    script.write_text("echo {{ name }}!")
+    stat = script.stat()
+    os.utime(script, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert deployer.compile_template(script) is not template
+    assert deployer.render(script, {"name": "two"}) == "echo two!"
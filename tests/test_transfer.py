@@ -0,0 +1,106 @@
+"""Tests for bulk file transfers, against in-process SSH servers"""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+import pytest
+
+from ogc import transfer
+from tests.sftp_server import LoopbackServer, SFTPNode
+
+
+@pytest.fixture
+def nodes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(transfer, "CHUNK_SIZE", 64 * 1024)
+    servers, _nodes = [], {}
+    for idx in range(2):
+        home = tmp_path / f"node-{idx}"
+        home.mkdir()
+        servers.append(LoopbackServer(home))
+        _nodes[f"node-{idx}"] = SFTPNode(f"node-{idx}", servers[-1].port)
+    yield _nodes
+    for node in _nodes.values():
+        node.close()
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def src(tmp_path) -> Path:
+    path = tmp_path / "src"
+    (path / "conf").mkdir(parents=True)
+    (path / "conf" / "agent.yml").write_text("outputs: {}\n")
+    (path / "agent.tar.gz").write_bytes(os.urandom(300 * 1024))
+    (path / "run.sh").write_text("#!/bin/sh\n")
+    (path / "run.sh").chmod(0o755)
+    (path / "debug.log").write_text("noise")
+    return path
+
+
+def _push(nodes, src, **kwargs):
+    return transfer.push(
+        nodes, src, "deploy", exclude=["*.log"], client=nodes.get, **kwargs
+    )
+
+
+def _files(root: Path) -> dict[str, bytes]:
+    return {
+        path.relative_to(root).as_posix(): path.read_bytes()
+        for path in root.rglob("*")
+        if path.is_file()
+    }
+
+
+def test_push_pull(tmp_path, nodes, src):
+    reports = _push(nodes, src)
+    expected = {k: v for k, v in _files(src).items() if k != "debug.log"}
+    for name, report in reports.items():
+        assert report.files == 3 and not report.failed
+        assert _files(tmp_path / name / "deploy") == expected
+        assert os.access(tmp_path / name / "deploy/run.sh", os.X_OK)
+    assert all(report.skipped == 3 for report in _push(nodes, src).values())
+
+    pulled = tmp_path / "pulled"
+    reports = transfer.pull(nodes, "deploy", pulled, client=nodes.get)
+    assert all(report.files == 3 for report in reports.values())
+    for name in nodes:
+        assert _files(pulled / name / "deploy") == expected
+
+
+def test_compressed(tmp_path, nodes, src):
+    reports = _push(nodes, src, compress=True)
+    assert all(report.files == 3 for report in reports.values())
+    assert (tmp_path / "node-0/deploy/conf/agent.yml").read_text() == "outputs: {}\n"
+    pulled = tmp_path / "pulled"
+    transfer.pull(nodes, "deploy/conf", pulled, compress=True, client=nodes.get)
+    assert (pulled / "node-1/conf/agent.yml").read_text() == "outputs: {}\n"
+
+
+def test_resumes_chunks(tmp_path, nodes, src, monkeypatch):
+    pump = transfer._pump
+    chunks = []
+
+    def _failing(_src, dest, length):
+        if length == transfer.CHUNK_SIZE and len(chunks) == 2:
+            raise ConnectionResetError("interrupted")
+        chunks.append(length)
+        pump(_src, dest, length)
+
+    node = {"node-0": nodes["node-0"]}
+    monkeypatch.setattr(transfer, "_pump", _failing)
+    report = _push(node, src / "agent.tar.gz", streams=1)["node-0"]
+    assert report.failed and not (tmp_path / "node-0/deploy").exists()
+
+    chunks.clear()
+    monkeypatch.setattr(
+        transfer, "_pump", lambda *args: chunks.append(args[2]) or pump(*args)
+    )
+    report = _push(node, src / "agent.tar.gz", streams=1)["node-0"]
+    assert report.resumed == 1 and not report.failed
+    # 300KiB in 64KiB chunks, the first two were kept
+    assert len(chunks) == 3
+    copy = tmp_path / "node-0/deploy"
+    assert copy.read_bytes() == (src / "agent.tar.gz").read_bytes()
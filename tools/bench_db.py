@@ -0,0 +1,76 @@
+"""Machine store query latency as the fleet grows
+
+Run with `python -m tools.bench_db`
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import tempfile
+import time
+import timeit
+
+import structlog
+from libcloud.compute.base import Node
+
+from ogc import db
+from ogc.models.layout import LayoutModel
+from ogc.models.machine import MachineModel
+
+FLEET_SIZES = [100, 1000, 5000]
+
+
+def fake_machine(idx: int) -> MachineModel:
+    layout = LayoutModel(
+        instance_size="e2-standard-4",
+        provider="google" if idx % 2 else "aws",
+        remote_path="/home/ubuntu",
+        runs_on="ubuntu-2204-lts",
+        scale=1,
+        username="ubuntu",
+        ssh_private_key="~/.ssh/id_rsa_libcloud",
+        ssh_public_key="~/.ssh/id_rsa_libcloud.pub",
+        tags=["ogc-manager"] if idx == 0 else ["ogc-worker"],
+        labels={"team": "observability"},
+        ports=["22:22"],
+    )
+    node = Node(
+        id=str(idx),
+        name=f"bench-{idx}",
+        state="running",
+        public_ips=["127.0.0.1"],
+        private_ips=["127.0.0.1"],
+        driver=None,
+    )
+    return MachineModel(layout=layout, node=node)
+
+
+def main() -> None:
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
+    )
+    print(
+        f"{'nodes':>8} {'write (ms)':>12} {'instance_id (ms)':>18} {'tag (ms)':>10} {'all (ms)':>10}"
+    )
+    for size in FLEET_SIZES:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            store = db.store()
+            start = time.perf_counter()
+            with store.batch() as batch:
+                for idx in range(size):
+                    batch.put(fake_machine(idx))
+            write = time.perf_counter() - start
+
+            by_id = timeit.timeit(lambda: db.query(instance_id="0"), number=20) / 20
+            by_tag = timeit.timeit(lambda: db.query(tag="ogc-manager"), number=20) / 20
+            everything = timeit.timeit(db.query, number=1)
+            print(
+                f"{size:>8} {write * 1000:>12.2f} {by_id * 1000:>18.2f}"
+                f" {by_tag * 1000:>10.2f} {everything * 1000:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Time to get a file onto the whole fleet, direct push versus tree fan-out
+
+Nodes are local directories standing in for sshd hosts, they relay to each
+other over the loopback. Uploads from ogc share one simulated uplink.
+
+Run with `python -m tools.bench_distribute`
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import structlog
+
+from ogc import distribute
+from tests.test_distribute import LocalNode
+
+FLEET_SIZES = [10, 50, 100]
+
+# Size of the artifact
+SIZE = 20 * 1024 * 1024
+
+# Bytes per second of the shared uplink
+UPLINK = 50 * 1024 * 1024
+
+_uplink = threading.Lock()
+
+
+class UplinkNode(LocalNode):
+    """Node whose uploads go through the shared, saturated uplink"""
+
+    def upload(self, src: Path, dest: str) -> None:
+        with _uplink:
+            time.sleep(src.stat().st_size / UPLINK)
+        super().upload(src, dest)
+
+
+def main() -> None:
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING),
+    )
+    print(f"{SIZE // 2**20} MiB, uplink {UPLINK // 2**20} MiB/s")
+    print(f"{'nodes':>8} {'direct (s)':>12} {'tree (s)':>10} {'rounds':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp) / "artifact.tar.gz"
+        src.write_bytes(os.urandom(SIZE))
+        for size in FLEET_SIZES:
+            elapsed = {}
+            for tree in (False, True):
+                homes = Path(tempfile.mkdtemp(dir=tmp))
+                nodes = []
+                for idx in range(size):
+                    (homes / f"node-{idx}").mkdir()
+                    nodes.append(UplinkNode(homes / f"node-{idx}"))
+                report = distribute.distribute(
+                    nodes, src, "artifact.tar.gz", tree=tree, client=lambda n: n
+                )
+                assert not report.failed
+                elapsed[tree] = report
+            print(
+                f"{size:>8} {elapsed[False].elapsed:>12.2f}"
+                f" {elapsed[True].elapsed:>10.2f} {elapsed[True].rounds:>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
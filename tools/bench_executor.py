@@ -0,0 +1,67 @@
+"""Throughput of the execution backends across simulated fleets
+
+Every node sleeps for a simulated SSH round trip. Each executor runs in its
+own interpreter, gevent patches it on import.
+
+Run with `python -m tools.bench_executor`
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import structlog
+
+FLEET_SIZES = [10, 100, 1000]
+
+EXECUTORS = ["gevent", "asyncio"]
+
+# Seconds a simulated node takes
+LATENCY = 0.05
+
+
+def simulate(size: int) -> float:
+    """Runs `size` simulated nodes, returns nodes per second"""
+    from ogc.executor import get_executor
+    from ogc.rollout import Rollout
+    from ogc.scheduler import Priority
+
+    def work(node: int) -> bool:
+        time.sleep(LATENCY)
+        return True
+
+    start = time.perf_counter()
+    report = get_executor().run(Rollout(), range(size), work, "ssh", Priority.EXEC)
+    elapsed = time.perf_counter() - start
+    assert report.succeeded == size
+    return size / elapsed
+
+
+def main() -> None:
+    if len(sys.argv) > 1:
+        structlog.configure(
+            wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING),
+        )
+        print(simulate(int(sys.argv[1])))
+        return
+    print(f"{'nodes':>8} " + " ".join(f"{name + ' (nodes/s)':>20}" for name in EXECUTORS))
+    for size in FLEET_SIZES:
+        rates = []
+        for name in EXECUTORS:
+            out = subprocess.run(
+                [sys.executable, "-m", "tools.bench_executor", str(size)],
+                env={**os.environ, "OGC_EXECUTOR": name},
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            rates.append(float(out.split()[-1]))
+        print(f"{size:>8} " + " ".join(f"{rate:>20.1f}" for rate in rates))
+
+
+if __name__ == "__main__":
+    main()
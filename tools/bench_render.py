@@ -0,0 +1,87 @@
+"""Script rendering time for exec_scripts
+
+Renders a directory of scripts for every node, compiling the templates for
+every node as before the template cache and once with it.
+
+Run with `python -m tools.bench_render`
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import structlog
+from jinja2 import Environment, FileSystemLoader
+
+from ogc import deployer
+from tools.bench_db import fake_machine
+
+NODES = 1000
+
+SCRIPTS = 10
+
+SCRIPT = """#!/bin/bash
+set -eux
+{% for key, value in env.items() if key.startswith("OGC_") %}
+export {{ key }}="{{ value }}"
+{% endfor %}
+hostnamectl set-hostname {{ node.instance_name }}
+echo "{{ node.private_ip }} {{ node.instance_name }}" >> /etc/hosts
+{% if node.layout.tags %}
+echo "tags: {{ node.layout.tags | join(',') }}"
+{% endif %}
+{% for peer in nodes %}
+echo "{{ peer.private_ip }} {{ peer.instance_name }}" >> /etc/hosts
+{% endfor %}
+"""
+
+
+def uncached(path: Path, context: deployer.Ctx) -> str:
+    env = Environment(loader=FileSystemLoader(searchpath=str(path.parent)))
+    return env.get_template(path.name).render(**context)
+
+
+def main() -> None:
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        scripts = Path(tmp) / "scripts"
+        scripts.mkdir()
+        paths = []
+        for idx in range(SCRIPTS):
+            paths.append(scripts / f"{idx:02}-step.sh")
+            paths[-1].write_text(SCRIPT)
+        machines = [fake_machine(idx) for idx in range(NODES)]
+        peers = machines[:10]
+        contexts = [
+            deployer.Ctx(env=dict(os.environ), node=machine, nodes=peers)
+            for machine in machines
+        ]
+
+        start = time.perf_counter()
+        for context in contexts:
+            for path in paths:
+                uncached(path, context)
+        before = time.perf_counter() - start
+
+        start = time.perf_counter()
+        templates = [deployer.compile_template(path) for path in paths]
+        compiled = time.perf_counter() - start
+        for context in contexts:
+            for _template in templates:
+                _template.render(**context)
+        after = time.perf_counter() - start
+
+        print(f"{NODES} nodes x {SCRIPTS} scripts")
+        print(f"{'compile per node (s)':>22} {'compile once (s)':>18} {'of which compiling (ms)':>24}")
+        print(f"{before:>22.2f} {after:>18.2f} {compiled * 1000:>24.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Push throughput of the transfer engine against a one file at a time copy
+
+Every node is an in-process SSH server behind a proxy adding latency, the
+baseline writes each file without pipelining, one node after the other, as
+libcloud's `FileDeployment` does. Servers run in this process too, so the
+numbers compare the modes rather than measure a real link.
+
+Run with `python -m tools.bench_transfer`
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import structlog
+
+from ogc import transfer
+from tests.sftp_server import LoopbackServer, SFTPNode
+
+NODES = 4
+
+# One way delay added by the proxy, in seconds
+LATENCY = float(os.environ.get("OGC_BENCH_LATENCY", 0.01))
+
+
+class DelayProxy:
+    """Forwards connections to a port, delaying every packet by `LATENCY`"""
+
+    def __init__(self, port: int):
+        self.target = port
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(10)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            conn, _ = self.sock.accept()
+            upstream = socket.create_connection(("127.0.0.1", self.target))
+            for src, dest in ((conn, upstream), (upstream, conn)):
+                src.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._pipe(src, dest)
+
+    def _pipe(self, src: socket.socket, dest: socket.socket) -> None:
+        queue: deque[tuple[float, bytes]] = deque()
+        ready = threading.Semaphore(0)
+
+        def _read() -> None:
+            while data := src.recv(65536):
+                queue.append((time.monotonic() + LATENCY, data))
+                ready.release()
+            queue.append((0, b""))
+            ready.release()
+
+        def _write() -> None:
+            while True:
+                ready.acquire()
+                due, data = queue.popleft()
+                if not data:
+                    dest.close()
+                    return
+                time.sleep(max(0, due - time.monotonic()))
+                dest.sendall(data)
+
+        threading.Thread(target=_read, daemon=True).start()
+        threading.Thread(target=_write, daemon=True).start()
+
+
+def _dataset(root: Path) -> Path:
+    src = root / "src"
+    (src / "conf").mkdir(parents=True)
+    for idx in range(200):
+        (src / "conf" / f"{idx:03}.yml").write_bytes(os.urandom(8 * 1024))
+    line = b"2026-10-17T07:00:00Z INFO agent harvested 128 events from /var/log\n"
+    (src / "agent.log").write_bytes(line * (8 * 2**20 // len(line)))
+    (src / "agent.tar.gz").write_bytes(os.urandom(8 * 2**20))
+    return src
+
+
+def _baseline(nodes: dict[str, SFTPNode], src: Path) -> None:
+    entries = transfer.plan_push(src, "baseline")
+    for node in nodes.values():
+        with node.sftp() as sftp:
+            made: set[str] = set()
+            for entry in entries:
+                transfer._makedirs(sftp, os.path.dirname(entry.dest), made)
+                with sftp.open(entry.dest, "wb") as fp:
+                    fp.write(Path(entry.src).read_bytes())
+
+
+def main() -> None:
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        os.chdir(root)
+        src = _dataset(root)
+        size = sum(path.stat().st_size for path in src.rglob("*") if path.is_file())
+        nodes = {}
+        for idx in range(NODES):
+            home = root / f"node-{idx}"
+            home.mkdir()
+            proxy = DelayProxy(LoopbackServer(home).port)
+            nodes[home.name] = SFTPNode(home.name, proxy.port)
+
+        print(
+            f"{NODES} nodes, {size / 2**20:.0f} MiB in 202 files each,"
+            f" {LATENCY * 2000:.0f}ms round trip"
+        )
+        print(f"{'mode':>28} {'seconds':>8} {'MiB/s':>8}")
+        modes = {
+            "one file at a time": lambda: _baseline(nodes, src),
+            "pipelined, 1 stream": lambda: transfer.push(
+                nodes, src, "single", streams=1, client=nodes.get
+            ),
+            "pipelined, 4 streams": lambda: transfer.push(
+                nodes, src, "streams", streams=4, client=nodes.get
+            ),
+            "compressed": lambda: transfer.push(
+                nodes, src, "compressed", compress=True, client=nodes.get
+            ),
+        }
+        transfer.CHUNK_SIZE = 2 * 2**20
+        for mode, push in modes.items():
+            started = time.monotonic()
+            push()
+            elapsed = time.monotonic() - started
+            print(f"{mode:>28} {elapsed:>8.2f} {NODES * size / 2**20 / elapsed:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()